@@ -0,0 +1,70 @@
+"""Sign latency of RSA 2048 (RSASSA-PSS) and ECDSA P-256 keys.
+
+Run from repository root:
+  python -m benchmarks.ecc [--iterations 50]
+
+Token of `tests.pkcs11.PKCS11` with simulated latency of `benchmarks.suite` is
+used; it holds an RSA and an ECDSA P-256 key. Both are signed with a digest
+computed locally, once opening a session per signature and once with the
+session pool and object cache.
+"""
+import click
+
+from oll_sc.api import (sc_sign_ecdsa_p256_sha256,
+                        sc_sign_rsa_pkcs_pss_sha256_prehash)
+from oll_sc.object_cache import disable_object_cache, enable_object_cache
+from oll_sc.session_pool import disable_session_pool, enable_session_pool
+from tests.pkcs11 import PKCS11
+from tests.settings import EC_KEY_ID, VALID_KEY_ID, VALID_PIN
+
+from .suite import DATA, LATENCY, _measure
+
+# name -> function(pkcs11) returning signature
+SIGNERS = {
+    'rsa2048_pss': lambda pkcs11: sc_sign_rsa_pkcs_pss_sha256_prehash(DATA, VALID_KEY_ID,
+                                                                      VALID_PIN, pkcs11=pkcs11),
+    'ecdsa_p256': lambda pkcs11: sc_sign_ecdsa_p256_sha256(DATA, EC_KEY_ID, VALID_PIN,
+                                                           pkcs11=pkcs11),
+}
+
+
+def run(iterations=50, latency=None):
+  """Return dict of name -> result with ops/s, p50/p99 latency and signature
+  size of every signer, with and without session pool ('_pooled' suffix).
+
+  Args:
+    - iterations(int): Signatures per benchmark
+    - latency(dict): Overrides of `benchmarks.suite.LATENCY`
+  """
+  pkcs11 = PKCS11(latency=dict(LATENCY, **(latency or {})), ec_key=True)
+  results = {}
+  for name, sign in SIGNERS.items():
+    results[name] = _measure(lambda: sign(pkcs11), iterations)
+    results[name]['signature_bytes'] = len(sign(pkcs11))
+
+  enable_session_pool()
+  enable_object_cache()
+  try:
+    for name, sign in SIGNERS.items():
+      results[name + '_pooled'] = _measure(lambda: sign(pkcs11), iterations)
+      results[name + '_pooled']['signature_bytes'] = results[name]['signature_bytes']
+  finally:
+    disable_session_pool()
+    disable_object_cache()
+  return results
+
+
+@click.command()
+@click.option('--iterations', '-n', type=int, default=50, help='Signatures per benchmark.')
+def main(iterations):
+  results = run(iterations)
+  click.echo('{:<20} {:>10} {:>9} {:>9} {:>10}'.format(
+      'benchmark', 'ops/s', 'p50 ms', 'p99 ms', 'sig bytes'))
+  for name, result in results.items():
+    click.echo('{:<20} {:>10.1f} {:>9.2f} {:>9.2f} {:>10}'.format(
+        name, result['ops_per_sec'], result['p50_ms'], result['p99_ms'],
+        result['signature_bytes']))
+
+
+if __name__ == '__main__':
+  main()  # pylint: disable=E1120
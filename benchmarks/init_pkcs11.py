@@ -0,0 +1,67 @@
+"""Calls per second of `sc_is_present` with and without shared PyKCS11Lib.
+
+Run from repository root:
+  python -m benchmarks.init_pkcs11 [--load-latency-ms 5] [--calls 200] [--real]
+
+Without `--real` PyKCS11Lib is replaced by a fake which sleeps for
+`--load-latency-ms` in `load()` (dlopen + C_Initialize of OpenSC).
+"""
+import time
+from unittest import mock
+
+import click
+
+import oll_sc
+from oll_sc.api import sc_is_present
+
+
+class _SimulatedPyKCS11Lib:
+  load_latency = 0.005
+
+  def load(self, path):
+    time.sleep(self.load_latency)
+
+  def getSlotList(self, tokenPresent=False):
+    return [0]
+
+
+def _calls_per_second(func, calls):
+  start = time.perf_counter()
+  for _ in range(calls):
+    func()
+  return calls / (time.perf_counter() - start)
+
+
+def _uncached_call():
+  """Behaviour before shared instance: library is loaded for every call."""
+  oll_sc.reload_pkcs11()
+  sc_is_present()
+
+
+def _run(calls):
+  before = _calls_per_second(_uncached_call, calls)
+  oll_sc.get_pkcs11()
+  after = _calls_per_second(sc_is_present, calls)
+  click.echo('load per call:   {:>12.1f} calls/s'.format(before))
+  click.echo('shared instance: {:>12.1f} calls/s'.format(after))
+  click.echo('speedup:         {:>12.1f}x'.format(after / before))
+
+
+@click.command()
+@click.option('--calls', type=int, default=200, help='Number of calls per run.')
+@click.option('--load-latency-ms', type=float, default=5.0,
+              help='Simulated library load latency.')
+@click.option('--real', is_flag=True, help='Use bundled OpenSC library.')
+def main(calls, load_latency_ms, real):
+  if real:
+    _run(calls)
+    return
+
+  _SimulatedPyKCS11Lib.load_latency = load_latency_ms / 1000
+  with mock.patch.object(oll_sc, 'PyKCS11Lib', _SimulatedPyKCS11Lib), \
+          mock.patch.object(oll_sc, 'OPENSC_LIB_PATH', mock.Mock(is_file=lambda: True)):
+    _run(calls)
+
+
+if __name__ == '__main__':
+  main()  # pylint: disable=E1120
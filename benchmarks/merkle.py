@@ -0,0 +1,53 @@
+"""Documents signed per second by `sc_sign_merkle` and `sc_sign_many`.
+
+Run from repository root:
+  python -m benchmarks.merkle [--documents 100000] [--workers N]
+
+Token of `tests.pkcs11.PKCS11` with simulated latency of `benchmarks.suite` is
+used. `sc_sign_many` signs only a sample of documents, because it needs one token
+signature per document.
+"""
+import time
+
+import click
+
+from oll_sc.api import sc_sign_many
+from oll_sc.merkle import sc_sign_merkle
+from tests.pkcs11 import PKCS11
+from tests.settings import VALID_KEY_ID, VALID_PIN
+
+from .suite import LATENCY
+
+# Number of documents signed with `sc_sign_many`
+SIGN_MANY_SAMPLE = 50
+
+
+def _rate(func, count):
+  start = time.perf_counter()
+  func()
+  return count / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--documents', type=int, default=100000, help='Number of documents.')
+@click.option('--size', type=int, default=4096, help='Size of a document in bytes.')
+@click.option('--workers', type=int, default=None, help='Hashing threads (default: CPUs).')
+def main(documents, size, workers):
+  pkcs11 = PKCS11(latency=LATENCY)
+  items = [i.to_bytes(8, 'big') * (size // 8) for i in range(documents)]
+  sample = items[:SIGN_MANY_SAMPLE]
+
+  rates = [
+      ('sc_sign_many', _rate(lambda: list(sc_sign_many(sample, VALID_KEY_ID, VALID_PIN,
+                                                       pkcs11=pkcs11)), len(sample))),
+      ('sc_sign_merkle', _rate(lambda: sc_sign_merkle(items, VALID_KEY_ID, VALID_PIN,
+                                                      workers=workers, pkcs11=pkcs11),
+                               documents)),
+  ]
+  click.echo('{:<16} {:>14}'.format('', 'documents/s'))
+  for name, rate in rates:
+    click.echo('{:<16} {:>14.1f}'.format(name, rate))
+
+
+if __name__ == '__main__':
+  main()  # pylint: disable=E1120
@@ -0,0 +1,114 @@
+"""Import time of package modules.
+
+Run from repository root:
+  python -m benchmarks.startup [--runs 5] [--save-baseline] [--tolerance 0.5]
+
+Every module is imported in a new interpreter with `python -X importtime` and
+the fastest run is reported. Command exits with status 1 if import of a module
+got slower than `benchmarks/startup_baseline.json` by more than `--tolerance`,
+or if it imports one of `LAZY_MODULES`.
+"""
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import click
+
+BASELINE_PATH = Path(__file__).parent / 'startup_baseline.json'
+
+MODULES = ('oll_sc', 'oll_sc.api', 'oll_sc.cli')
+
+# Heavy modules which must be imported only when they are used
+LAZY_MODULES = {
+    'oll_sc': ('PyKCS11', 'platform', 'cryptography', 'ykman'),
+    'oll_sc.api': ('PyKCS11', 'cryptography.x509', 'cryptography.hazmat.primitives.serialization',
+                   'ykman'),
+    'oll_sc.cli': ('PyKCS11', 'cryptography.x509', 'cryptography.hazmat.primitives.serialization',
+                   'ykman'),
+}
+
+
+def import_time(module):
+  """Import module in a new interpreter and return its cumulative import time
+  (ms) and names of all imported modules."""
+  process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                           stderr=subprocess.PIPE, universal_newlines=True, check=True)
+  cumulative = {}
+  for line in process.stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    _, total, name = line[len('import time:'):].split('|')
+    cumulative[name.strip()] = int(total) / 1000
+  return cumulative[module], set(cumulative)
+
+
+def run(runs=5):
+  """Return dict of module -> {'import_ms', 'lazy_imported'}."""
+  results = {}
+  for module in MODULES:
+    times = []
+    imported = set()
+    for _ in range(runs):
+      milliseconds, imported = import_time(module)
+      times.append(milliseconds)
+    results[module] = {
+        'import_ms': min(times),
+        'lazy_imported': sorted(name for name in LAZY_MODULES[module] if name in imported),
+    }
+  return results
+
+
+def compare(results, baseline, tolerance=0.5):
+  """Return list of (module, ratio) of modules slower than baseline by more than
+  `tolerance`, where ratio is current / baseline import time."""
+  regressions = []
+  for module, result in results.items():
+    if module not in baseline:
+      continue
+    ratio = result['import_ms'] / baseline[module]['import_ms']
+    if ratio > 1 + tolerance:
+      regressions.append((module, ratio))
+  return regressions
+
+
+@click.command()
+@click.option('--runs', '-n', type=int, default=5, help='Imports per module.')
+@click.option('--baseline', type=click.Path(), default=str(BASELINE_PATH),
+              help='Baseline results file.')
+@click.option('--save-baseline', is_flag=True, help='Store results as new baseline.')
+@click.option('--tolerance', type=float, default=0.5,
+              help='Allowed relative increase of import time.')
+def main(runs, baseline, save_baseline, tolerance):
+  results = run(runs)
+  baseline_path = Path(baseline)
+  stored = json.loads(baseline_path.read_text()) if baseline_path.is_file() else {}
+
+  click.echo('{:<12} {:>10} {:>10}  {}'.format('module', 'import ms', 'baseline', 'eager'))
+  for module, result in results.items():
+    ratio = ''
+    if module in stored:
+      ratio = '{:.2f}x'.format(result['import_ms'] / stored[module]['import_ms'])
+    click.echo('{:<12} {:>10.1f} {:>10}  {}'.format(
+        module, result['import_ms'], ratio, ', '.join(result['lazy_imported'])))
+
+  if save_baseline:
+    baseline_path.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    click.echo('Baseline saved to {}'.format(baseline_path))
+    return
+
+  failed = False
+  for module, ratio in compare(results, stored, tolerance):
+    click.echo('REGRESSION: import of {} takes {:.2f}x of baseline'.format(module, ratio),
+               err=True)
+    failed = True
+  for module, result in results.items():
+    for name in result['lazy_imported']:
+      click.echo('REGRESSION: {} imports {}'.format(module, name), err=True)
+      failed = True
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()  # pylint: disable=E1120
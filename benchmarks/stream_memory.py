@@ -0,0 +1,118 @@
+"""Peak memory and throughput of signing a large file.
+
+Run from repository root:
+  python -m benchmarks.stream_memory [--size-mb 2048] [--compare-read-bytes]
+
+A sparse file of `--size-mb` megabytes is signed on the token of
+`tests.pkcs11.PKCS11` by streaming it through multi-part signing
+(`sc_sign_rsa_pkcs_pss_sha256_stream`), by hashing it locally
+(`sc_sign_rsa_pkcs_pss_sha256_prehash`) and, with `--compare-read-bytes`, by
+reading it whole (`sc_sign_rsa_pkcs_pss_sha256`). Every variant runs in a forked
+process, whose peak resident memory above its starting size is reported. The
+fake token does not hash streamed data, so only the cost of the API is measured.
+"""
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from oll_sc.api import (sc_sign_rsa_pkcs_pss_sha256,
+                        sc_sign_rsa_pkcs_pss_sha256_prehash,
+                        sc_sign_rsa_pkcs_pss_sha256_stream)
+from oll_sc.hashing import CHUNK_SIZE
+from tests.pkcs11 import PKCS11
+from tests.settings import VALID_KEY_ID, VALID_PIN
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+# name -> function(path, chunk_size, pkcs11) returning signature
+VARIANTS = {
+    'stream': lambda path, chunk_size, pkcs11: sc_sign_rsa_pkcs_pss_sha256_stream(
+        path, VALID_KEY_ID, VALID_PIN, chunk_size, pkcs11=pkcs11),
+    'prehash': lambda path, chunk_size, pkcs11: sc_sign_rsa_pkcs_pss_sha256_prehash(
+        path, VALID_KEY_ID, VALID_PIN, chunk_size, pkcs11=pkcs11),
+    'read_bytes': lambda path, chunk_size, pkcs11: sc_sign_rsa_pkcs_pss_sha256(
+        path.read_bytes(), VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11),
+}
+
+
+def _run_in_child(func):
+  """Call `func` in a forked process and return (seconds, peak bytes above the
+  child's starting resident memory)."""
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    status = 1
+    try:
+      start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      start = time.perf_counter()
+      func()
+      with os.fdopen(write_fd, 'wb') as out:
+        pickle.dump((time.perf_counter() - start, start_rss), out)
+      status = 0
+    finally:
+      os._exit(status)
+
+  os.close(write_fd)
+  with os.fdopen(read_fd, 'rb') as result:
+    data = result.read()
+  _, status, usage = os.wait4(pid, 0)
+  if status != 0 or not data:
+    raise RuntimeError('Benchmark process failed.')
+  seconds, start_rss = pickle.loads(data)
+  return seconds, max(0, usage.ru_maxrss - start_rss) * _MAXRSS_BYTES
+
+
+def run(size_mb=2048, variants=('stream', 'prehash'), chunk_size=CHUNK_SIZE, directory=None):
+  """Return dict of variant -> {'seconds', 'mb_per_sec', 'peak_mb'}.
+
+  Args:
+    - size_mb(int): Size of signed file in megabytes
+    - variants(iterable of str): Names of `VARIANTS` to run
+    - chunk_size(int): Size of chunks in which file is read
+    - directory(str): Directory of the temporary file; system default if None
+  """
+  pkcs11 = PKCS11(stream_digest=False)
+  results = {}
+  with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+    path = Path(tmp_dir) / 'data'
+    with open(str(path), 'wb') as data_file:
+      # Sparse file, so creating it does not take time or disk space
+      data_file.truncate(size_mb * 1024 * 1024)
+
+    for name in variants:
+      sign = VARIANTS[name]
+      seconds, peak = _run_in_child(lambda: sign(path, chunk_size, pkcs11))
+      results[name] = {
+          'seconds': seconds,
+          'mb_per_sec': size_mb / seconds if seconds else float('inf'),
+          'peak_mb': peak / (1024 * 1024),
+      }
+  return results
+
+
+@click.command()
+@click.option('--size-mb', type=int, default=2048, help='Size of signed file in megabytes.')
+@click.option('--chunk-size', type=int, default=CHUNK_SIZE, help='Size of read chunks in bytes.')
+@click.option('--compare-read-bytes', is_flag=True, default=False,
+              help='Also sign file read whole into memory.')
+@click.option('--directory', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Directory of the temporary file.')
+def main(size_mb, chunk_size, compare_read_bytes, directory):
+  variants = ('stream', 'prehash') + (('read_bytes',) if compare_read_bytes else ())
+  results = run(size_mb, variants, chunk_size, directory)
+  click.echo('{:<12} {:>10} {:>10} {:>10}'.format('variant', 'seconds', 'MB/s', 'peak MB'))
+  for name, result in results.items():
+    click.echo('{:<12} {:>10.2f} {:>10.1f} {:>10.1f}'.format(
+        name, result['seconds'], result['mb_per_sec'], result['peak_mb']))
+
+
+if __name__ == '__main__':
+  main()  # pylint: disable=E1120
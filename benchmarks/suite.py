@@ -0,0 +1,158 @@
+"""API benchmarks on a simulated token.
+
+Run from repository root:
+  python -m benchmarks.suite [--iterations 50] [--save-baseline] [--tolerance 0.2]
+
+Token of `tests.pkcs11.PKCS11` is used with per-operation latency (open, login,
+find, sign) and real RSASSA-PSS signatures of a software key. Every benchmark
+reports operations per second and p50/p99 latency. Results are compared with
+`benchmarks/baseline.json`; command exits with status 1 if operations per second
+of any benchmark dropped by more than `--tolerance`.
+"""
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import click
+
+from oll_sc.api import (sc_export_pub_key_pem, sc_export_x509_pem,
+                        sc_is_present, sc_sign_many,
+                        sc_sign_rsa_pkcs_pss_sha256)
+from oll_sc.object_cache import disable_object_cache, enable_object_cache
+from oll_sc.scheduler import SigningScheduler
+from oll_sc.session_pool import disable_session_pool, enable_session_pool
+from tests.pkcs11 import PKCS11
+from tests.settings import VALID_KEY_ID, VALID_PIN
+
+BASELINE_PATH = Path(__file__).parent / 'baseline.json'
+
+# Simulated latency (seconds) of token operations, roughly those of a YubiKey;
+# ECDSA P-256 signing ('sign_ec') is several times faster than RSA 2048
+LATENCY = {'open': 0.002, 'login': 0.005, 'find': 0.002, 'sign': 0.02, 'sign_ec': 0.005}
+
+DATA = b'benchmark data' * 64
+
+
+def _percentile(samples, q):
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _measure(func, iterations, ops_per_call=1):
+  """Call `func` `iterations` times and return ops/s and p50/p99 latency (ms)."""
+  samples = []
+  start = time.perf_counter()
+  for _ in range(iterations):
+    call_start = time.perf_counter()
+    func()
+    samples.append((time.perf_counter() - call_start) / ops_per_call)
+  elapsed = time.perf_counter() - start
+  return {
+      'ops_per_sec': iterations * ops_per_call / elapsed,
+      'p50_ms': _percentile(samples, 0.5) * 1000,
+      'p99_ms': _percentile(samples, 0.99) * 1000,
+      'mean_ms': statistics.mean(samples) * 1000,
+  }
+
+
+BENCHMARKS = {
+    'is_present': lambda pkcs11: sc_is_present(pkcs11=pkcs11),
+    'export_pub_key': lambda pkcs11: sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN,
+                                                           pkcs11=pkcs11),
+    'export_x509': lambda pkcs11: sc_export_x509_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11),
+    'sign': lambda pkcs11: sc_sign_rsa_pkcs_pss_sha256(DATA, VALID_KEY_ID, VALID_PIN,
+                                                       pkcs11=pkcs11),
+}
+
+# Benchmarks signing many items per call: name -> (function, items per call)
+BATCH_BENCHMARKS = {
+    'sign_many': (lambda pkcs11: list(sc_sign_many([DATA] * 10, VALID_KEY_ID, VALID_PIN,
+                                                   pkcs11=pkcs11)), 10),
+}
+
+
+def run(iterations=50, latency=None, slots=2):
+  """Run all benchmarks and return dict of name -> result.
+
+  Args:
+    - iterations(int): Calls per benchmark
+    - latency(dict): Overrides of `LATENCY`
+    - slots(int): Number of simulated tokens with the same key
+  """
+  pkcs11 = PKCS11(slots=slots, latency=dict(LATENCY, **(latency or {})))
+  results = {}
+  for name, func in BENCHMARKS.items():
+    results[name] = _measure(lambda: func(pkcs11), iterations)
+
+  # Pool and cache are filled by the first call, later calls reuse them
+  enable_session_pool()
+  enable_object_cache()
+  try:
+    results['sign_repeated'] = _measure(
+        lambda: sc_sign_rsa_pkcs_pss_sha256(DATA, VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11),
+        iterations)
+  finally:
+    disable_session_pool()
+    disable_object_cache()
+
+  for name, (func, items) in BATCH_BENCHMARKS.items():
+    results[name] = _measure(lambda: func(pkcs11), max(1, iterations // items), items)
+
+  # Signing across tokens in all slots
+  with SigningScheduler.start(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) as scheduler:
+    items = 10 * slots
+    results['sign_scheduler'] = _measure(lambda: list(scheduler.map([DATA] * items)),
+                                         max(1, iterations // items), items)
+  return results
+
+
+def compare(results, baseline, tolerance=0.2):
+  """Return list of (name, ratio) of benchmarks slower than baseline by more
+  than `tolerance`, where ratio is current / baseline operations per second."""
+  regressions = []
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    ratio = result['ops_per_sec'] / baseline[name]['ops_per_sec']
+    if ratio < 1 - tolerance:
+      regressions.append((name, ratio))
+  return regressions
+
+
+@click.command()
+@click.option('--iterations', '-n', type=int, default=50, help='Calls per benchmark.')
+@click.option('--baseline', type=click.Path(), default=str(BASELINE_PATH),
+              help='Baseline results file.')
+@click.option('--save-baseline', is_flag=True, help='Store results as new baseline.')
+@click.option('--tolerance', type=float, default=0.2,
+              help='Allowed relative drop of operations per second.')
+def main(iterations, baseline, save_baseline, tolerance):
+  results = run(iterations)
+  baseline_path = Path(baseline)
+  stored = json.loads(baseline_path.read_text()) if baseline_path.is_file() else {}
+
+  click.echo('{:<16} {:>10} {:>9} {:>9} {:>10}'.format(
+      'benchmark', 'ops/s', 'p50 ms', 'p99 ms', 'baseline'))
+  for name, result in results.items():
+    ratio = ''
+    if name in stored:
+      ratio = '{:.2f}x'.format(result['ops_per_sec'] / stored[name]['ops_per_sec'])
+    click.echo('{:<16} {:>10.1f} {:>9.2f} {:>9.2f} {:>10}'.format(
+        name, result['ops_per_sec'], result['p50_ms'], result['p99_ms'], ratio))
+
+  if save_baseline:
+    baseline_path.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    click.echo('Baseline saved to {}'.format(baseline_path))
+    return
+
+  regressions = compare(results, stored, tolerance)
+  for name, ratio in regressions:
+    click.echo('REGRESSION: {} runs at {:.2f}x of baseline'.format(name, ratio), err=True)
+  if regressions:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()  # pylint: disable=E1120
@@ -0,0 +1,68 @@
+"""Verifications per second of `sc_verify` and `sc_verify_many`.
+
+Run from repository root:
+  python -m benchmarks.verify [--signatures 2000] [--processes N]
+
+Signatures are created with a software RSA 2048 key; verification does not
+touch the smart card.
+"""
+import os
+import time
+
+import click
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from oll_sc.api import sc_verify, sc_verify_many
+
+PSS_PADDING = padding.PSS(padding.MGF1(hashes.SHA256()), 32)
+
+
+def _signed_items(count):
+  key = rsa.generate_private_key(65537, 2048, default_backend())
+  pem = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                      serialization.PublicFormat.SubjectPublicKeyInfo)
+  items = []
+  for i in range(count):
+    data = b'metadata %d' % i
+    items.append((data, key.sign(data, PSS_PADDING, hashes.SHA256())))
+  return pem, items
+
+
+def _rate(func, count):
+  start = time.perf_counter()
+  func()
+  return count / (time.perf_counter() - start)
+
+
+def _parse_every_time(pem, items):
+  """Behaviour without parsed key cache: PEM is parsed for every signature."""
+  for data, signature in items:
+    public_key = serialization.load_pem_public_key(pem, default_backend())
+    public_key.verify(signature, data, PSS_PADDING, hashes.SHA256())
+
+
+@click.command()
+@click.option('--signatures', type=int, default=2000, help='Number of signatures.')
+@click.option('--processes', type=int, default=None, help='Worker processes (default: CPUs).')
+def main(signatures, processes):
+  processes = processes or os.cpu_count() or 1
+  pem, items = _signed_items(signatures)
+
+  rates = [
+      ('parse per call', 1, _rate(lambda: _parse_every_time(pem, items), signatures)),
+      ('sc_verify', 1, _rate(lambda: [sc_verify(d, s, pem) for d, s in items], signatures)),
+      ('sc_verify_many', 1,
+       _rate(lambda: sc_verify_many(items, pem, processes=1), signatures)),
+      ('sc_verify_many', processes,
+       _rate(lambda: sc_verify_many(items, pem, processes=processes,
+                                    process_pool_threshold=0), signatures)),
+  ]
+  click.echo('{:<16} {:>9} {:>14} {:>18}'.format('', 'processes', 'verify/s', 'verify/s/core'))
+  for name, procs, rate in rates:
+    click.echo('{:<16} {:>9} {:>14.1f} {:>18.1f}'.format(name, procs, rate, rate / procs))
+
+
+if __name__ == '__main__':
+  main()  # pylint: disable=E1120
@@ -1,12 +1,11 @@
 import logging
 import os
-import platform
+import threading
 from functools import wraps
 from pathlib import Path
 
-from PyKCS11 import PyKCS11Lib
-
 from .exceptions import PlatformNotSupported
+from .metrics import INIT_PKCS11, timed
 
 logger = logging.getLogger(__name__)
 
@@ -18,39 +17,143 @@ OPENSC_LIBS_PATHS = {
     'Linux-64bit': 'opensc/opensc-pkcs11-Linux-64bit.so'  # NOTE: Built on Ubuntu 16.04!
 }
 
-# https://github.com/easybuilders/easybuild/wiki/OS_flavor_name_version
-# One of ['Windows', 'Darwin', 'Linux']
-_SYSTEM = platform.system()
-# One of ['32bit' , '64bit'] - depends on python executable
-_ARCHITECTURE = platform.architecture()[0]
 
-PLATFORM = '{}-{}'.format(_SYSTEM, _ARCHITECTURE)
+def _resolve_platform():
+  """Return platform name and opensc-pkcs11 lib absolute path."""
+  import platform
+
+  # https://github.com/easybuilders/easybuild/wiki/OS_flavor_name_version
+  # One of ['Windows', 'Darwin', 'Linux']
+  system = platform.system()
+  # One of ['32bit' , '64bit'] - depends on python executable
+  architecture = platform.architecture()[0]
+
+  platform_name = '{}-{}'.format(system, architecture)
+  logger.info('Platform: %s', platform_name)
+  return platform_name, Path(__file__).parent / OPENSC_LIBS_PATHS.get(platform_name, '')
+
+
+# Resolved on first use by `_get_platform` and `_pkcs11_lib_class`, so importing
+# the package does not probe the platform or load PyKCS11
+PLATFORM = None
+OPENSC_LIB_PATH = None
+PyKCS11Lib = None
+
+
+def _get_platform():
+  """Return platform name and opensc-pkcs11 lib absolute path, resolved on
+  first call."""
+  global PLATFORM, OPENSC_LIB_PATH
+  if PLATFORM is None or OPENSC_LIB_PATH is None:
+    platform_name, lib_path = _resolve_platform()
+    if PLATFORM is None:
+      PLATFORM = platform_name
+    if OPENSC_LIB_PATH is None:
+      OPENSC_LIB_PATH = lib_path
+  return PLATFORM, OPENSC_LIB_PATH
+
+
+def _pkcs11_lib_class():
+  """Return PyKCS11Lib class, imported on first call."""
+  global PyKCS11Lib
+  if PyKCS11Lib is None:
+    from PyKCS11 import PyKCS11Lib as lib_class
+    PyKCS11Lib = lib_class
+  return PyKCS11Lib
+
+
+# Process-wide PyKCS11Lib instance and pid of the process which loaded it
+_PKCS11 = None
+_PKCS11_PID = None
+_PKCS11_LOCK = threading.Lock()
+# Instances inherited from parent process are kept referenced, so their
+# finalizer does not call C_Finalize on parent's library state in the child
+_FORKED_PKCS11 = []
+
+
+def _load_pkcs11():
+  """Instantiate PyKCS11Lib and load bundled OpenSC library."""
+  platform_name, lib_path = _get_platform()
+  if not lib_path.is_file():
+    raise PlatformNotSupported(
+        'opensc-pkcs11 library for platform {} is not included'
+        .format(platform_name))
+
+  pkcs11 = _pkcs11_lib_class()()
+  pkcs11.load(str(lib_path.resolve()))
+  logger.debug('PyKCS11Lib successfully loaded OpenSC library.')
+  return pkcs11
 
-logger.info('Platform: %s', PLATFORM)
 
-# opensc-pkcs11 lib absolute path
-OPENSC_LIB_PATH = Path(__file__).parent / OPENSC_LIBS_PATHS.get(PLATFORM, '')
+def _after_fork_in_child():
+  """PKCS#11 handles are not valid across fork, so child has to load library
+  again on first use."""
+  global _PKCS11, _PKCS11_LOCK
+  _PKCS11_LOCK = threading.Lock()
+  if _PKCS11 is not None:
+    _FORKED_PKCS11.append(_PKCS11)
+    _PKCS11 = None
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_pkcs11():
+  """Return process-wide PyKCS11Lib instance.
+
+  OpenSC library is loaded lazily on first call and loaded again in a child
+  process after `os.fork()`.
+
+  Returns:
+    PyKCS11Lib instance with OpenSC library loaded
+
+  Raises:
+    - PlatformNotSupported: If opensc-pkcs11 library is not included for platform
+  """
+  global _PKCS11, _PKCS11_PID
+  pid = os.getpid()
+  pkcs11 = _PKCS11
+  if pkcs11 is not None and _PKCS11_PID == pid:
+    return pkcs11
+
+  with _PKCS11_LOCK:
+    if _PKCS11 is not None and _PKCS11_PID != pid:
+      _FORKED_PKCS11.append(_PKCS11)
+      _PKCS11 = None
+    if _PKCS11 is None:
+      with timed(INIT_PKCS11):
+        _PKCS11 = _load_pkcs11()
+      _PKCS11_PID = pid
+    return _PKCS11
+
+
+def reload_pkcs11():
+  """Unload process-wide PyKCS11Lib instance and load OpenSC library again.
+  Needed for long running processes (e.g. to pick up newly attached readers).
+
+  Returns:
+    Newly loaded PyKCS11Lib instance
+  """
+  global _PKCS11
+  with _PKCS11_LOCK:
+    # Dropping the last reference calls C_Finalize before library is loaded again
+    _PKCS11 = None
+  return get_pkcs11()
 
 
 def init_pkcs11(api_func):
-  """Decorator to reinitialize PyKCS11 lib. Needed for long running processes.
+  """Decorator to pass process-wide PyKCS11 lib to API functions.
   """
   @wraps(api_func)
   def decorator(*args, **kwargs):
-    """If pkcs11 is NOT passed in kwargs, instantiate it and add it to
+    """If pkcs11 is NOT passed in kwargs, use shared instance and add it to
     kwargs.
                   NOTE: pkcs11 MUST be passed as kwarg!
     """
     pkcs11 = kwargs.pop('pkcs11', None)
     if pkcs11 is None:
-      if not OPENSC_LIB_PATH.is_file():
-        raise PlatformNotSupported(
-            'opensc-pkcs11 library for platform {} is not included'
-            .format(PLATFORM))
-
-      pkcs11 = PyKCS11Lib()
-      pkcs11.load(str(OPENSC_LIB_PATH.resolve()))
-      logger.debug('PyKCS11Lib successfully loaded OpenSC library.')
+      pkcs11 = get_pkcs11()
     kwargs['pkcs11'] = pkcs11
 
     return api_func(*args, **kwargs)
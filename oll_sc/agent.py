@@ -0,0 +1,197 @@
+"""Client side of the signing agent (`oll-sc agent`).
+
+The agent holds loaded PKCS#11 library and logged in session and serves requests
+over a Unix domain socket whose path is exported in `OLL_SC_AUTH_SOCK`. While
+the variable is set, API functions decorated with `via_agent` are forwarded to
+the agent unless `pkcs11` is passed explicitly.
+
+Protocol: every message is a 4-byte big endian length followed by a list of
+fields, each one a 4-byte big endian length followed by field bytes.
+  request:  [op, key_id, pin_digest, data, token]
+  response: [b'ok', result] or [b'error', exception class name, message]
+"""
+import hashlib
+import inspect
+import logging
+import os
+import socket
+import struct
+from functools import wraps
+
+from . import exceptions
+from .hashing import CHUNK_SIZE, sha256_digest
+
+logger = logging.getLogger(__name__)
+
+AGENT_SOCK_ENV = 'OLL_SC_AUTH_SOCK'
+
+_LENGTH = struct.Struct('!I')
+# Upper bound of a message, guards against reading garbage lengths
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+def _recv_exactly(sock, size):
+  buffer = bytearray(size)
+  view = memoryview(buffer)
+  received = 0
+  while received < size:
+    count = sock.recv_into(view[received:])
+    if not count:
+      raise ConnectionError('Connection closed by peer.')
+    received += count
+  return bytes(buffer)
+
+
+def send_message(sock, fields):
+  """Send list of bytes fields as one length-prefixed message."""
+  body = b''.join(_LENGTH.pack(len(field)) + field for field in fields)
+  sock.sendall(_LENGTH.pack(len(body)) + body)
+
+
+def recv_message(sock):
+  """Receive one length-prefixed message and return list of its fields.
+
+  Returns:
+    List of fields (bytes) or None if connection was closed
+
+  Raises:
+    - ConnectionError: If message is too large to be read
+    - ValueError: If fields of a received message are malformed
+  """
+  try:
+    header = _recv_exactly(sock, _LENGTH.size)
+  except ConnectionError:
+    return None
+  size, = _LENGTH.unpack(header)
+  if size > MAX_MESSAGE_SIZE:
+    raise ConnectionError('Message of {} bytes is too large.'.format(size))
+
+  body = _recv_exactly(sock, size)
+  fields = []
+  offset = 0
+  while offset < size:
+    if offset + _LENGTH.size > size:
+      raise ValueError('Truncated field length in message.')
+    length, = _LENGTH.unpack_from(body, offset)
+    offset += _LENGTH.size
+    if offset + length > size:
+      raise ValueError('Field of {} bytes exceeds message.'.format(length))
+    fields.append(body[offset:offset + length])
+    offset += length
+  return fields
+
+
+def pin_digest(pin):
+  """Digest of PIN sent to the agent instead of the PIN itself."""
+  return hashlib.sha256(pin.encode() if isinstance(pin, str) else bytes(pin)).digest()
+
+
+def agent_socket_path():
+  """Return path of running agent's socket or None."""
+  path = os.environ.get(AGENT_SOCK_ENV)
+  if not path or not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+    return None
+  return path
+
+
+def _error_from_response(name, message):
+  error_cls = getattr(exceptions, name, None)
+  if not (isinstance(error_cls, type) and issubclass(error_cls, exceptions.SmartCardError)):
+    error_cls = exceptions.SmartCardError
+  # Some exceptions format their message in __init__; message is already formatted
+  error = error_cls.__new__(error_cls)
+  Exception.__init__(error, message)
+  return error
+
+
+class AgentClient:
+  """Connection to the signing agent."""
+
+  def __init__(self, path, timeout=60):
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.settimeout(timeout)
+    try:
+      self._sock.connect(path)
+    except OSError:
+      self._sock.close()
+      raise
+
+  def request(self, op, key_id=None, pin=None, data=None, token=None):
+    """Send request to the agent and return its result (bytes). Token selector
+    (see `oll_sc.slot_resolver`) selects the token; agent's token if None.
+
+    Raises:
+      - SmartCardError (or subclass): Error raised by the agent
+      - SmartCardAgentError: If connection to the agent failed (e.g. agent
+        closed it) or its response is malformed
+    """
+    try:
+      send_message(self._sock, [
+          op.encode(),
+          bytes(key_id or ()),
+          pin_digest(pin) if pin is not None else b'',
+          bytes(data or b''),
+          (token or '').encode(),
+      ])
+      response = recv_message(self._sock)
+    except (OSError, ValueError) as e:
+      raise exceptions.SmartCardAgentError('Signing agent request failed: {}'.format(e))
+    if response is None:
+      raise exceptions.SmartCardAgentError('Agent closed the connection.')
+    if len(response) < 2 or (response[0] != b'ok' and len(response) < 3):
+      raise exceptions.SmartCardAgentError('Malformed response of signing agent.')
+    if response[0] == b'ok':
+      return response[1]
+    raise _error_from_response(response[1].decode(), response[2].decode())
+
+  def close(self):
+    self._sock.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def via_agent(op):
+  """Decorator forwarding API function to the signing agent if it is running and
+  `pkcs11` is not passed. Falls back to calling the function if agent cannot be
+  reached. Errors of an established connection raise SmartCardAgentError.
+
+  Backend configured by `oll_sc.backends` takes precedence over the agent, so
+  `via_backend` has to be applied outside of `via_agent`.
+
+  Args:
+    - op(str): Agent operation (see `oll_sc.agent_server.OPERATIONS`)
+  """
+  def decorator(api_func):
+    signature = inspect.signature(api_func)
+
+    @wraps(api_func)
+    def wrapper(*args, **kwargs):
+      path = agent_socket_path()
+      if path is None or kwargs.get('pkcs11') is not None:
+        return api_func(*args, **kwargs)
+
+      arguments = signature.bind(*args, **kwargs).arguments
+      data = arguments.get('data')
+      if op == 'sign_prehash':
+        # Only digest is sent to the agent
+        data = sha256_digest(data, arguments.get('chunk_size', CHUNK_SIZE))
+      elif isinstance(data, str):
+        data = data.encode()
+
+      try:
+        client = AgentClient(path)
+      except OSError as e:
+        logger.debug('Signing agent is not reachable (%s), calling %s directly.',
+                     e, api_func.__name__)
+        return api_func(*args, **kwargs)
+
+      with client:
+        result = client.request(op, arguments.get('key_id'), arguments.get('pin'), data,
+                                arguments.get('token'))
+      return result == b'\x01' if op == 'is_present' else result
+    return wrapper
+  return decorator
@@ -0,0 +1,184 @@
+"""Signing agent server (`oll-sc agent`). See `oll_sc.agent` for the protocol."""
+import hmac
+import json
+import logging
+import os
+import socketserver
+import tempfile
+import threading
+from pathlib import Path
+
+from PyKCS11 import PyKCS11Error
+
+from . import get_pkcs11
+from .agent import pin_digest, recv_message, send_message
+from .api import (RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM, sc_export_pub_key_pem,
+                  sc_export_x509_pem, sc_is_present, sc_session, sc_sign_rsa,
+                  sc_sign_rsa_pkcs_pss_sha256)
+from .exceptions import SmartCardError, SmartCardWrongPinError
+from .retry import classify_error
+from .metrics import disable_metrics, enable_metrics, get_metrics
+from .object_cache import disable_object_cache, enable_object_cache
+from .session_pool import disable_session_pool, enable_session_pool
+
+logger = logging.getLogger(__name__)
+
+# op -> function(key_id, pin, data, token, pkcs11) returning bytes
+OPERATIONS = {
+    'is_present': lambda key_id, pin, data, token, pkcs11:
+    b'\x01' if sc_is_present(token=token, pkcs11=pkcs11) else b'\x00',
+    'export_pub_key': lambda key_id, pin, data, token, pkcs11:
+    sc_export_pub_key_pem(key_id, pin, token=token, pkcs11=pkcs11),
+    'export_x509': lambda key_id, pin, data, token, pkcs11:
+    sc_export_x509_pem(key_id, pin, token=token, pkcs11=pkcs11),
+    'sign': lambda key_id, pin, data, token, pkcs11:
+    sc_sign_rsa_pkcs_pss_sha256(data, key_id, pin, token=token, pkcs11=pkcs11),
+    'sign_prehash': lambda key_id, pin, data, token, pkcs11:
+    bytes(sc_sign_rsa(data, RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM, key_id, pin, token=token,
+                      pkcs11=pkcs11)),
+    # JSON of `Metrics.snapshot()` of agent's PKCS#11 phases
+    'stats': lambda key_id, pin, data, token, pkcs11:
+    json.dumps(get_metrics().snapshot() if get_metrics() is not None else {}).encode(),
+}
+
+# Operations which do not need PIN digest
+_PUBLIC_OPERATIONS = (b'is_present', b'stats')
+# Number of request fields; older clients do not send token
+_REQUEST_FIELDS = (4, 5)
+
+
+def _error_response(error):
+  return [b'error', type(error).__name__.encode(), str(error).encode()]
+
+
+class _AgentRequestHandler(socketserver.BaseRequestHandler):
+
+  def handle(self):
+    while True:
+      try:
+        message = recv_message(self.request)
+      except (ConnectionError, OSError) as e:
+        logger.debug('Dropping agent connection: %s', e)
+        return
+      except ValueError as e:
+        # Whole message was read, so connection can be used for next requests
+        logger.debug('Malformed agent request: %s', e)
+        send_message(self.request, _error_response(
+            SmartCardError('Malformed agent request: {}'.format(e))))
+        continue
+      if message is None:
+        return
+
+      try:
+        if len(message) not in _REQUEST_FIELDS:
+          raise SmartCardError('Malformed agent request: {} fields.'.format(len(message)))
+        result = self.server.execute(*message)
+      except SmartCardError as e:
+        response = _error_response(e)
+      except PyKCS11Error as e:
+        response = _error_response(classify_error(e))
+      except ValueError as e:
+        logger.debug('Invalid agent request: %s', e)
+        response = _error_response(SmartCardError('Invalid agent request: {}'.format(e)))
+      else:
+        response = [b'ok', result]
+      send_message(self.request, response)
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """Serves API requests with one loaded PKCS#11 library and logged in session.
+  Requests are executed one at a time."""
+  daemon_threads = True
+
+  def __init__(self, path, pin, token=None):
+    """
+    Args:
+      - path(str): Path of Unix domain socket
+      - pin(str): Pin for session login; requests have to send its digest
+      - token(str): Token selector used by requests which do not select a token
+    """
+    self._pin = pin
+    self._token = token
+    self._pin_digest = pin_digest(pin)
+    self._lock = threading.Lock()
+    super().__init__(path, _AgentRequestHandler)
+
+  def server_bind(self):
+    # Socket is created accessible only by its owner; chmod after bind would
+    # leave it open to other users meanwhile. umask is process-wide, agent is
+    # started before any other thread creates files.
+    umask = os.umask(0o177)
+    try:
+      super().server_bind()
+    finally:
+      os.umask(umask)
+
+  def execute(self, op, key_id, digest, data, token=b''):
+    """Execute one request and return its result (bytes). Clients which do not
+    send token field use agent's token.
+
+    Raises:
+      - SmartCardError (or subclass): If request failed
+      - PyKCS11Error: If PKCS#11 call failed outside of API functions
+      - ValueError: If request fields are not valid (e.g. op is not UTF-8)
+    """
+    operation = OPERATIONS.get(op.decode())
+    if operation is None:
+      raise SmartCardError('Unknown agent operation {}.'.format(op.decode()))
+    if op not in _PUBLIC_OPERATIONS and not hmac.compare_digest(digest, self._pin_digest):
+      raise SmartCardWrongPinError('PIN is not valid.')
+
+    with self._lock:
+      return operation(tuple(key_id), self._pin, data, token.decode() or self._token,
+                       get_pkcs11())
+
+  def server_close(self):
+    super().server_close()
+    try:
+      os.unlink(self.server_address)
+    except OSError:
+      pass
+    disable_session_pool()
+    disable_object_cache()
+    disable_metrics()
+
+
+def start_agent(pin, path=None, ttl=3600, token=None):
+  """Log in to smart card and create agent server. Caller runs `serve_forever()`.
+
+  Args:
+    - pin(str): Pin for session login
+    - path(str): Socket path; new private temporary directory is used if None
+    - ttl(int): Seconds after which agent stops and logs out; no limit if 0
+    - token(str): Token selector (see `oll_sc.slot_resolver`) of token logged in
+      at start and used by requests which do not select a token
+
+  Returns:
+    AgentServer instance
+
+  Raises:
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+  """
+  if path is None:
+    path = str(Path(tempfile.mkdtemp(prefix='oll-sc-')) / 'agent.sock')
+
+  enable_session_pool(max_size=1, idle_timeout=ttl or float('inf'))
+  enable_object_cache()
+  enable_metrics()
+  try:
+    with sc_session(pin, token=token, pkcs11=get_pkcs11()):
+      pass
+    server = AgentServer(path, pin, token)
+  except BaseException:
+    disable_session_pool()
+    disable_object_cache()
+    disable_metrics()
+    raise
+
+  if ttl:
+    timer = threading.Timer(ttl, server.shutdown)
+    timer.daemon = True
+    timer.start()
+  logger.info('Signing agent listening on %s', path)
+  return server
@@ -0,0 +1,121 @@
+"""Awaitable versions of `oll_sc.api` functions.
+
+PKCS#11 calls are run one at a time on a dedicated thread, in order in which
+they were awaited, so the event loop is not blocked by smart card operations.
+"""
+import asyncio
+import functools
+import logging
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from . import api
+
+logger = logging.getLogger(__name__)
+
+
+class TokenExecutor:
+  """Runs PKCS#11 calls on a single thread.
+
+  At most `max_pending` calls are submitted at a time (running or waiting);
+  further callers wait in `run` until a call finishes. Cancelling a call which
+  has not started yet removes it; a running call is finished on the thread and
+  its result is discarded.
+  """
+
+  def __init__(self, max_pending=32):
+    """
+    Args:
+      - max_pending(int): Maximum number of submitted calls
+    """
+    self.max_pending = max_pending
+    self._executor = ThreadPoolExecutor(max_workers=1)
+    self._semaphores = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+
+  async def run(self, func, *args, **kwargs):
+    """Run `func(*args, **kwargs)` on PKCS#11 thread and return its result."""
+    loop = asyncio.get_event_loop()
+    semaphore = self._semaphores.get(loop)
+    if semaphore is None:
+      semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_pending)
+
+    await semaphore.acquire()
+    try:
+      future = self._executor.submit(functools.partial(func, *args, **kwargs))
+    except BaseException:
+      semaphore.release()
+      raise
+
+    def release(_):
+      try:
+        loop.call_soon_threadsafe(semaphore.release)
+      except RuntimeError:
+        # Event loop was closed while call was running
+        pass
+    future.add_done_callback(release)
+
+    return await asyncio.wrap_future(future)
+
+  def shutdown(self, wait=True):
+    self._executor.shutdown(wait=wait)
+
+
+_EXECUTOR = None
+
+
+def get_executor():
+  """Return executor used by awaitable API functions."""
+  global _EXECUTOR
+  if _EXECUTOR is None:
+    _EXECUTOR = TokenExecutor()
+  return _EXECUTOR
+
+
+def configure(max_pending=32):
+  """Replace executor used by awaitable API functions.
+
+  Args:
+    - max_pending(int): Maximum number of submitted PKCS#11 calls
+
+  Returns:
+    TokenExecutor instance
+  """
+  global _EXECUTOR
+  executor, _EXECUTOR = _EXECUTOR, TokenExecutor(max_pending)
+  if executor is not None:
+    executor.shutdown(wait=False)
+  return _EXECUTOR
+
+
+def _after_fork_in_child():
+  """Executor thread does not exist in the child process."""
+  global _EXECUTOR
+  _EXECUTOR = None
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+async def sc_export_pub_key_pem(key_id, pin, token=None, pkcs11=None):
+  """Awaitable version of `oll_sc.api.sc_export_pub_key_pem`."""
+  return await get_executor().run(api.sc_export_pub_key_pem, key_id, pin, token=token,
+                                  pkcs11=pkcs11)
+
+
+async def sc_export_x509_pem(key_id, pin, token=None, pkcs11=None):
+  """Awaitable version of `oll_sc.api.sc_export_x509_pem`."""
+  return await get_executor().run(api.sc_export_x509_pem, key_id, pin, token=token,
+                                  pkcs11=pkcs11)
+
+
+async def sc_is_present(token=None, pkcs11=None):
+  """Awaitable version of `oll_sc.api.sc_is_present`."""
+  return await get_executor().run(api.sc_is_present, token=token, pkcs11=pkcs11)
+
+
+async def sc_sign_rsa_pkcs_pss_sha256(data, key_id, pin, token=None, pkcs11=None):
+  """Awaitable version of `oll_sc.api.sc_sign_rsa_pkcs_pss_sha256`."""
+  return await get_executor().run(api.sc_sign_rsa_pkcs_pss_sha256, data, key_id, pin,
+                                  token=token, pkcs11=pkcs11)
@@ -1,46 +1,183 @@
+import hashlib
 import logging
+import os
 from contextlib import contextmanager
+from functools import lru_cache
 
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from PyKCS11 import (CKA_ALWAYS_AUTHENTICATE, CKA_CERTIFICATE_TYPE, CKA_CLASS,
-                     CKA_ID, CKA_VALUE, CKC_X_509, CKF_RW_SESSION,
-                     CKF_SERIAL_SESSION, CKG_MGF1_SHA256, CKM_SHA256,
-                     CKM_SHA256_RSA_PKCS_PSS, CKO_CERTIFICATE, CKO_PRIVATE_KEY,
-                     CKO_PUBLIC_KEY, CKU_CONTEXT_SPECIFIC, PyKCS11Error,
-                     RSA_PSS_Mechanism)
-
-from . import init_pkcs11
+from . import export_cache, init_pkcs11
+from .agent import via_agent
+from .backends import via_backend
 from .exceptions import (SmartCardFindKeyObjectError, SmartCardNotPresentError,
-                         SmartCardSigningError, SmartCardWrongPinError)
+                         SmartCardSigningError, SmartCardTransientError)
+from .hashing import CHUNK_SIZE, data_summary, iter_chunks, sha256_digest
+from .metrics import CONTEXT_LOGIN, FIND_OBJECTS, LOGIN, OPEN_SESSION, SIGN, timed
+from .object_cache import get_object_cache
+from .retry import classify_error, retry_transient, slot_guard
+from .session_pool import get_session_pool
+from .slot_resolver import resolve_slot
+from .watcher import get_token_watcher
 
 logger = logging.getLogger(__name__)
 
 
+class _LazyMechanism:
+  """PyKCS11 mechanism created on first use, so importing this module does not
+  load PyKCS11. Attributes (e.g. `to_native`) are those of the mechanism."""
+
+  def __init__(self, create):
+    self._create = create
+    self._mechanism = None
+
+  def __getattr__(self, name):
+    if self._mechanism is None:
+      self._mechanism = self._create()
+    return getattr(self._mechanism, name)
+
+  def __repr__(self):
+    return '<lazy {}>'.format(self._create.__name__)
+
+
+def _rsa_pkcs_pss_sha256():
+  from PyKCS11 import CKG_MGF1_SHA256, CKM_SHA256, CKM_SHA256_RSA_PKCS_PSS, RSA_PSS_Mechanism
+  return RSA_PSS_Mechanism(CKM_SHA256_RSA_PKCS_PSS, CKM_SHA256, CKG_MGF1_SHA256, 32)
+
+
+def _rsa_pkcs_pss_sha256_prehash():
+  from PyKCS11 import CKG_MGF1_SHA256, CKM_RSA_PKCS_PSS, CKM_SHA256, RSA_PSS_Mechanism
+  return RSA_PSS_Mechanism(CKM_RSA_PKCS_PSS, CKM_SHA256, CKG_MGF1_SHA256, 32)
+
+
+def _ecdsa():
+  from PyKCS11 import CKM_ECDSA, Mechanism
+  return Mechanism(CKM_ECDSA)
+
+
+def _ecdsa_sha256():
+  from PyKCS11 import CKM_ECDSA_SHA256, Mechanism
+  return Mechanism(CKM_ECDSA_SHA256)
+
+
+RSA_PKCS_PSS_SHA256_MECHANISM = _LazyMechanism(_rsa_pkcs_pss_sha256)
+# RSASSA-PSS over SHA256 digest computed by the caller
+RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM = _LazyMechanism(_rsa_pkcs_pss_sha256_prehash)
+# ECDSA over digest computed by the caller
+ECDSA_MECHANISM = _LazyMechanism(_ecdsa)
+# ECDSA over SHA256 digest computed by the token, used for multi-part signing
+ECDSA_SHA256_MECHANISM = _LazyMechanism(_ecdsa_sha256)
+
+# Encodings of ECDSA signatures: DER SEQUENCE of r and s (X.509, `cryptography`,
+# securesystemslib) or r || s as returned by PKCS#11 (JWS, COSE)
+SIGNATURE_DER = 'der'
+SIGNATURE_RAW = 'raw'
+SIGNATURE_ENCODINGS = (SIGNATURE_DER, SIGNATURE_RAW)
+# Size of raw ECDSA P-256 signature
+P256_SIGNATURE_SIZE = 64
+
+# DER of named curve OID (CKA_EC_PARAMS) -> `cryptography` curve class name
+_EC_CURVES = {
+    bytes.fromhex('06082a8648ce3d030107'): 'SECP256R1',
+    bytes.fromhex('06052b81040022'): 'SECP384R1',
+}
+
+# Number of parsed public keys kept by `sc_verify` and `sc_verify_many`
+PUBLIC_KEY_CACHE_SIZE = 64
+# Batches of at least this many signatures are verified in a process pool
+VERIFY_PROCESS_POOL_THRESHOLD = 512
+
+
+def _find_object(session, key_id, obj_class, attributes, pkcs11, template=()):
+  """Return handle of object with given key id and class and values of requested
+  attributes. Object cache is used if enabled."""
+  from PyKCS11 import CKA_CLASS, CKA_ID
+
+  def lookup():
+    with timed(FIND_OBJECTS):
+      handle = session.findObjects([(CKA_ID, key_id), (CKA_CLASS, obj_class)] + list(template))[0]
+    return handle, session.getAttributeValue(handle, attributes)
+
+  cache = get_object_cache()
+  if cache is None:
+    return lookup()
+  return cache.get(pkcs11, session, key_id, obj_class, lookup)
+
+
+def _evict_stale_object(error, session, key_id, obj_class):
+  """Remove object from cache if PKCS#11 reported its handle as invalid (e.g.
+  token was reinserted)."""
+  from PyKCS11 import CKR_KEY_HANDLE_INVALID, CKR_OBJECT_HANDLE_INVALID
+
+  cache = get_object_cache()
+  if cache is not None and error.value in (CKR_KEY_HANDLE_INVALID, CKR_OBJECT_HANDLE_INVALID):
+    cache.evict(session, key_id, obj_class)
+
+
+def _ec_public_key(ec_params, ec_point):
+  """Return EC public key of CKA_EC_PARAMS and CKA_EC_POINT values.
+
+  Raises:
+    - ValueError: If curve is not supported or point is not valid
+  """
+  from cryptography.hazmat.primitives.asymmetric import ec
+
+  try:
+    curve = getattr(ec, _EC_CURVES[bytes(ec_params)])()
+  except KeyError:
+    raise ValueError('Unsupported EC curve.')
+  point = bytes(ec_point)
+  # CKA_EC_POINT is DER OCTET STRING of the point, some tokens omit the encoding
+  size = 1 + 2 * ((curve.key_size + 7) // 8)
+  if len(point) == size + 2 and point[:2] == bytes([0x04, size]):
+    point = point[2:]
+  return ec.EllipticCurvePublicKey.from_encoded_point(curve, point)
+
+
+@via_backend
+@via_agent('export_pub_key')
+@retry_transient
 @init_pkcs11
-def sc_export_pub_key_pem(key_id, pin, pkcs11=None):
+def sc_export_pub_key_pem(key_id, pin, token=None, pkcs11=None):
   """Export public key for provided key id from smart card.
 
   Args:
     - key_id(tuple): Key ID as tuple (e.g. (1,))
     - pin(str): Pin for session login
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
     - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
 
   Returns:
-    Public key in PEM format (bytes)
+    Public key (RSA or EC) in PEM format (bytes)
 
   Raises:
     - SmartCardNotPresentError: If smart card is not inserted
     - SmartCardWrongPinError: If pin is incorrect
     - SmartCardFindKeyObjectError: If public key for given key id does not exist
+
+  NOTE: If export cache is enabled (`oll_sc.export_cache.enable_export_cache`),
+        cached public key of inserted token is returned without login, so PIN
+        is not verified.
   """
-  with sc_session(pin, pkcs11=pkcs11) as session:
-    try:
-      pub_key = session.findObjects([(CKA_ID, key_id), (CKA_CLASS, CKO_PUBLIC_KEY)])[0]
-      pub_key_value = session.getAttributeValue(pub_key, [CKA_VALUE])[0]
+  cache = export_cache.get_export_cache()
+  if cache is not None:
+    slot = resolve_slot(pkcs11, token) if token is not None else None
+    pub_key_pem = cache.get(pkcs11, key_id, export_cache.PUBLIC_KEY, slot)
+    if pub_key_pem is not None:
+      return pub_key_pem
+
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  from PyKCS11 import CKA_EC_PARAMS, CKA_EC_POINT, CKA_VALUE, CKO_PUBLIC_KEY, PyKCS11Error
 
-      pub_key_der = serialization.load_der_public_key(bytes(pub_key_value), default_backend())
+  with sc_session(pin, token=token, pkcs11=pkcs11) as session:
+    try:
+      _, (pub_key_value, ec_params, ec_point) = _find_object(
+          session, key_id, CKO_PUBLIC_KEY, [CKA_VALUE, CKA_EC_PARAMS, CKA_EC_POINT], pkcs11)
+
+      if pub_key_value:
+        pub_key_der = serialization.load_der_public_key(bytes(pub_key_value), default_backend())
+      else:
+        # EC public keys of PIV tokens have only curve and point
+        pub_key_der = _ec_public_key(ec_params, ec_point)
       # Convert public key DER to PEM format
       pub_key_pem = pub_key_der.public_bytes(
           serialization.Encoding.PEM,
@@ -48,18 +185,30 @@ def sc_export_pub_key_pem(key_id, pin, pkcs11=None):
       )
 
       logger.debug('Public key for key id: %s is \n%s', key_id, pub_key_pem.decode())
+      if cache is not None:
+        # CKA_VALUE can be PKCS#1, cache keeps DER of the exported PEM
+        spki_der = pub_key_der.public_bytes(serialization.Encoding.DER,
+                                            serialization.PublicFormat.SubjectPublicKeyInfo)
+        cache.put(pkcs11, key_id, export_cache.PUBLIC_KEY, spki_der, pub_key_pem, slot)
       return pub_key_pem
     except (IndexError, TypeError, ValueError):
       raise SmartCardFindKeyObjectError(key_id)
+    except PyKCS11Error as e:
+      raise classify_error(e)
 
 
+@via_backend
+@via_agent('export_x509')
+@retry_transient
 @init_pkcs11
-def sc_export_x509_pem(key_id, pin, pkcs11=None):
+def sc_export_x509_pem(key_id, pin, token=None, pkcs11=None):
   """Export x509 certificate for provided key id from smart card.
 
   Args:
     - key_id(tuple): Key ID as tuple (e.g. (1,))
     - pin(str): Pin for session login
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
     - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
 
   Returns:
@@ -69,44 +218,82 @@ def sc_export_x509_pem(key_id, pin, pkcs11=None):
     - SmartCardNotPresentError: If smart card is not inserted
     - SmartCardWrongPinError: If pin is incorrect
     - SmartCardFindKeyObjectError: If x509 certificate for given key id does not exist
+
+  NOTE: If export cache is enabled (`oll_sc.export_cache.enable_export_cache`),
+        cached certificate of inserted token is returned without login, so PIN
+        is not verified.
   """
-  with sc_session(pin, pkcs11=pkcs11) as session:
+  cache = export_cache.get_export_cache()
+  if cache is not None:
+    slot = resolve_slot(pkcs11, token) if token is not None else None
+    x509_cert_value_pem = cache.get(pkcs11, key_id, export_cache.X509, slot)
+    if x509_cert_value_pem is not None:
+      return x509_cert_value_pem
+
+  from cryptography import x509
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  from PyKCS11 import CKA_CERTIFICATE_TYPE, CKA_VALUE, CKC_X_509, CKO_CERTIFICATE, PyKCS11Error
+
+  with sc_session(pin, token=token, pkcs11=pkcs11) as session:
     try:
-      x509_cert = session.findObjects([(CKA_ID, key_id),
-                                       (CKA_CLASS, CKO_CERTIFICATE),
-                                       (CKA_CERTIFICATE_TYPE, CKC_X_509)])[0]
-      x509_cert_value = session.getAttributeValue(x509_cert, [CKA_VALUE])[0]
+      _, (x509_cert_value,) = _find_object(session, key_id, CKO_CERTIFICATE, [CKA_VALUE], pkcs11,
+                                           template=[(CKA_CERTIFICATE_TYPE, CKC_X_509)])
       x509_cert_value_der = x509.load_der_x509_certificate(bytes(x509_cert_value),
                                                            default_backend())
       # Convert x509 certificate DER to PEM format
       x509_cert_value_pem = x509_cert_value_der.public_bytes(serialization.Encoding.PEM)
 
       logger.debug('X509 certificate for key id: %s is \n%s', key_id, x509_cert_value_pem.decode())
+      if cache is not None:
+        cache.put(pkcs11, key_id, export_cache.X509, x509_cert_value, x509_cert_value_pem,
+                  slot)
       return x509_cert_value_pem
     except (IndexError, TypeError, ValueError):
       raise SmartCardFindKeyObjectError(key_id)
+    except PyKCS11Error as e:
+      raise classify_error(e)
 
 
+@via_backend
+@via_agent('is_present')
 @init_pkcs11
-def sc_is_present(pkcs11=None):
+def sc_is_present(token=None, pkcs11=None):
   """Check if smart card is inserted.
 
   Args:
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      any token if None
     - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
 
   Returns:
     True if smart card is inserted otherwise False (bool)
+
+  NOTE: If token watcher is running (`oll_sc.watcher.start_token_watcher`),
+        its snapshot of present tokens is used.
   """
+  if token is not None:
+    try:
+      resolve_slot(pkcs11, token)
+      return True
+    except SmartCardNotPresentError:
+      return False
+
+  watcher = get_token_watcher()
+  if watcher is not None and watcher.pkcs11 is pkcs11:
+    return watcher.is_present()
   return bool(pkcs11.getSlotList(tokenPresent=True))
 
 
 @contextmanager
 @init_pkcs11
-def sc_session(pin, pkcs11=None):
+def sc_session(pin, token=None, pkcs11=None):
   """Open token session needed for signing, encryption, etc.
 
   Args:
     - pin(str): Pin for session login
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
     - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
 
   Returns:
@@ -115,30 +302,86 @@ def sc_session(pin, pkcs11=None):
   Raises:
     - SmartCardNotPresentError: If smart card is not inserted
     - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardPinLockedError: If PIN is locked
+    - SmartCardTransientError: If token failed temporarily (e.g. CKR_DEVICE_ERROR)
+    - SmartCardCircuitOpenError: If token of the slot failed repeatedly
+
+  NOTE: Errors are classified by `oll_sc.retry.classify_error`.
+  NOTE: If session pool is enabled (`oll_sc.session_pool.enable_session_pool`),
+        logged in session is borrowed from the pool and returned to it afterwards.
   """
-  if not sc_is_present(pkcs11=pkcs11):
+  pool = get_session_pool()
+  if pool is not None:
+    slot = resolve_slot(pkcs11, token) if token is not None else None
+    with pool.session(pin, pkcs11, slot) as session:
+      yield session
+    return
+
+  from PyKCS11 import CKF_RW_SESSION, CKF_SERIAL_SESSION, PyKCS11Error
+
+  if token is None and not sc_is_present(pkcs11=pkcs11):
     raise SmartCardNotPresentError('Please insert your smart card.')
 
   try:
-    slot = pkcs11.getSlotList(tokenPresent=True)[0]
+    slot = resolve_slot(pkcs11, token)
+  except PyKCS11Error as e:
+    raise classify_error(e)
 
-    session = pkcs11.openSession(slot, CKF_SERIAL_SESSION | CKF_RW_SESSION)
+  with slot_guard(slot):
+    try:
+      with timed(OPEN_SESSION):
+        session = pkcs11.openSession(slot, CKF_SERIAL_SESSION | CKF_RW_SESSION)
+    except PyKCS11Error as e:
+      raise classify_error(e)
     logger.debug('Session opened for slot %s', slot)
 
-    session.login(pin)
-    yield session
-    session.logout()
+    try:
+      try:
+        with timed(LOGIN):
+          session.login(pin)
+      except PyKCS11Error as e:
+        # Never retried when PIN is incorrect, so PIN attempts are not used up
+        raise classify_error(e, login=True)
+      yield session
+      try:
+        session.logout()
+        logger.debug('Successfully logged out of session.')
+      except PyKCS11Error as e:
+        logger.debug('Could not log out of session: %s', e)
+    finally:
+      try:
+        session.closeSession()
+        logger.debug('Successfully closed the session.')
+      except PyKCS11Error as e:
+        logger.debug('Could not close the session: %s', e)
+
+
+def _context_login(session, pin):
+  """Login with CKU_CONTEXT_SPECIFIC for one operation of a key with
+  CKA_ALWAYS_AUTHENTICATE. Errors are login errors, which are never retried."""
+  from PyKCS11 import CKU_CONTEXT_SPECIFIC, PyKCS11Error
+
+  try:
+    with timed(CONTEXT_LOGIN):
+      session.login(pin, CKU_CONTEXT_SPECIFIC)
+  except PyKCS11Error as e:
+    raise classify_error(e, login=True)
+
+
+def _find_private_key(session, key_id, pkcs11):
+  """Return private key handle for given key id and its CKA_ALWAYS_AUTHENTICATE
+  attribute value."""
+  from PyKCS11 import CKA_ALWAYS_AUTHENTICATE, CKO_PRIVATE_KEY
 
-    logger.debug('Successfully logged out of session.')
-  except PyKCS11Error:
-    raise SmartCardWrongPinError('PIN is not valid.')
-  finally:
-    session.closeSession()
-    logger.debug('Successfully closed the session.')
+  priv_key, (always_auth,) = _find_object(session, key_id, CKO_PRIVATE_KEY,
+                                          [CKA_ALWAYS_AUTHENTICATE], pkcs11)
+  return priv_key, always_auth
 
 
+@via_backend
+@retry_transient
 @init_pkcs11
-def sc_sign_rsa(data, mechanism, key_id, pin, pkcs11=None):
+def sc_sign_rsa(data, mechanism, key_id, pin, token=None, pkcs11=None):
   """Create and return signature using provided rsa mechanism.
 
   Args:
@@ -146,6 +389,8 @@ def sc_sign_rsa(data, mechanism, key_id, pin, pkcs11=None):
     - mechanism(PyKCS11 mechanism): Consult PyKCS11 for more info
     - key_id(tuple): Key ID as tuple (e.g. (1,))
     - pin(str): Pin for session login
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
     - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
 
   Returns:
@@ -156,36 +401,284 @@ def sc_sign_rsa(data, mechanism, key_id, pin, pkcs11=None):
     - SmartCardWrongPinError: If pin is incorrect
     - SmartCardFindKeyObjectError: If private key for given key id does not exist
     - SmartCardSigningError: If error happened during signing data
+    - SmartCardTransientError: If token kept failing temporarily after retries
+
+  NOTE: Transient errors are retried with backoff (`oll_sc.retry.configure_retry`).
   """
+  return _sign(data, mechanism, key_id, pin, token, pkcs11)
+
+
+def _sign(data, mechanism, key_id, pin, token, pkcs11):
+  """Sign data with private key of key id in one session; see `sc_sign_rsa`."""
+  from PyKCS11 import CKO_PRIVATE_KEY, PyKCS11Error
+
   if isinstance(data, str):
     data = data.encode()
 
-  logger.debug('About to sign data %s with mechanism %s', data, mechanism)
+  if logger.isEnabledFor(logging.DEBUG):
+    # Data is not logged, it can be large or confidential
+    logger.debug('About to sign %s bytes of data (SHA256 %s) with mechanism %s',
+                 *data_summary(data), mechanism)
 
-  with sc_session(pin, pkcs11=pkcs11) as session:
+  with sc_session(pin, token=token, pkcs11=pkcs11) as session:
     try:
-      priv_key = session.findObjects([(CKA_ID, key_id), (CKA_CLASS, CKO_PRIVATE_KEY)])[0]
+      priv_key, always_auth = _find_private_key(session, key_id, pkcs11)
 
       # If CKA_ALWAYS_AUTHENTICATE is True, login with CKU_CONTEXT_SPECIFIC
-      always_auth = session.getAttributeValue(priv_key, [CKA_ALWAYS_AUTHENTICATE])[0]
       if always_auth:
-        session.login(pin, CKU_CONTEXT_SPECIFIC)
+        _context_login(session, pin)
 
-      return session.sign(priv_key, data, mechanism)
+      with timed(SIGN):
+        return session.sign(priv_key, data, mechanism)
     except (IndexError, TypeError):
       raise SmartCardFindKeyObjectError(key_id)
-    except PyKCS11Error:
+    except PyKCS11Error as e:
+      _evict_stale_object(e, session, key_id, CKO_PRIVATE_KEY)
+      if isinstance(classify_error(e), SmartCardTransientError):
+        raise SmartCardTransientError('Token error while signing, try again: {}'.format(e))
       raise SmartCardSigningError(data)
 
 
+@via_backend
+@retry_transient
+@init_pkcs11
+def sc_sign_ecdsa(data, mechanism, key_id, pin, token=None, pkcs11=None):
+  """Create and return signature using provided ECDSA mechanism.
+
+  Args:
+    - data(str | bytes): Data (or digest for CKM_ECDSA) to be signed
+    - mechanism(PyKCS11 mechanism): ECDSA mechanism (e.g. ECDSA_MECHANISM)
+    - key_id(tuple): Key ID as tuple (e.g. (1,))
+    - pin(str): Pin for session login
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    Signature as returned by PKCS#11, r || s (bytes)
+
+  Raises:
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If private key for given key id does not exist
+    - SmartCardSigningError: If error happened during signing data (e.g. key is
+      not an EC key)
+    - SmartCardTransientError: If token kept failing temporarily after retries
+
+  NOTE: Transient errors are retried with backoff (`oll_sc.retry.configure_retry`).
+  """
+  return bytes(_sign(data, mechanism, key_id, pin, token, pkcs11))
+
+
+@via_backend
+@init_pkcs11
+def sc_sign_ecdsa_p256_sha256(data, key_id, pin, encoding=SIGNATURE_DER, chunk_size=CHUNK_SIZE,
+                              token=None, pkcs11=None):
+  """Hash data locally with SHA256 and sign the digest with ECDSA P-256 key.
+  Only the digest is sent to the smart card.
+
+  Args:
+    - data(str | bytes-like | pathlib.Path | file object): Data, path of a file or
+      binary file object to be digested and signed
+    - key_id(tuple): Key ID as tuple (e.g. (2,))
+    - pin(str): Pin for session login
+    - encoding(str): SIGNATURE_DER or SIGNATURE_RAW (r || s, 64 bytes)
+    - chunk_size(int): Size of chunks in which files are read and hashed
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    ECDSA signature of SHA256 digested data (bytes)
+
+  Raises:
+    - ValueError: If encoding is not known
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If private key for given key id does not exist
+    - SmartCardSigningError: If error happened during signing data (e.g. key is
+      not an EC P-256 key)
+  """
+  if encoding not in SIGNATURE_ENCODINGS:
+    raise ValueError('Unknown signature encoding {}.'.format(encoding))
+  digest = sha256_digest(data, chunk_size)
+  signature = sc_sign_ecdsa(digest, ECDSA_MECHANISM, key_id, pin, token=token, pkcs11=pkcs11)
+  if len(signature) != P256_SIGNATURE_SIZE:
+    # Key of another curve
+    raise SmartCardSigningError(digest)
+  return ecdsa_signature_to_der(signature) if encoding == SIGNATURE_DER else signature
+
+
+@via_backend
+@via_agent('sign')
 @init_pkcs11
-def sc_sign_rsa_pkcs_pss_sha256(data, key_id, pin, pkcs11=None):
+def sc_sign_rsa_pkcs_pss_sha256(data, key_id, pin, token=None, pkcs11=None):
   """Sign data using SHA256_RSA_PKCS_PSS mechanism.
 
   Args:
     - data(str | bytes): Data to be digested and signed
     - key_id(tuple): Key ID as tuple (e.g. (1,))
     - pin(str): Pin for session login
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    Signature based on RSASSA-PSS signing algorithm on SHA256 digested data (bytes)
+
+  Raises:
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If private key for given key id does not exist
+    - SmartCardSigningError: If error happened during signing data
+  """
+  return bytes(sc_sign_rsa(data, RSA_PKCS_PSS_SHA256_MECHANISM, key_id, pin, token=token,
+                           pkcs11=pkcs11))
+
+
+@via_backend
+@via_agent('sign_prehash')
+@init_pkcs11
+def sc_sign_rsa_pkcs_pss_sha256_prehash(data, key_id, pin, chunk_size=CHUNK_SIZE, token=None,
+                                        pkcs11=None):
+  """Hash data locally with SHA256 and sign only the digest using RSA_PKCS_PSS
+  mechanism. Signature is the same as one created by `sc_sign_rsa_pkcs_pss_sha256`,
+  but data is not sent to the smart card.
+
+  Args:
+    - data(str | bytes-like | pathlib.Path | file object): Data, path of a file or
+      binary file object to be digested and signed
+    - key_id(tuple): Key ID as tuple (e.g. (1,))
+    - pin(str): Pin for session login
+    - chunk_size(int): Size of chunks in which files are read and hashed
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    Signature based on RSASSA-PSS signing algorithm on SHA256 digested data (bytes)
+
+  Raises:
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If private key for given key id does not exist
+    - SmartCardSigningError: If error happened during signing data
+  """
+  digest = sha256_digest(data, chunk_size)
+  return bytes(sc_sign_rsa(digest, RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM, key_id, pin,
+                           token=token, pkcs11=pkcs11))
+
+
+def _check(rv):
+  from PyKCS11 import CKR_OK, PyKCS11Error
+
+  if rv != CKR_OK:
+    raise PyKCS11Error(rv)
+
+
+def _sign_final(lib, handle):
+  """Finish multi-part signing operation and return signature (bytes)."""
+  from PyKCS11 import ckbytelist
+
+  signature = ckbytelist()
+  # First call gets signature size, second one the signature
+  _check(lib.C_SignFinal(handle, signature))
+  _check(lib.C_SignFinal(handle, signature))
+  return bytes(signature)
+
+
+@via_backend
+@init_pkcs11
+def sc_sign_stream(data, mechanism, key_id, pin, chunk_size=CHUNK_SIZE, token=None,
+                   pkcs11=None):
+  """Sign data with multi-part signing (C_SignInit, C_SignUpdate, C_SignFinal).
+  Data is passed to the token in chunks, so it is never loaded in memory whole.
+
+  Args:
+    - data(str | bytes-like | mmap | pathlib.Path | file object): Data, path of a
+      file or binary file object to be digested and signed; slices of bytes-like
+      and mmap objects are not copied, files are read into one reused buffer
+    - mechanism(PyKCS11 mechanism): Mechanism digesting data on the token (e.g.
+      RSA_PKCS_PSS_SHA256_MECHANISM or ECDSA_SHA256_MECHANISM)
+    - key_id(tuple): Key ID as tuple (e.g. (1,))
+    - pin(str): Pin for session login
+    - chunk_size(int): Size of chunks passed to the token
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    Signature as returned by PKCS#11 (bytes); r || s for ECDSA
+
+  Raises:
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If private key for given key id does not exist
+    - SmartCardSigningError: If error happened during signing data
+    - SmartCardTransientError: If token failed temporarily (e.g. CKR_DEVICE_ERROR)
+
+  NOTE: Unlike `sc_sign_rsa`, signing is not retried, since file objects cannot
+        be read again. Errors carry size and SHA256 of data read so far.
+  """
+  from PyKCS11 import CKO_PRIVATE_KEY, PyKCS11Error, ckbytelist
+
+  with sc_session(pin, token=token, pkcs11=pkcs11) as session:
+    try:
+      priv_key, always_auth = _find_private_key(session, key_id, pkcs11)
+    except (IndexError, TypeError):
+      raise SmartCardFindKeyObjectError(key_id)
+
+    lib, handle = session.lib, session.session
+    digest, size = hashlib.sha256(), 0
+    try:
+      _check(lib.C_SignInit(handle, mechanism.to_native(), priv_key))
+      try:
+        # Context specific login authorizes the initialized operation
+        if always_auth:
+          _context_login(session, pin)
+        with timed(SIGN):
+          for chunk in iter_chunks(data, chunk_size):
+            digest.update(chunk)
+            size += len(chunk)
+            # Filling native byte list from bytes is faster than from a memoryview
+            _check(lib.C_SignUpdate(handle, ckbytelist(bytes(chunk))))
+          signature = _sign_final(lib, handle)
+      except BaseException:
+        # Terminate operation, so the session can sign again (e.g. pooled); if
+        # token already terminated it, CKR_OPERATION_NOT_INITIALIZED is ignored
+        try:
+          _sign_final(lib, handle)
+        except PyKCS11Error:
+          pass
+        raise
+    except PyKCS11Error as e:
+      _evict_stale_object(e, session, key_id, CKO_PRIVATE_KEY)
+      if isinstance(classify_error(e), SmartCardTransientError):
+        raise SmartCardTransientError('Token error while signing, try again: {}'.format(e))
+      raise SmartCardSigningError(size=size, digest=digest.hexdigest())
+
+  logger.debug('Signed %s bytes of data (SHA256 %s) with mechanism %s', size,
+               digest.hexdigest(), mechanism)
+  return signature
+
+
+@via_backend
+@via_agent('sign_prehash')
+@init_pkcs11
+def sc_sign_rsa_pkcs_pss_sha256_stream(data, key_id, pin, chunk_size=CHUNK_SIZE, token=None,
+                                       pkcs11=None):
+  """Sign data using SHA256_RSA_PKCS_PSS mechanism with multi-part signing.
+  Signature is the same as one created by `sc_sign_rsa_pkcs_pss_sha256`, but
+  data is passed to the token in chunks instead of loaded in memory whole.
+
+  Args:
+    - data(str | bytes-like | mmap | pathlib.Path | file object): Data, path of a
+      file or binary file object to be digested and signed
+    - key_id(tuple): Key ID as tuple (e.g. (1,))
+    - pin(str): Pin for session login
+    - chunk_size(int): Size of chunks passed to the token
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
     - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
 
   Returns:
@@ -196,6 +689,185 @@ def sc_sign_rsa_pkcs_pss_sha256(data, key_id, pin, pkcs11=None):
     - SmartCardWrongPinError: If pin is incorrect
     - SmartCardFindKeyObjectError: If private key for given key id does not exist
     - SmartCardSigningError: If error happened during signing data
+
+  NOTE: If signing agent is running, data is hashed locally and only the digest
+        is sent to the agent (like `sc_sign_rsa_pkcs_pss_sha256_prehash`).
+  """
+  return sc_sign_stream(data, RSA_PKCS_PSS_SHA256_MECHANISM, key_id, pin, chunk_size,
+                        token=token, pkcs11=pkcs11)
+
+
+@via_backend
+@init_pkcs11
+def sc_sign_many(data_items, key_id, pin, mechanism=RSA_PKCS_PSS_SHA256_MECHANISM, token=None,
+                 pkcs11=None):
+  """Sign many data items in one session. Private key is looked up once and
+  signatures are yielded in order of data items.
+
+  Args:
+    - data_items(iterable of str | bytes): Data items to be digested and signed
+    - key_id(tuple): Key ID as tuple (e.g. (1,))
+    - pin(str): Pin for session and context specific login
+    - mechanism(PyKCS11 mechanism): Defaults to SHA256_RSA_PKCS_PSS
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    Generator of signatures (bytes). If signing of a data item failed,
+    SmartCardSigningError instance is yielded in place of its signature.
+
+  Raises:
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If private key for given key id does not exist
+  """
+  from PyKCS11 import CKO_PRIVATE_KEY, PyKCS11Error
+
+  with sc_session(pin, token=token, pkcs11=pkcs11) as session:
+    try:
+      priv_key, always_auth = _find_private_key(session, key_id, pkcs11)
+    except (IndexError, TypeError):
+      raise SmartCardFindKeyObjectError(key_id)
+
+    for data in data_items:
+      if isinstance(data, str):
+        data = data.encode()
+
+      # Context specific login is valid for one signing operation only; its
+      # errors abort the batch, so PIN attempts are not used up
+      if always_auth:
+        _context_login(session, pin)
+      try:
+        with timed(SIGN):
+          signature = bytes(session.sign(priv_key, data, mechanism))
+      except PyKCS11Error as e:
+        _evict_stale_object(e, session, key_id, CKO_PRIVATE_KEY)
+        signature = SmartCardSigningError(data)
+      except TypeError:
+        signature = SmartCardSigningError(data)
+      yield signature
+
+
+def ecdsa_signature_to_der(signature):
+  """Return DER encoding of raw (r || s) ECDSA signature."""
+  from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+
+  signature = bytes(signature)
+  size = len(signature) // 2
+  return encode_dss_signature(int.from_bytes(signature[:size], 'big'),
+                              int.from_bytes(signature[size:], 'big'))
+
+
+def ecdsa_signature_to_raw(signature, size=P256_SIGNATURE_SIZE // 2):
+  """Return raw (r || s) encoding of DER ECDSA signature.
+
+  Args:
+    - signature(bytes): DER encoded signature
+    - size(int): Size of r and s in bytes (32 for P-256)
+
+  Raises:
+    - ValueError: If signature is not valid DER
+  """
+  from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+  r, s = decode_dss_signature(bytes(signature))
+  return r.to_bytes(size, 'big') + s.to_bytes(size, 'big')
+
+
+@lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def _load_public_key(pem):
+  """Parse PEM public key or x509 certificate; parsed keys are kept in a LRU cache."""
+  from cryptography import x509
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+
+  if b'-----BEGIN CERTIFICATE-----' in pem:
+    return x509.load_pem_x509_certificate(pem, default_backend()).public_key()
+  return serialization.load_pem_public_key(pem, default_backend())
+
+
+def _verify_chunk(pem, items):
+  """Verify list of (data, signature) pairs; run in process pool workers."""
+  from cryptography.exceptions import InvalidSignature
+  from cryptography.hazmat.primitives import hashes
+  from cryptography.hazmat.primitives.asymmetric import ec, padding
+
+  public_key = _load_public_key(pem)
+  if isinstance(public_key, ec.EllipticCurvePublicKey):
+    # DER encoded signatures of `sc_sign_ecdsa_p256_sha256`
+    args = (ec.ECDSA(hashes.SHA256()),)
+  else:
+    # Padding of RSA_PKCS_PSS_SHA256_MECHANISM (MGF1 with SHA256, 32 bytes of salt)
+    args = (padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=32), hashes.SHA256())
+  results = []
+  for data, signature in items:
+    if isinstance(data, str):
+      data = data.encode()
+    try:
+      public_key.verify(bytes(signature), bytes(data), *args)
+      results.append(True)
+    except InvalidSignature:
+      results.append(False)
+  return results
+
+
+def sc_verify(data, signature, pem):
+  """Verify RSASSA-PSS signature of SHA256 digested data, as created by
+  `sc_sign_rsa_pkcs_pss_sha256`, or DER encoded ECDSA signature, as created by
+  `sc_sign_ecdsa_p256_sha256`, depending on the public key.
+
+  Args:
+    - data(str | bytes): Signed data
+    - signature(bytes): Signature
+    - pem(bytes | str): Public key or x509 certificate in PEM format (e.g. returned
+      by `sc_export_pub_key_pem` or `sc_export_x509_pem`)
+
+  Returns:
+    True if signature is valid otherwise False (bool)
+
+  Raises:
+    - ValueError: If pem could not be parsed
+  """
+  if isinstance(pem, str):
+    pem = pem.encode()
+  return _verify_chunk(bytes(pem), [(data, signature)])[0]
+
+
+def sc_verify_many(items, pem, processes=None,
+                   process_pool_threshold=VERIFY_PROCESS_POOL_THRESHOLD):
+  """Verify many SHA256 signatures made with the same key (see `sc_verify`).
+  Public key is parsed once. Batches of at least `process_pool_threshold` items
+  are split into chunks verified across a process pool.
+
+  Args:
+    - items(iterable of (str | bytes, bytes)): Pairs of signed data and signature
+    - pem(bytes | str): Public key or x509 certificate in PEM format
+    - processes(int): Number of worker processes; defaults to number of CPUs
+    - process_pool_threshold(int): Minimum batch size verified in a process pool
+
+  Returns:
+    List of bools, in order of items
+
+  Raises:
+    - ValueError: If pem could not be parsed
   """
-  mechanism = RSA_PSS_Mechanism(CKM_SHA256_RSA_PKCS_PSS, CKM_SHA256, CKG_MGF1_SHA256, 32)
-  return bytes(sc_sign_rsa(data, mechanism, key_id, pin, pkcs11=pkcs11))
+  if isinstance(pem, str):
+    pem = pem.encode()
+  pem = bytes(pem)
+  items = [(data.encode() if isinstance(data, str) else bytes(data), bytes(signature))
+           for data, signature in items]
+  # Parse in the caller's process too, so invalid PEM raises before workers start
+  _load_public_key(pem)
+
+  processes = processes or os.cpu_count() or 1
+  if processes == 1 or len(items) < process_pool_threshold:
+    return _verify_chunk(pem, items)
+
+  from concurrent.futures import ProcessPoolExecutor
+
+  chunk_size = -(-len(items) // (processes * 4))
+  chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+  with ProcessPoolExecutor(max_workers=processes) as executor:
+    results = executor.map(_verify_chunk, [pem] * len(chunks), chunks)
+    return [valid for chunk_results in results for valid in chunk_results]
@@ -0,0 +1,146 @@
+"""Signing backends of `oll_sc.api`.
+
+By default API functions use the smart card through PKCS#11. Another backend
+can be set with `set_backend` or configured through environment:
+
+  OLL_SC_BACKEND=software OLL_SC_KEYS_DIR=/path/to/keys
+
+API functions decorated with `via_backend` are then forwarded to the backend
+unless `pkcs11` is passed explicitly.
+"""
+import abc
+import importlib
+import inspect
+import logging
+import os
+import threading
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ENV = 'OLL_SC_BACKEND'
+KEYS_DIR_ENV = 'OLL_SC_KEYS_DIR'
+
+PKCS11 = 'pkcs11'
+SOFTWARE = 'software'
+
+# name -> (module, class) of backends which can be selected through environment
+BACKENDS = {
+    SOFTWARE: ('oll_sc.software_backend', 'SoftwareBackend'),
+}
+
+
+class Backend(abc.ABC):
+  """Interface of signing backends. Methods take the arguments of API functions
+  of the same name (without `sc_` prefix, `token` and `pkcs11`), raise the same
+  exceptions and return the same values."""
+
+  @abc.abstractmethod
+  def is_present(self):
+    pass
+
+  @abc.abstractmethod
+  def export_pub_key_pem(self, key_id, pin):
+    pass
+
+  @abc.abstractmethod
+  def export_x509_pem(self, key_id, pin):
+    pass
+
+  @abc.abstractmethod
+  def sign_rsa(self, data, mechanism, key_id, pin):
+    pass
+
+  @abc.abstractmethod
+  def sign_rsa_pkcs_pss_sha256(self, data, key_id, pin):
+    pass
+
+  @abc.abstractmethod
+  def sign_rsa_pkcs_pss_sha256_prehash(self, data, key_id, pin, chunk_size):
+    pass
+
+  @abc.abstractmethod
+  def sign_stream(self, data, mechanism, key_id, pin, chunk_size):
+    pass
+
+  @abc.abstractmethod
+  def sign_rsa_pkcs_pss_sha256_stream(self, data, key_id, pin, chunk_size):
+    pass
+
+  @abc.abstractmethod
+  def sign_many(self, data_items, key_id, pin, mechanism):
+    pass
+
+  @abc.abstractmethod
+  def sign_ecdsa(self, data, mechanism, key_id, pin):
+    pass
+
+  @abc.abstractmethod
+  def sign_ecdsa_p256_sha256(self, data, key_id, pin, encoding, chunk_size):
+    pass
+
+
+_BACKEND = None
+_ENV_BACKENDS = {}
+_ENV_BACKENDS_LOCK = threading.Lock()
+
+
+def _backend_from_env():
+  name = os.environ.get(BACKEND_ENV, PKCS11).lower()
+  if name == PKCS11:
+    return None
+  try:
+    module_name, class_name = BACKENDS[name]
+  except KeyError:
+    raise ValueError('Unknown backend {} in {}.'.format(name, BACKEND_ENV))
+
+  key = (name, os.environ.get(KEYS_DIR_ENV))
+  with _ENV_BACKENDS_LOCK:
+    backend = _ENV_BACKENDS.get(key)
+    if backend is None:
+      backend_cls = getattr(importlib.import_module(module_name), class_name)
+      backend = _ENV_BACKENDS[key] = backend_cls.from_env()
+      logger.debug('Using %s backend.', name)
+    return backend
+
+
+def get_backend():
+  """Return backend used by API functions or None if smart card is used.
+
+  Raises:
+    - ValueError: If OLL_SC_BACKEND names unknown backend
+  """
+  if _BACKEND is not None:
+    return _BACKEND
+  return _backend_from_env()
+
+
+def set_backend(backend):
+  """Use given backend in API functions (e.g. `SoftwareBackend`); None restores
+  backend configured through environment (smart card by default)."""
+  global _BACKEND
+  _BACKEND = backend
+
+
+def via_backend(api_func):
+  """Decorator forwarding API function to configured backend's method of the
+  same name (without `sc_` prefix) unless `pkcs11` is passed."""
+  signature = inspect.signature(api_func)
+  method_name = api_func.__name__[len('sc_'):]
+
+  @wraps(api_func)
+  def wrapper(*args, **kwargs):
+    if kwargs.get('pkcs11') is not None:
+      return api_func(*args, **kwargs)
+    backend = get_backend()
+    if backend is None:
+      return api_func(*args, **kwargs)
+
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = bound.arguments
+    arguments.pop('pkcs11', None)
+    # Backends hold one set of keys, token selector does not apply to them
+    arguments.pop('token', None)
+    return getattr(backend, method_name)(**arguments)
+  return wrapper
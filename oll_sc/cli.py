@@ -1,11 +1,21 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import click
 
-from .api import (sc_export_pub_key_pem, sc_export_x509_pem, sc_is_present,
-                  sc_session, sc_sign_rsa_pkcs_pss_sha256)
-from .exceptions import SmartCardError
-from .yk_api import yk_setup
+from .api import (RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM, SIGNATURE_DER,
+                  SIGNATURE_RAW, sc_export_pub_key_pem, sc_export_x509_pem,
+                  sc_is_present, sc_session, sc_sign_ecdsa_p256_sha256,
+                  sc_sign_many, sc_sign_rsa_pkcs_pss_sha256,
+                  sc_sign_rsa_pkcs_pss_sha256_prehash,
+                  sc_sign_rsa_pkcs_pss_sha256_stream)
+from .exceptions import SmartCardAgentError, SmartCardError
+from .export_cache import enable_export_cache
+from .hashing import sha256_digest
 
 
 @click.group()
@@ -13,15 +23,39 @@ def oll_sc():
   """oll-sc tool CLI"""
 
 
+def _cache_options(command):
+  command = click.option('--no-cache', is_flag=True, default=False,
+                         help='Export from smart card without using export cache.')(command)
+  return click.option('--refresh-cache', is_flag=True, default=False,
+                      help='Drop cached exports and export from smart card again.')(command)
+
+
+def _token_option(command):
+  return click.option('--token', '-t', type=str, default=None,
+                      help='Token selector: serial:<serial>, label:<label> or '
+                           'fingerprint:<certificate SHA256>; first token by default.')(command)
+
+
+def _use_export_cache(no_cache, refresh_cache):
+  if no_cache:
+    return
+  cache = enable_export_cache()
+  if refresh_cache:
+    cache.invalidate()
+
+
 @oll_sc.command()
 @click.argument('key_id', type=int)
 @click.argument('pin')
 @click.option('--output-path', '-o', type=click.Path(), default=None,
               help='The output file path to write public key pem to.')
-def public_key(key_id, pin, output_path=None):
+@_cache_options
+@_token_option
+def public_key(key_id, pin, output_path=None, no_cache=False, refresh_cache=False, token=None):
   """Extract public key from smart card in PEM format."""
+  _use_export_cache(no_cache, refresh_cache)
   try:
-    pub_key_pem_bytes = sc_export_pub_key_pem((key_id,), pin)
+    pub_key_pem_bytes = sc_export_pub_key_pem((key_id,), pin, token=token)
     pub_key_pem = pub_key_pem_bytes.decode('utf-8')
 
     if output_path:
@@ -35,9 +69,10 @@ def public_key(key_id, pin, output_path=None):
 
 
 @oll_sc.command()
-def inserted():
+@_token_option
+def inserted(token):
   """Check if smart card is inserted."""
-  if sc_is_present():
+  if sc_is_present(token=token):
     click.echo('Smart card is inserted.')
   else:
     click.echo('Smart card is not inserted.')
@@ -45,10 +80,117 @@ def inserted():
 
 @oll_sc.command()
 @click.argument('pin')
-def check_pin(pin):
+@click.option('--socket-path', '-s', type=click.Path(), default=None,
+              help='Path of agent socket; a private temporary directory is used by default.')
+@click.option('--ttl', type=int, default=3600,
+              help='Seconds after which agent logs out and exits (0 for no limit).')
+@_token_option
+def agent(pin, socket_path, ttl, token):
+  """Run signing agent which keeps smart card session logged in.
+
+  API functions and commands forward requests to the agent while
+  OLL_SC_AUTH_SOCK is exported.
+  """
+  from .agent import AGENT_SOCK_ENV
+  from .agent_server import start_agent
+  try:
+    server = start_agent(pin, socket_path, ttl, token)
+  except SmartCardError as e:
+    click.echo(e)
+    return
+
+  click.echo('{0}={1}; export {0};'.format(AGENT_SOCK_ENV, server.server_address))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+@oll_sc.command()
+@click.option('--pin', '-p', type=str, default=None,
+              help='PIN for login; private keys are listed only if given.')
+@click.option('--values', is_flag=True, default=False,
+              help='Include DER values of certificates and public keys (hex).')
+@_token_option
+def inventory(pin, values, token):
+  """List certificates and keys on smart card as JSON."""
+  from .inventory import sc_inventory
+  try:
+    token_inventory = sc_inventory(pin, token)
+  except SmartCardError as e:
+    click.echo(e)
+    return
+  click.echo(json.dumps(token_inventory.to_dict(include_values=values), indent=2))
+
+
+def _agent_stats():
+  """Return metrics snapshot of running signing agent or None."""
+  from .agent import AgentClient, agent_socket_path
+  path = agent_socket_path()
+  if path is None:
+    return None
+  try:
+    with AgentClient(path) as client:
+      return json.loads(client.request('stats').decode())
+  except (OSError, SmartCardAgentError):
+    return None
+
+
+@oll_sc.command()
+@click.option('--pin', '-p', type=str, default=None,
+              help='Sign test data with this PIN and show its timings if agent is not running.')
+@click.option('--key-id', '-k', type=int, default=1, help='Key id used for test signatures.')
+@click.option('--count', '-n', type=int, default=10, help='Number of test signatures.')
+@click.option('--prometheus', is_flag=True, default=False,
+              help='Print metrics in Prometheus text format.')
+@_token_option
+def stats(pin, key_id, count, prometheus, token):
+  """Show timings of PKCS#11 phases (library load, session, login, object
+  lookup, context login and signing).
+
+  Metrics of running signing agent are shown; otherwise test data is signed
+  COUNT times with given PIN.
+  """
+  from .metrics import (PHASES, disable_metrics, enable_metrics,
+                        prometheus_text, quantile)
+  snapshot = _agent_stats()
+  if snapshot is None:
+    if pin is None:
+      click.echo('Signing agent is not running; pass --pin to measure signing.')
+      return
+    metrics = enable_metrics()
+    try:
+      for _ in range(count):
+        sc_sign_rsa_pkcs_pss_sha256(b'oll-sc stats', (key_id,), pin, token=token)
+    except SmartCardError as e:
+      click.echo(e)
+    finally:
+      disable_metrics()
+    snapshot = metrics.snapshot()
+
+  if prometheus:
+    click.echo(prometheus_text(snapshot), nl=False)
+    return
+
+  click.echo('{:<14} {:>7} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+      'phase', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms', 'errors'))
+  for phase in sorted(snapshot, key=lambda p: PHASES.index(p) if p in PHASES else len(PHASES)):
+    data = snapshot[phase]
+    errors = ', '.join('{}={}'.format(name, n) for name, n in sorted(data['errors'].items()))
+    click.echo('{:<14} {:>7} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}  {}'.format(
+        phase, data['count'], data['sum'] / data['count'] * 1000,
+        quantile(data, 0.5) * 1000, quantile(data, 0.99) * 1000, data['max'] * 1000, errors))
+
+
+@oll_sc.command()
+@click.argument('pin')
+@_token_option
+def check_pin(pin, token):
   """Check smart card PIN."""
   try:
-    with sc_session(pin) as _:
+    with sc_session(pin, token=token) as _:
       click.echo('PIN OK.')
   except SmartCardError as e:
     click.echo(e)
@@ -63,21 +205,66 @@ def check_pin(pin):
               help='Data to sign.')
 @click.option('--output-path', '-o', type=click.Path(), default=None,
               help='Path of a file to write signature to.')
-def sign_rsa_pkcs_pss_sha256(key_id, pin, input_path, input_data, output_path):
+@click.option('--prehash', is_flag=True, default=False,
+              help='Hash input locally and send only SHA256 digest to smart card.')
+@_token_option
+def sign_rsa_pkcs_pss_sha256(key_id, pin, input_path, input_data, output_path, prehash, token):
   """Sign input using SHA256_RSA_PKCS_PSS mechanism."""
   # Input path overrides input data
   if input_path is not None:
     input_path = Path(input_path)
     if input_path.is_file():
-      input_data = input_path.read_bytes()
+      # File is read in chunks while hashing or signing
+      input_data = input_path
 
   if input_data is None:
     click.echo('\nError: Missing option "--input-data" or "--input-path".')
     return
 
   try:
-    signature = sc_sign_rsa_pkcs_pss_sha256(input_data, (key_id,), pin)
+    if prehash:
+      signature = sc_sign_rsa_pkcs_pss_sha256_prehash(input_data, (key_id,), pin, token=token)
+    elif isinstance(input_data, Path):
+      signature = sc_sign_rsa_pkcs_pss_sha256_stream(input_data, (key_id,), pin, token=token)
+    else:
+      signature = sc_sign_rsa_pkcs_pss_sha256(input_data, (key_id,), pin, token=token)
+
+    if output_path:
+      with open(output_path, 'wb') as out:
+        out.write(signature)
+    else:
+      click.echo(signature)
+
+  except SmartCardError as e:
+    click.echo(e)
+
+
+@oll_sc.command()
+@click.argument('key_id', type=int)
+@click.argument('pin')
+@click.option('--input-path', '-i', type=click.Path(), default=None,
+              help='Path of a file to sign.')
+@click.option('--input-data', '-d', type=str, default=None,
+              help='Data to sign.')
+@click.option('--output-path', '-o', type=click.Path(), default=None,
+              help='Path of a file to write signature to.')
+@click.option('--raw', is_flag=True, default=False,
+              help='Write signature as r || s (64 bytes) instead of DER.')
+@_token_option
+def sign_ecdsa_p256_sha256(key_id, pin, input_path, input_data, output_path, raw, token):
+  """Sign SHA256 digest of input with ECDSA P-256 key."""
+  # Input path overrides input data; file is read in chunks while hashing
+  if input_path is not None and Path(input_path).is_file():
+    input_data = Path(input_path)
+
+  if input_data is None:
+    click.echo('\nError: Missing option "--input-data" or "--input-path".')
+    return
 
+  try:
+    signature = sc_sign_ecdsa_p256_sha256(input_data, (key_id,), pin,
+                                          encoding=SIGNATURE_RAW if raw else SIGNATURE_DER,
+                                          token=token)
     if output_path:
       with open(output_path, 'wb') as out:
         out.write(signature)
@@ -88,15 +275,129 @@ def sign_rsa_pkcs_pss_sha256(key_id, pin, input_path, input_data, output_path):
     click.echo(e)
 
 
+def _batch_input_paths(inputs, manifest):
+  """Resolve directories, files, glob patterns and manifest entries to a list of
+  files to sign."""
+  patterns = list(inputs)
+  if manifest is not None:
+    manifest = Path(manifest)
+    for line in manifest.read_text().splitlines():
+      line = line.strip()
+      if line and not line.startswith('#'):
+        patterns.append(str(manifest.parent / line))
+
+  paths = []
+  for pattern in patterns:
+    path = Path(pattern)
+    if path.is_dir():
+      paths.extend(sorted(p for p in path.rglob('*') if p.is_file() and p.suffix != '.sig'))
+    elif path.is_file():
+      paths.append(path)
+    else:
+      paths.extend(sorted(Path(p) for p in glob.glob(pattern, recursive=True)
+                          if Path(p).is_file() and not p.endswith('.sig')))
+
+  # Drop duplicates, keep order
+  return list(dict.fromkeys(paths))
+
+
+def _hash_file(path):
+  """Return (SHA256 digest, size) of file or OSError if it could not be read."""
+  try:
+    return sha256_digest(path), path.stat().st_size
+  except OSError as e:
+    return e
+
+
+@oll_sc.command()
+@click.argument('key_id', type=int)
+@click.argument('pin')
+@click.argument('inputs', nargs=-1)
+@click.option('--manifest', '-m', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='File with paths or glob patterns to sign, one per line.')
+@click.option('--output-json', '-j', type=click.Path(), default=None,
+              help='Write all signatures to this JSON file instead of <file>.sig files.')
+@click.option('--workers', '-w', type=int, default=None,
+              help='Number of threads used to hash files.')
+@_token_option
+def sign_batch(key_id, pin, inputs, manifest, output_json, workers, token):
+  """Sign files using SHA256_RSA_PKCS_PSS mechanism in one smart card session.
+
+  INPUTS are directories, files or glob patterns. Files are hashed in parallel
+  and only digests are sent to smart card.
+  """
+  paths = _batch_input_paths(inputs, manifest)
+  if not paths:
+    click.echo('\nError: No files to sign.')
+    return
+
+  start = time.perf_counter()
+  results = []
+  failed = 0
+  total_bytes = 0
+  try:
+    with ThreadPoolExecutor(workers) as executor:
+      hashed_files = list(executor.map(_hash_file, paths))
+    hashed = time.perf_counter()
+    # Unreadable files are reported below and not signed
+    digests = [hashed_file[0] for hashed_file in hashed_files
+               if not isinstance(hashed_file, OSError)]
+    signatures = iter(sc_sign_many(digests, (key_id,), pin,
+                                   mechanism=RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM,
+                                   token=token) if digests else ())
+
+    for index, (path, hashed_file) in enumerate(zip(paths, hashed_files), 1):
+      result = {'path': str(path)}
+      if isinstance(hashed_file, OSError):
+        failed += 1
+        result['error'] = str(hashed_file)
+      else:
+        digest, size = hashed_file
+        signature = next(signatures)
+        total_bytes += size
+        result['sha256'] = digest.hex()
+        if isinstance(signature, SmartCardError):
+          failed += 1
+          result['error'] = str(signature)
+        elif output_json:
+          result['signature'] = signature.hex()
+        else:
+          try:
+            path.with_name(path.name + '.sig').write_bytes(signature)
+          except OSError as e:
+            failed += 1
+            result['error'] = str(e)
+      results.append(result)
+      click.echo('\r[{}/{}] {}'.format(index, len(paths), path), err=True, nl=False)
+  except SmartCardError as e:
+    click.echo(e)
+    return
+
+  if output_json:
+    with open(output_json, 'w') as out:
+      json.dump(results, out, indent=2)
+
+  elapsed = time.perf_counter() - start
+  signed = len(paths) - failed
+  click.echo('', err=True)
+  click.echo('Signed {} files ({:.1f} MB), {} failed in {:.2f}s (hashing {:.2f}s): '
+             '{:.1f} files/s, {:.1f} MB/s'
+             .format(signed, total_bytes / 1e6, failed, elapsed, hashed - start,
+                     len(paths) / elapsed, total_bytes / 1e6 / elapsed), err=True)
+
+
 @oll_sc.command()
 @click.argument('key_id', type=int)
 @click.argument('pin')
 @click.option('--output-path', '-o', type=click.Path(), default=None,
               help='The output file path to write public key pem to.')
-def x509(key_id, pin, output_path=None):
+@_cache_options
+@_token_option
+def x509(key_id, pin, output_path=None, no_cache=False, refresh_cache=False, token=None):
   """Extract x509 certificate from smart card in PEM format."""
+  _use_export_cache(no_cache, refresh_cache)
   try:
-    x509_cert_bytes = sc_export_x509_pem((key_id,), pin)
+    x509_cert_bytes = sc_export_x509_pem((key_id,), pin, token=token)
     x509_cert = x509_cert_bytes.decode('utf-8')
 
     if output_path:
@@ -114,10 +415,48 @@ def x509(key_id, pin, output_path=None):
 @click.option('--cert-cn', type=str, required=True, help='Certificate common name (CN)')
 @click.option('--cert-exp-days', type=int, default=365, help='Certificate expiration in days')
 @click.option('--pin-retries', type=int, default=10, help='Number of pin and puk retries')
-def yubikey_setup(pin, cert_cn, cert_exp_days, pin_retries):
+@click.option('--all', 'all_devices', is_flag=True, default=False,
+              help='Setup all inserted Yubikeys concurrently.')
+@click.option('--report', '-r', type=click.Path(), default=None,
+              help='Write JSON report of every device (with --all).')
+@click.option('--key-type', type=click.Choice(['rsa2048', 'eccp256']), default='rsa2048',
+              help='Type of generated key; eccp256 keys sign faster.')
+def yubikey_setup(pin, cert_cn, cert_exp_days, pin_retries, all_devices, report, key_type):
   try:
-    pub_key_pem = yk_setup(pin, cert_cn, cert_exp_days, pin_retries)
+    if all_devices:
+      _yubikey_setup_all(pin, cert_cn, cert_exp_days, pin_retries, report, key_type)
+      return
+    from .yk_api import generate_random_management_key, yk_setup
+    mgm_key = generate_random_management_key()
+    pub_key_pem = yk_setup(pin, cert_cn, cert_exp_days, pin_retries, mgm_key=mgm_key,
+                           key_type=key_type)
     click.echo('Yubikey is setup.')
+    click.echo('Management key: {}'.format(mgm_key.hex()))
     click.echo('Public key:\n\n{}'.format(pub_key_pem))
   except Exception as e:
     click.echo(e)
+
+
+def _yubikey_setup_all(pin, cert_cn, cert_exp_days, pin_retries, report, key_type):
+  from .yk_api import yk_setup_all
+  reports = yk_setup_all(pin, cert_cn, cert_exp_days, pin_retries, key_type=key_type)
+  if not reports:
+    click.echo('No Yubikey is inserted.')
+    return
+
+  for device in reports:
+    status = 'setup' if device.error is None else 'failed: {}'.format(device.error)
+    click.echo('Yubikey {} {} ({:.1f}s)'.format(device.serial, status, device.elapsed))
+  if report is not None:
+    entries = []
+    for device in reports:
+      entry = device._asdict()
+      if device.pub_key_pem is not None:
+        entry['pub_key_pem'] = device.pub_key_pem.decode()
+        entry['mgm_key'] = device.mgm_key.hex()
+      entries.append(entry)
+    # Report holds management keys, so only the owner can read it
+    fd = os.open(report, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as report_file:
+      json.dump(entries, report_file, indent=2)
+    click.echo('Report written to {}'.format(report))
@@ -1,3 +1,6 @@
+from .hashing import data_summary
+
+
 class PlatformNotSupported(Exception):
   pass
 
@@ -21,5 +24,45 @@ class SmartCardNotPresentError(SmartCardError):
 
 
 class SmartCardSigningError(SmartCardError):
-  def __init__(self, data):
-    super().__init__('Unable to create signature for data:\n{}\n'.format(data))
+  """Signing failed. Message carries size and SHA256 digest of data instead of
+  the data, so large payloads are neither copied nor formatted."""
+
+  def __init__(self, data=b'', size=None, digest=None):
+    """
+    Args:
+      - data(str | bytes-like): Data which could not be signed
+      - size(int), digest(str): Size and SHA256 (hex) of data, if data was
+        streamed and is not in memory
+    """
+    if size is None:
+      try:
+        size, digest = data_summary(data)
+      except TypeError:
+        pass  # Not bytes-like, e.g. invalid item of a batch
+    self.size = size
+    self.digest = digest
+    if size is None:
+      message = 'Unable to create signature for data of type {}.'.format(type(data).__name__)
+    else:
+      message = 'Unable to create signature for data of {} bytes (SHA256 {}).'.format(size, digest)
+    super().__init__(message)
+
+
+class SmartCardPinLockedError(SmartCardWrongPinError):
+  pass
+
+
+class SmartCardTransientError(SmartCardError):
+  """Temporary token failure (e.g. CKR_DEVICE_ERROR); operation can be retried."""
+
+
+class SmartCardCircuitOpenError(SmartCardError):
+  """Token failed repeatedly; calls fail fast until it recovers."""
+
+
+class SmartCardQueueFullError(SmartCardError):
+  """Signing queue (or caller's share of it) is full; request was rejected."""
+
+
+class SmartCardAgentError(SmartCardError):
+  """Connection to the signing agent failed or its response was malformed."""
@@ -0,0 +1,241 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = 'OLL_SC_CACHE_DIR'
+
+PUBLIC_KEY = 'public_key'
+X509 = 'x509'
+
+
+def default_cache_dir():
+  """Return export cache directory (`$OLL_SC_CACHE_DIR` or user's cache directory)."""
+  cache_dir = os.environ.get(CACHE_DIR_ENV)
+  if cache_dir:
+    return Path(cache_dir)
+  base = os.environ.get('XDG_CACHE_HOME') or str(Path.home() / '.cache')
+  return Path(base) / 'oll-sc' / 'exports'
+
+
+def _pem_der(pem):
+  """Return DER encoded in PEM (bytes) or None if PEM is malformed."""
+  lines = pem.strip().splitlines()
+  if len(lines) < 3 or not lines[0].startswith(b'-----BEGIN') or \
+     not lines[-1].startswith(b'-----END'):
+    return None
+  try:
+    return base64.b64decode(b''.join(lines[1:-1]), validate=True)
+  except (binascii.Error, ValueError):
+    return None
+
+
+def _token_info(pkcs11, slot=None):
+  """Return (slot, serial, label) of token in the slot (first slot if None) or None."""
+  if slot is None:
+    slots = pkcs11.getSlotList(tokenPresent=True)
+    if not slots:
+      return None
+    slot = slots[0]
+  info = pkcs11.getTokenInfo(slot)
+  return slot, info.serialNumber.strip(), info.label.strip()
+
+
+def _public_value_sha256(pkcs11, slot, key_id, kind):
+  """Return SHA256 (hex) of public value of exported object (CKA_VALUE, or
+  CKA_EC_POINT of EC public keys without CKA_VALUE) read in a session without
+  login, or None if object cannot be read."""
+  from PyKCS11 import (CKA_CLASS, CKA_EC_POINT, CKA_ID, CKA_VALUE, CKF_SERIAL_SESSION,
+                       CKO_CERTIFICATE, CKO_PUBLIC_KEY, PyKCS11Error)
+
+  if kind == X509:
+    obj_class, attributes = CKO_CERTIFICATE, [CKA_VALUE]
+  else:
+    obj_class, attributes = CKO_PUBLIC_KEY, [CKA_VALUE, CKA_EC_POINT]
+  try:
+    session = pkcs11.openSession(slot, CKF_SERIAL_SESSION)
+  except PyKCS11Error:
+    return None
+  try:
+    handles = session.findObjects([(CKA_ID, key_id), (CKA_CLASS, obj_class)])
+    if not handles:
+      return None
+    value = next((value for value in session.getAttributeValue(handles[0], attributes)
+                  if value), None)
+  except PyKCS11Error:
+    return None
+  finally:
+    session.closeSession()
+  return hashlib.sha256(bytes(value)).hexdigest() if value else None
+
+
+class ExportCache:
+  """On-disk cache of exported public keys and x509 certificates.
+
+  Entries are stored per token serial, key id and kind of exported object, with
+  token label, SHA256 of exported PEM, of DER value it encodes and of public
+  value of the object on the token. Entry is used only if serial and label of
+  inserted token match, both digests match, and public value read from the token
+  without login is unchanged (e.g. key was not regenerated by another tool).
+  Entries are also kept in memory, so repeated exports in one process do not
+  touch the disk.
+
+  PIN is not verified when a cached entry is used, so exports with a wrong PIN
+  succeed on a cache hit.
+  """
+
+  def __init__(self, directory=None):
+    """
+    Args:
+      - directory(str | pathlib.Path): Cache directory; `default_cache_dir()` if None
+    """
+    self.directory = Path(directory) if directory is not None else default_cache_dir()
+    self._memory = {}
+    self._lock = threading.Lock()
+
+  def _path(self, serial, key_id, kind):
+    name = '{}:{}:{}'.format(serial, bytes(key_id).hex(), kind)
+    return self.directory / (hashlib.sha256(name.encode()).hexdigest() + '.json')
+
+  def get(self, pkcs11, key_id, kind, slot=None):
+    """Return cached PEM (bytes) for inserted token or None.
+
+    Args:
+      - pkcs11(PyKCS11): PyKCS11Lib instance used to read token info
+      - key_id(tuple): Key ID as tuple (e.g. (1,))
+      - kind(str): PUBLIC_KEY or X509
+      - slot(int): Slot of the token; first slot with token present if None
+    """
+    token = _token_info(pkcs11, slot)
+    if token is None:
+      return None
+    slot, serial, label = token
+    path = self._path(serial, key_id, kind)
+
+    with self._lock:
+      entry = self._memory.get(path)
+    if entry is None:
+      try:
+        entry = json.loads(path.read_text())
+      except (OSError, ValueError):
+        return None
+
+    if entry.get('serial') != serial or entry.get('label') != label:
+      return None
+    pem = entry.get('pem', '').encode()
+    der = _pem_der(pem)
+    if hashlib.sha256(pem).hexdigest() != entry.get('pem_sha256') or der is None or \
+       hashlib.sha256(der).hexdigest() != entry.get('value_sha256'):
+      logger.warning('Cached %s for key id %s is corrupted, ignoring it.', kind, key_id)
+      return None
+    if entry.get('public_sha256') != _public_value_sha256(pkcs11, slot, key_id, kind):
+      logger.debug('Cached %s for key id %s does not match the token.', kind, key_id)
+      return None
+
+    with self._lock:
+      self._memory[path] = entry
+    logger.debug('Using cached %s for key id %s', kind, key_id)
+    return pem
+
+  def put(self, pkcs11, key_id, kind, value_der, pem, slot=None):
+    """Store exported PEM of inserted token.
+
+    Args:
+      - pkcs11(PyKCS11): PyKCS11Lib instance used to read token info
+      - key_id(tuple): Key ID as tuple (e.g. (1,))
+      - kind(str): PUBLIC_KEY or X509
+      - value_der(bytes): DER encoded in exported PEM (e.g. CKA_VALUE of x509
+        certificate)
+      - pem(bytes): Exported PEM
+      - slot(int): Slot of the token; first slot with token present if None
+    """
+    token = _token_info(pkcs11, slot)
+    if token is None:
+      return
+    slot, serial, label = token
+    public_sha256 = _public_value_sha256(pkcs11, slot, key_id, kind)
+    if public_sha256 is None:
+      # Entry could not be checked against the token, so it is never used
+      logger.debug('%s for key id %s is not readable without login, not cached.', kind, key_id)
+      return
+    path = self._path(serial, key_id, kind)
+    entry = {
+        'serial': serial,
+        'label': label,
+        'key_id': list(key_id),
+        'kind': kind,
+        'value_sha256': hashlib.sha256(bytes(value_der)).hexdigest(),
+        'pem_sha256': hashlib.sha256(pem).hexdigest(),
+        'public_sha256': public_sha256,
+        'pem': pem.decode(),
+    }
+    with self._lock:
+      self._memory[path] = entry
+
+    try:
+      self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+      # Write to temporary file and rename, so readers never see partial entry
+      fd, tmp_path = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+      with os.fdopen(fd, 'w') as tmp:
+        json.dump(entry, tmp)
+      os.replace(tmp_path, str(path))
+    except OSError as e:
+      logger.warning('Could not write export cache entry: %s', e)
+
+  def invalidate(self):
+    """Remove all cached exports."""
+    with self._lock:
+      self._memory.clear()
+    for path in self.directory.glob('*.json'):
+      try:
+        path.unlink()
+      except OSError:
+        pass
+    logger.debug('Export cache %s invalidated.', self.directory)
+
+
+_EXPORT_CACHE = None
+
+
+def get_export_cache():
+  """Return export cache used by `oll_sc.api` export functions or None if disabled."""
+  return _EXPORT_CACHE
+
+
+def enable_export_cache(directory=None):
+  """Make `oll_sc.api` export functions return cached public keys and x509
+  certificates without logging in to the smart card. PIN is not verified when
+  cached export is returned.
+
+  Args:
+    - directory(str | pathlib.Path): Cache directory; `default_cache_dir()` if None
+
+  Returns:
+    ExportCache instance
+  """
+  global _EXPORT_CACHE
+  _EXPORT_CACHE = ExportCache(directory)
+  return _EXPORT_CACHE
+
+
+def disable_export_cache():
+  """Export public objects from smart card on every call again."""
+  global _EXPORT_CACHE
+  _EXPORT_CACHE = None
+
+
+def invalidate_export_cache():
+  """Remove cached exports from enabled and default cache directory (e.g. after
+  key was regenerated)."""
+  caches = [ExportCache()]
+  if _EXPORT_CACHE is not None:
+    caches.append(_EXPORT_CACHE)
+  for cache in caches:
+    cache.invalidate()
@@ -0,0 +1,97 @@
+import hashlib
+import mmap
+from pathlib import PurePath
+
+# Size of chunks in which files are read and hashed
+CHUNK_SIZE = 1024 * 1024
+
+
+def _read_chunks(file_object, chunk_size):
+  readinto = getattr(file_object, 'readinto', None)
+  if readinto is None:
+    for chunk in iter(lambda: file_object.read(chunk_size), b''):
+      yield chunk.encode() if isinstance(chunk, str) else chunk
+    return
+
+  # Read into one reusable buffer instead of allocating bytes for every chunk
+  buffer = bytearray(chunk_size)
+  view = memoryview(buffer)
+  size = readinto(buffer)
+  while size:
+    yield view[:size]
+    size = readinto(buffer)
+
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+  """Yield data in chunks without reading whole files into memory.
+
+  Args:
+    - source(str | bytes-like | mmap | pathlib.Path | file object): Data, path of
+      a file or binary file object. `str` is treated as data and encoded.
+    - chunk_size(int): Maximum size of yielded chunks
+
+  Returns:
+    Generator of bytes-like chunks. A chunk is only valid until next one is
+    yielded.
+  """
+  if isinstance(source, str):
+    source = source.encode()
+
+  if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+    # Slices of memoryview (also of mmap) are not copies
+    view = memoryview(source).cast('B')
+    for start in range(0, len(view), chunk_size):
+      yield view[start:start + chunk_size]
+  elif isinstance(source, PurePath):
+    with open(str(source), 'rb') as file_object:
+      yield from _read_chunks(file_object, chunk_size)
+  else:
+    yield from _read_chunks(source, chunk_size)
+
+
+def data_summary(data):
+  """Return size and SHA256 (hex) of in-memory data, logged and reported in
+  errors instead of the data.
+
+  Args:
+    - data(str | bytes-like | mmap | list of ints): Data
+
+  Returns:
+    Tuple (size in bytes (int), SHA256 digest (hex str))
+
+  Raises:
+    - TypeError: If data is not bytes-like
+  """
+  if isinstance(data, str):
+    data = data.encode()
+  elif isinstance(data, (list, tuple)):
+    # PyKCS11 also accepts data as list of byte values
+    data = bytes(data)
+  view = memoryview(data).cast('B')
+  return view.nbytes, hashlib.sha256(view).hexdigest()
+
+
+def sha256_digest(source, chunk_size=CHUNK_SIZE):
+  """Return SHA256 digest of data, file at given path or file object.
+
+  Args:
+    - source(str | bytes-like | mmap | pathlib.Path | file object): Data to be hashed
+    - chunk_size(int): Size of chunks in which files are read
+
+  Returns:
+    SHA256 digest (bytes)
+  """
+  if isinstance(source, PurePath):
+    with open(str(source), 'rb') as file_object:
+      try:
+        # Whole file is hashed in one call without holding the GIL
+        with mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+          return hashlib.sha256(mapped).digest()
+      except (OSError, ValueError):
+        # Empty files and some special files cannot be mapped
+        return sha256_digest(file_object, chunk_size)
+
+  digest = hashlib.sha256()
+  for chunk in iter_chunks(source, chunk_size):
+    digest.update(chunk)
+  return digest.digest()
@@ -0,0 +1,179 @@
+import hashlib
+import logging
+from collections import namedtuple
+from contextlib import contextmanager
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from PyKCS11 import (CKA_ALWAYS_AUTHENTICATE, CKA_CLASS, CKA_ID, CKA_KEY_TYPE,
+                     CKA_LABEL, CKA_MODULUS_BITS, CKA_VALUE, CKF_SERIAL_SESSION,
+                     CKK_EC, CKK_RSA, CKO_CERTIFICATE, CKO_PRIVATE_KEY,
+                     CKO_PUBLIC_KEY, PyKCS11Error)
+
+from . import init_pkcs11
+from .api import sc_session
+from .slot_resolver import resolve_slot
+from .exceptions import SmartCardError
+from .retry import classify_error
+
+logger = logging.getLogger(__name__)
+
+CERTIFICATE = 'certificate'
+PUBLIC_KEY = 'public_key'
+PRIVATE_KEY = 'private_key'
+
+# Object kind -> (object class, attributes read in one call per object)
+_OBJECT_CLASSES = (
+    (CERTIFICATE, CKO_CERTIFICATE, [CKA_ID, CKA_LABEL, CKA_VALUE]),
+    (PUBLIC_KEY, CKO_PUBLIC_KEY, [CKA_ID, CKA_LABEL, CKA_VALUE, CKA_KEY_TYPE, CKA_MODULUS_BITS]),
+    (PRIVATE_KEY, CKO_PRIVATE_KEY, [CKA_ID, CKA_LABEL, CKA_KEY_TYPE, CKA_MODULUS_BITS,
+                                    CKA_ALWAYS_AUTHENTICATE]),
+)
+
+_KEY_TYPES = {CKK_RSA: 'RSA', CKK_EC: 'EC'}
+
+KeyObject = namedtuple('KeyObject', [
+    'kind',  # CERTIFICATE, PUBLIC_KEY or PRIVATE_KEY
+    'key_id',  # tuple
+    'label',  # str
+    'key_type',  # 'RSA', 'EC' or None
+    'modulus_bits',  # int or None
+    'always_authenticate',  # bool or None
+    'fingerprint',  # SHA256 of SubjectPublicKeyInfo DER (hex) or None
+    'value',  # CKA_VALUE DER (bytes) or None for private keys
+])
+
+
+def _spki_fingerprint(kind, value):
+  """Return SHA256 fingerprint (hex) of public key in certificate or public key DER."""
+  try:
+    if kind == CERTIFICATE:
+      public_key = x509.load_der_x509_certificate(value, default_backend()).public_key()
+    else:
+      public_key = serialization.load_der_public_key(value, default_backend())
+  except ValueError:
+    return None
+  spki = public_key.public_bytes(serialization.Encoding.DER,
+                                 serialization.PublicFormat.SubjectPublicKeyInfo)
+  return hashlib.sha256(spki).hexdigest()
+
+
+class TokenInventory:
+  """Key objects of a token, indexed by key id and public key fingerprint.
+
+  Usage:
+    inventory[(1,)]  # objects with key id (1,)
+    inventory.by_fingerprint(fingerprint)
+  """
+
+  def __init__(self, serial, label, objects):
+    self.serial = serial
+    self.label = label
+    self.objects = tuple(objects)
+    self._by_key_id = {}
+    self._by_fingerprint = {}
+    for obj in self.objects:
+      self._by_key_id.setdefault(obj.key_id, []).append(obj)
+      if obj.fingerprint:
+        self._by_fingerprint.setdefault(obj.fingerprint, []).append(obj)
+
+  def __getitem__(self, key_id):
+    return list(self._by_key_id.get(tuple(key_id), ()))
+
+  def __iter__(self):
+    return iter(self.objects)
+
+  def __len__(self):
+    return len(self.objects)
+
+  def by_fingerprint(self, fingerprint):
+    """Return objects of the key with given SHA256 fingerprint (hex)."""
+    return list(self._by_fingerprint.get(fingerprint.lower(), ()))
+
+  def of_kind(self, kind):
+    """Return objects of given kind (CERTIFICATE, PUBLIC_KEY or PRIVATE_KEY)."""
+    return [obj for obj in self.objects if obj.kind == kind]
+
+  def to_dict(self, include_values=False):
+    """Return JSON serializable representation."""
+    objects = []
+    for obj in self.objects:
+      entry = obj._asdict()
+      entry['key_id'] = list(obj.key_id)
+      value = entry.pop('value')
+      if include_values and value is not None:
+        entry['value'] = value.hex()
+      objects.append(entry)
+    return {'serial': self.serial, 'label': self.label, 'objects': objects}
+
+
+@contextmanager
+def _public_session(pkcs11, token=None):
+  """Open session without login; only public objects are visible."""
+  try:
+    session = pkcs11.openSession(resolve_slot(pkcs11, token), CKF_SERIAL_SESSION)
+  except PyKCS11Error as e:
+    raise classify_error(e)
+  try:
+    yield session
+  finally:
+    session.closeSession()
+
+
+def _read_objects(session):
+  objects = []
+  for kind, obj_class, attributes in _OBJECT_CLASSES:
+    for handle in session.findObjects([(CKA_CLASS, obj_class)]):
+      values = dict(zip(attributes, session.getAttributeValue(handle, attributes)))
+      value = values.get(CKA_VALUE)
+      value = bytes(value) if value is not None else None
+      objects.append(KeyObject(
+          kind=kind,
+          key_id=tuple(values[CKA_ID] or ()),
+          label=values[CKA_LABEL],
+          key_type=_KEY_TYPES.get(values.get(CKA_KEY_TYPE)),
+          modulus_bits=values.get(CKA_MODULUS_BITS),
+          always_authenticate=values.get(CKA_ALWAYS_AUTHENTICATE),
+          fingerprint=_spki_fingerprint(kind, value) if value else None,
+          value=value,
+      ))
+
+  # Private keys have no public value; use fingerprint of matching public object
+  fingerprints = {obj.key_id: obj.fingerprint for obj in objects if obj.fingerprint}
+  return [obj._replace(fingerprint=fingerprints.get(obj.key_id))
+          if obj.kind == PRIVATE_KEY else obj for obj in objects]
+
+
+@init_pkcs11
+def sc_inventory(pin=None, token=None, pkcs11=None):
+  """List certificates, public and private keys of inserted smart card in one
+  session. All attributes of an object are read in one call.
+
+  Args:
+    - pin(str): Pin for session login; private keys are listed only if given
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    TokenInventory instance
+
+  Raises:
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardError: If token objects could not be read
+  """
+  session_context = sc_session(pin, token=token, pkcs11=pkcs11) if pin is not None else \
+      _public_session(pkcs11, token)
+  with session_context as session:
+    try:
+      token_info = pkcs11.getTokenInfo(session.getSessionInfo().slotID)
+    except PyKCS11Error as e:
+      raise classify_error(e)
+    try:
+      objects = _read_objects(session)
+    except PyKCS11Error as e:
+      raise SmartCardError('Could not read token objects: {}'.format(e))
+
+  return TokenInventory(token_info.serialNumber.strip(), token_info.label.strip(), objects)
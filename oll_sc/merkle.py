@@ -0,0 +1,206 @@
+"""Signing many documents with one token signature.
+
+Documents are hashed locally into leaves of a SHA256 Merkle tree and only the
+root is signed on the token. Every document gets a proof of inclusion, which
+together with the root signature verifies the document.
+
+Leaves and inner nodes are hashed with different prefixes (as in RFC 6962), so
+an inner node cannot be presented as a document. A node without a sibling is
+moved up to the next level unchanged.
+"""
+import hashlib
+import os
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .api import sc_sign_rsa_pkcs_pss_sha256, sc_verify
+from .hashing import CHUNK_SIZE, sha256_digest
+
+_LEAF_PREFIX = b'\x00'
+_NODE_PREFIX = b'\x01'
+# Signed message is prefixed, so root signature is not valid for a document
+ROOT_PREFIX = b'oll-sc-merkle-root-v1:'
+
+_PROOF_HEADER = struct.Struct('>II')
+_HASH_SIZE = 32
+
+
+class MerkleProof(namedtuple('MerkleProof', ['index', 'leaf_count', 'path'])):
+  """Proof of inclusion of a document: its leaf index, number of leaves and
+  sibling hashes from the leaf up to the root."""
+  __slots__ = ()
+
+  def to_bytes(self):
+    """Return compact encoding: index and leaf count (4 bytes each) followed by
+    sibling hashes."""
+    return _PROOF_HEADER.pack(self.index, self.leaf_count) + b''.join(self.path)
+
+  @classmethod
+  def from_bytes(cls, data):
+    """Decode proof encoded by `to_bytes`.
+
+    Raises:
+      - ValueError: If data is not a valid encoded proof
+    """
+    data = bytes(data)
+    if len(data) < _PROOF_HEADER.size or (len(data) - _PROOF_HEADER.size) % _HASH_SIZE:
+      raise ValueError('Invalid Merkle proof.')
+    index, leaf_count = _PROOF_HEADER.unpack_from(data)
+    path = [data[start:start + _HASH_SIZE]
+            for start in range(_PROOF_HEADER.size, len(data), _HASH_SIZE)]
+    return cls(index, leaf_count, path)
+
+
+MerkleSignature = namedtuple('MerkleSignature', ['root', 'signature', 'proofs'])
+
+
+def leaf_hash(document, chunk_size=CHUNK_SIZE):
+  """Return Merkle tree leaf of a document.
+
+  Args:
+    - document(str | bytes-like | pathlib.Path | file object): Data, path of a
+      file or binary file object
+    - chunk_size(int): Size of chunks in which files are read and hashed
+  """
+  return hashlib.sha256(_LEAF_PREFIX + sha256_digest(document, chunk_size)).digest()
+
+
+def _node_hash(left, right):
+  return hashlib.sha256(_NODE_PREFIX + left + right).digest()
+
+
+def _leaf_hashes(documents, workers, chunk_size):
+  workers = workers or os.cpu_count() or 1
+  if workers == 1 or len(documents) < 2:
+    return [leaf_hash(document, chunk_size) for document in documents]
+
+  # hashlib releases the GIL while hashing, so documents are hashed in threads.
+  # Documents are split into batches to avoid one future per document.
+  batch_size = -(-len(documents) // (workers * 4))
+  batches = [documents[i:i + batch_size] for i in range(0, len(documents), batch_size)]
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    results = executor.map(lambda batch: [leaf_hash(document, chunk_size) for document in batch],
+                           batches)
+    return [leaf for batch in results for leaf in batch]
+
+
+def merkle_tree(leaves):
+  """Return levels of Merkle tree, from leaves up to the root level.
+
+  Args:
+    - leaves(list of bytes): Leaf hashes
+
+  Returns:
+    List of levels (lists of bytes); last level holds only the root
+
+  Raises:
+    - ValueError: If there are no leaves
+  """
+  if not leaves:
+    raise ValueError('Merkle tree needs at least one leaf.')
+  levels = [list(leaves)]
+  while len(levels[-1]) > 1:
+    level = levels[-1]
+    parents = [_node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+      parents.append(level[-1])
+    levels.append(parents)
+  return levels
+
+
+def merkle_proof(levels, index):
+  """Return MerkleProof of leaf at index of tree returned by `merkle_tree`."""
+  path = []
+  position = index
+  for level in levels[:-1]:
+    sibling = position ^ 1
+    if sibling < len(level):
+      path.append(level[sibling])
+    position //= 2
+  return MerkleProof(index, len(levels[0]), path)
+
+
+def merkle_root_from_proof(leaf, proof):
+  """Return root computed from leaf and its proof of inclusion.
+
+  Raises:
+    - ValueError: If proof does not match its leaf count
+  """
+  index, size = proof.index, proof.leaf_count
+  if not 0 <= index < size:
+    raise ValueError('Invalid Merkle proof.')
+  node = leaf
+  path = iter(proof.path)
+  try:
+    while size > 1:
+      if index % 2:
+        node = _node_hash(next(path), node)
+      elif index + 1 < size:
+        node = _node_hash(node, next(path))
+      index //= 2
+      size = (size + 1) // 2
+  except StopIteration:
+    raise ValueError('Invalid Merkle proof.')
+  if next(path, None) is not None:
+    raise ValueError('Invalid Merkle proof.')
+  return node
+
+
+def sc_sign_merkle(documents, key_id, pin, workers=None, chunk_size=CHUNK_SIZE, token=None,
+                   pkcs11=None):
+  """Sign documents with one token signature of their Merkle tree root.
+
+  Args:
+    - documents(iterable of str | bytes-like | pathlib.Path | file object):
+      Documents to be signed
+    - key_id(tuple): Key ID as tuple (e.g. (1,))
+    - pin(str): Pin for session login
+    - workers(int): Threads hashing documents; defaults to number of CPUs
+    - chunk_size(int): Size of chunks in which files are read and hashed
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    MerkleSignature(root, signature, proofs), where proofs are MerkleProof
+    instances in order of documents
+
+  Raises:
+    - ValueError: If there are no documents
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If private key for given key id does not exist
+    - SmartCardSigningError: If error happened during signing data
+  """
+  levels = merkle_tree(_leaf_hashes(list(documents), workers, chunk_size))
+  root = levels[-1][0]
+  signature = sc_sign_rsa_pkcs_pss_sha256(ROOT_PREFIX + root, key_id, pin, token=token,
+                                          pkcs11=pkcs11)
+  proofs = [merkle_proof(levels, index) for index in range(len(levels[0]))]
+  return MerkleSignature(root, signature, proofs)
+
+
+def sc_verify_merkle(document, proof, signature, pem, chunk_size=CHUNK_SIZE):
+  """Verify document signed by `sc_sign_merkle`.
+
+  Args:
+    - document(str | bytes-like | pathlib.Path | file object): Signed document
+    - proof(MerkleProof | bytes): Proof of the document (or its `to_bytes()`)
+    - signature(bytes): Signature of the Merkle root
+    - pem(bytes | str): Public key or x509 certificate in PEM format
+    - chunk_size(int): Size of chunks in which files are read and hashed
+
+  Returns:
+    True if document is included in the signed root otherwise False (bool)
+
+  Raises:
+    - ValueError: If pem could not be parsed
+  """
+  try:
+    if not isinstance(proof, MerkleProof):
+      proof = MerkleProof.from_bytes(proof)
+    root = merkle_root_from_proof(leaf_hash(document, chunk_size), proof)
+  except ValueError:
+    return False
+  return sc_verify(ROOT_PREFIX + root, signature, pem)
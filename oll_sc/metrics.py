@@ -0,0 +1,236 @@
+"""Timing of PKCS#11 phases and of waiting in the signing queue.
+
+Hooks registered with `add_hook` are called after every timed phase with
+`(phase, duration, error)`, where duration is in seconds and error is the raised
+exception or None. Without registered hooks phases are not timed at all.
+
+`enable_metrics` registers a `Metrics` hook which keeps histograms of phase
+durations and error counts by exception class.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+INIT_PKCS11 = 'init_pkcs11'
+OPEN_SESSION = 'open_session'
+LOGIN = 'login'
+FIND_OBJECTS = 'find_objects'
+CONTEXT_LOGIN = 'context_login'
+SIGN = 'sign'
+# Time spent by a request in `oll_sc.signing_queue.SigningQueue` before signing
+QUEUE_WAIT = 'queue_wait'
+
+PHASES = (INIT_PKCS11, QUEUE_WAIT, OPEN_SESSION, LOGIN, FIND_OBJECTS, CONTEXT_LOGIN, SIGN)
+
+# Upper bounds (seconds) of histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_HOOKS = ()
+_HOOKS_LOCK = threading.Lock()
+
+
+def add_hook(hook):
+  """Register callable `hook(phase, duration, error)` called after every timed phase."""
+  global _HOOKS
+  with _HOOKS_LOCK:
+    _HOOKS = _HOOKS + (hook,)
+
+
+def remove_hook(hook):
+  """Unregister hook added by `add_hook`."""
+  global _HOOKS
+  with _HOOKS_LOCK:
+    _HOOKS = tuple(h for h in _HOOKS if h is not hook)
+
+
+def record(phase, duration, error=None):
+  """Pass duration measured by the caller to registered hooks (e.g. when phase
+  does not start and end in the same block)."""
+  for hook in _HOOKS:
+    try:
+      hook(phase, duration, error)
+    except Exception:  # pylint: disable=broad-except
+      logger.exception('Instrumentation hook %r failed.', hook)
+
+
+class _NoTiming:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+_NO_TIMING = _NoTiming()
+
+
+class _Timing:
+  __slots__ = ('phase', 'hooks', 'start')
+
+  def __init__(self, phase, hooks):
+    self.phase = phase
+    self.hooks = hooks
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, traceback):
+    duration = time.perf_counter() - self.start
+    for hook in self.hooks:
+      try:
+        hook(self.phase, duration, exc)
+      except Exception:  # pylint: disable=broad-except
+        logger.exception('Instrumentation hook %r failed.', hook)
+    return False
+
+
+def timed(phase):
+  """Context manager timing a phase and passing the result to registered hooks.
+
+  Usage:
+    with timed(SIGN):
+      session.sign(...)
+  """
+  hooks = _HOOKS
+  if not hooks:
+    return _NO_TIMING
+  return _Timing(phase, hooks)
+
+
+class _Histogram:
+  __slots__ = ('counts', 'count', 'sum', 'max')
+
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value):
+    index = 0
+    while index < len(BUCKETS) and value > BUCKETS[index]:
+      index += 1
+    self.counts[index] += 1
+    self.count += 1
+    self.sum += value
+    self.max = max(self.max, value)
+
+
+class Metrics:
+  """Hook keeping histogram of durations and error counts of every phase."""
+
+  def __init__(self):
+    self._histograms = {}
+    self._errors = {}  # (phase, exception class name) -> count
+    self._lock = threading.Lock()
+
+  def __call__(self, phase, duration, error):
+    with self._lock:
+      histogram = self._histograms.get(phase)
+      if histogram is None:
+        histogram = self._histograms[phase] = _Histogram()
+      histogram.observe(duration)
+      if error is not None:
+        key = (phase, type(error).__name__)
+        self._errors[key] = self._errors.get(key, 0) + 1
+
+  def reset(self):
+    with self._lock:
+      self._histograms.clear()
+      self._errors.clear()
+
+  def snapshot(self):
+    """Return dict of phase -> {'count', 'sum', 'max', 'buckets', 'errors'}, where
+    buckets is a list of (upper bound, cumulative count) and errors maps exception
+    class names to counts."""
+    with self._lock:
+      snapshot = {}
+      for phase, histogram in self._histograms.items():
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(BUCKETS + (float('inf'),), histogram.counts):
+          cumulative += count
+          buckets.append((bound, cumulative))
+        snapshot[phase] = {
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'max': histogram.max,
+            'buckets': buckets,
+            'errors': {},
+        }
+      for (phase, error), count in self._errors.items():
+        snapshot[phase]['errors'][error] = count
+      return snapshot
+
+  def prometheus_text(self):
+    """Return metrics in Prometheus text exposition format."""
+    return prometheus_text(self.snapshot())
+
+
+def quantile(data, q):
+  """Estimate quantile `q` (0-1) of a phase in `Metrics.snapshot()` as upper
+  bound of the bucket containing it (at most the observed maximum)."""
+  rank = q * data['count']
+  for bound, count in data['buckets']:
+    if count >= rank:
+      return min(bound, data['max'])
+  return data['max']
+
+
+def prometheus_text(snapshot):
+  """Return snapshot returned by `Metrics.snapshot()` in Prometheus text
+  exposition format."""
+  lines = [
+      '# HELP oll_sc_phase_duration_seconds Duration of PKCS#11 phases.',
+      '# TYPE oll_sc_phase_duration_seconds histogram',
+  ]
+  for phase, data in sorted(snapshot.items()):
+    for bound, count in data['buckets']:
+      le = '+Inf' if bound == float('inf') else repr(bound)
+      lines.append('oll_sc_phase_duration_seconds_bucket{{phase="{}",le="{}"}} {}'
+                   .format(phase, le, count))
+    lines.append('oll_sc_phase_duration_seconds_sum{{phase="{}"}} {!r}'
+                 .format(phase, data['sum']))
+    lines.append('oll_sc_phase_duration_seconds_count{{phase="{}"}} {}'
+                 .format(phase, data['count']))
+  lines += [
+      '# HELP oll_sc_phase_errors_total Errors raised in PKCS#11 phases.',
+      '# TYPE oll_sc_phase_errors_total counter',
+  ]
+  for phase, data in sorted(snapshot.items()):
+    for error, count in sorted(data['errors'].items()):
+      lines.append('oll_sc_phase_errors_total{{phase="{}",error="{}"}} {}'
+                   .format(phase, error, count))
+  return '\n'.join(lines) + '\n'
+
+
+_METRICS = None
+
+
+def get_metrics():
+  """Return metrics recorded since `enable_metrics` or None if disabled."""
+  return _METRICS
+
+
+def enable_metrics():
+  """Start recording phase durations and errors.
+
+  Returns:
+    Metrics instance
+  """
+  global _METRICS
+  if _METRICS is None:
+    _METRICS = Metrics()
+    add_hook(_METRICS)
+  return _METRICS
+
+
+def disable_metrics():
+  """Stop recording phase durations and errors."""
+  global _METRICS
+  if _METRICS is not None:
+    remove_hook(_METRICS)
+    _METRICS = None
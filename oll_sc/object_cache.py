@@ -0,0 +1,134 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ObjectCache:
+  """LRU cache of key object handles and attribute values, keyed by
+  (session, key id, object class).
+
+  Handles are valid as long as the session is open, so cached objects are looked
+  up without any call to the token. Only sessions of the session pool
+  (`oll_sc.session_pool.enable_session_pool`) are reused, so the cache is used
+  only together with the pool. Entries of a session are invalidated when the
+  pool closes it. Cache is cleared when PyKCS11 lib is reloaded.
+  """
+
+  def __init__(self, max_size=128):
+    """
+    Args:
+      - max_size(int): Maximum number of cached objects
+    """
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._pkcs11 = None
+    self._lock = threading.Lock()
+
+  def get(self, pkcs11, session, key_id, obj_class, lookup):
+    """Return cached (handle, attribute values) or call `lookup` and cache its result.
+
+    Args:
+      - pkcs11(PyKCS11): PyKCS11Lib instance handles belong to
+      - session(pykcs11.Session): Session in which handles were found
+      - key_id(tuple): Key ID as tuple (e.g. (1,))
+      - obj_class(int): Object class (e.g. CKO_PRIVATE_KEY)
+      - lookup(callable): Returns (handle, attribute values) on cache miss
+
+    Returns:
+      Tuple of object handle and list of attribute values
+    """
+    key = (session, tuple(key_id), obj_class)
+    with self._lock:
+      if self._pkcs11 is not pkcs11:
+        self._entries.clear()
+        self._pkcs11 = pkcs11
+      try:
+        value = self._entries[key]
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+      except KeyError:
+        self.misses += 1
+
+    value = lookup()
+
+    with self._lock:
+      if self._pkcs11 is pkcs11:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+          self._entries.popitem(last=False)
+          self.evictions += 1
+    return value
+
+  def evict(self, session, key_id, obj_class):
+    """Remove single object from cache (e.g. if its handle is not valid anymore)."""
+    with self._lock:
+      self._entries.pop((session, tuple(key_id), obj_class), None)
+
+  def invalidate(self, session=None):
+    """Remove cached objects of a session (or of all sessions).
+
+    Args:
+      - session(pykcs11.Session): Closed session; all sessions if None
+    """
+    with self._lock:
+      if session is None:
+        self._entries.clear()
+      else:
+        for key in [key for key in self._entries if key[0] is session]:
+          del self._entries[key]
+    if session is None:
+      logger.debug('Object cache invalidated.')
+
+  def stats(self):
+    """Return cache hit/miss counters and size (dict)."""
+    with self._lock:
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'size': len(self._entries),
+      }
+
+
+_OBJECT_CACHE = None
+
+
+def get_object_cache():
+  """Return object cache used by `oll_sc.api` functions or None if disabled."""
+  return _OBJECT_CACHE
+
+
+def enable_object_cache(max_size=128):
+  """Make `oll_sc.api` functions cache key object handles and attributes of
+  pooled sessions instead of searching for objects on every call. Cache is
+  disabled together with the session pool.
+
+  Args:
+    - max_size(int): Maximum number of cached objects
+
+  Returns:
+    ObjectCache instance
+
+  Raises:
+    - RuntimeError: If session pool is not enabled
+  """
+  from .session_pool import get_session_pool
+
+  global _OBJECT_CACHE
+  if get_session_pool() is None:
+    raise RuntimeError('Object cache needs the session pool, enable it first.')
+  _OBJECT_CACHE = ObjectCache(max_size)
+  return _OBJECT_CACHE
+
+
+def disable_object_cache():
+  """Search for key objects on every call again."""
+  global _OBJECT_CACHE
+  _OBJECT_CACHE = None
@@ -0,0 +1,209 @@
+"""Classification of PKCS#11 errors, retry of transient errors and per-slot
+circuit breaker.
+
+Transient errors (e.g. CKR_DEVICE_ERROR, CKR_SESSION_HANDLE_INVALID) are raised
+as SmartCardTransientError and API functions decorated with `retry_transient`
+are called again after jittered exponential backoff. Errors of login are never
+transient, so login is never repeated after CKR_PIN_INCORRECT (or after token
+errors, which some PIV middleware reports for a wrong PIN).
+
+After `failure_threshold` consecutive transient failures of a slot, calls for
+that slot raise SmartCardCircuitOpenError without touching the token until
+`reset_timeout` passes; then one call is let through to probe the token.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+from .exceptions import (SmartCardCircuitOpenError, SmartCardError,
+                         SmartCardNotPresentError, SmartCardPinLockedError,
+                         SmartCardTransientError, SmartCardWrongPinError)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def error_codes():
+  """Return frozensets of transient, not present and wrong PIN error codes.
+  PyKCS11 is imported on first call, not when the package is imported."""
+  from PyKCS11 import (CKR_DEVICE_ERROR, CKR_DEVICE_MEMORY, CKR_DEVICE_REMOVED,
+                       CKR_FUNCTION_FAILED, CKR_GENERAL_ERROR, CKR_OPERATION_ACTIVE,
+                       CKR_PIN_EXPIRED, CKR_PIN_INCORRECT, CKR_PIN_INVALID,
+                       CKR_PIN_LEN_RANGE, CKR_SESSION_CLOSED, CKR_SESSION_COUNT,
+                       CKR_SESSION_HANDLE_INVALID, CKR_TOKEN_NOT_PRESENT,
+                       CKR_TOKEN_NOT_RECOGNIZED)
+
+  transient = frozenset([
+      CKR_DEVICE_ERROR, CKR_DEVICE_MEMORY, CKR_FUNCTION_FAILED, CKR_GENERAL_ERROR,
+      CKR_OPERATION_ACTIVE, CKR_SESSION_CLOSED, CKR_SESSION_COUNT, CKR_SESSION_HANDLE_INVALID,
+  ])
+  not_present = frozenset([CKR_DEVICE_REMOVED, CKR_TOKEN_NOT_PRESENT, CKR_TOKEN_NOT_RECOGNIZED])
+  wrong_pin = frozenset([CKR_PIN_INCORRECT, CKR_PIN_INVALID, CKR_PIN_LEN_RANGE, CKR_PIN_EXPIRED])
+  return transient, not_present, wrong_pin
+
+
+def classify_error(error, login=False):
+  """Return SmartCardError (subclass) instance for PyKCS11Error.
+
+  Args:
+    - error(PyKCS11Error): Error raised by PyKCS11
+    - login(bool): Whether error was raised by login; login errors are never
+      transient and unknown ones are treated as wrong PIN
+  """
+  from PyKCS11 import CKR_PIN_LOCKED
+
+  transient_errors, not_present_errors, wrong_pin_errors = error_codes()
+  code = error.value
+  if code == CKR_PIN_LOCKED:
+    return SmartCardPinLockedError('PIN is locked.')
+  if code in wrong_pin_errors:
+    return SmartCardWrongPinError('PIN is not valid.')
+  if code in not_present_errors:
+    return SmartCardNotPresentError('Please insert your smart card.')
+  if login:
+    # Some PIV middleware reports wrong PIN as CKR_DEVICE_ERROR, CKR_FUNCTION_FAILED
+    # or CKR_GENERAL_ERROR, so a retry could use up another PIN attempt
+    if code in transient_errors:
+      return SmartCardError('Token error during login, not retried: {}'.format(error))
+    return SmartCardWrongPinError('PIN is not valid.')
+  if code in transient_errors:
+    return SmartCardTransientError('Token error, try again: {}'.format(error))
+  return SmartCardError(str(error))
+
+
+class CircuitBreaker:
+  """Per-slot circuit breaker counting consecutive transient failures."""
+
+  def __init__(self, failure_threshold=5, reset_timeout=30):
+    """
+    Args:
+      - failure_threshold(int): Consecutive failures after which slot fails fast
+      - reset_timeout(float): Seconds after which a failing slot is probed again
+    """
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self._failures = {}  # slot -> consecutive failures
+    self._opened_at = {}  # slot -> monotonic time
+    self._lock = threading.Lock()
+
+  def before_call(self, slot):
+    """Raise SmartCardCircuitOpenError if slot is failing."""
+    with self._lock:
+      opened_at = self._opened_at.get(slot)
+      if opened_at is None:
+        return
+      if time.monotonic() - opened_at < self.reset_timeout:
+        raise SmartCardCircuitOpenError(
+            'Token in slot {} is failing, not trying it for {}s.'.format(slot, self.reset_timeout))
+      # Let one call probe the token; circuit opens again if it fails
+      self._opened_at[slot] = time.monotonic()
+
+  def record_success(self, slot):
+    with self._lock:
+      self._failures.pop(slot, None)
+      if self._opened_at.pop(slot, None) is not None:
+        logger.info('Token in slot %s recovered.', slot)
+
+  def record_failure(self, slot):
+    with self._lock:
+      failures = self._failures[slot] = self._failures.get(slot, 0) + 1
+      if failures >= self.failure_threshold and slot not in self._opened_at:
+        logger.warning('Token in slot %s failed %s times in a row.', slot, failures)
+        self._opened_at[slot] = time.monotonic()
+
+  def is_open(self, slot):
+    with self._lock:
+      return slot in self._opened_at
+
+  def reset(self):
+    with self._lock:
+      self._failures.clear()
+      self._opened_at.clear()
+
+
+class RetryPolicy:
+  """Bounded retry with exponential backoff and full jitter."""
+
+  def __init__(self, attempts=3, base_delay=0.05, max_delay=1.0):
+    """
+    Args:
+      - attempts(int): Maximum number of calls (1 disables retry)
+      - base_delay(float): Backoff of the first retry in seconds
+      - max_delay(float): Upper bound of backoff in seconds
+    """
+    self.attempts = attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+
+  def delay(self, attempt):
+    """Return seconds to wait before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+_RETRY_POLICY = RetryPolicy()
+_CIRCUIT_BREAKER = CircuitBreaker()
+
+
+def get_retry_policy():
+  return _RETRY_POLICY
+
+
+def get_circuit_breaker():
+  """Return circuit breaker used by API functions or None if disabled."""
+  return _CIRCUIT_BREAKER
+
+
+def configure_retry(attempts=3, base_delay=0.05, max_delay=1.0, failure_threshold=5,
+                    reset_timeout=30):
+  """Configure retry of transient errors and circuit breaker of API functions.
+
+  Args:
+    - attempts(int): Maximum number of calls (1 disables retry)
+    - base_delay(float): Backoff of the first retry in seconds
+    - max_delay(float): Upper bound of backoff in seconds
+    - failure_threshold(int): Consecutive failures after which slot fails fast;
+      None disables circuit breaker
+    - reset_timeout(float): Seconds after which a failing slot is probed again
+  """
+  global _RETRY_POLICY, _CIRCUIT_BREAKER
+  _RETRY_POLICY = RetryPolicy(attempts, base_delay, max_delay)
+  _CIRCUIT_BREAKER = CircuitBreaker(failure_threshold, reset_timeout) \
+      if failure_threshold is not None else None
+
+
+@contextmanager
+def slot_guard(slot):
+  """Fail fast if slot's circuit is open and record outcome of the block."""
+  breaker = _CIRCUIT_BREAKER
+  if breaker is None:
+    yield
+    return
+  breaker.before_call(slot)
+  try:
+    yield
+  except SmartCardTransientError:
+    breaker.record_failure(slot)
+    raise
+  breaker.record_success(slot)
+
+
+def retry_transient(api_func):
+  """Decorator calling API function again when it raises SmartCardTransientError."""
+  @wraps(api_func)
+  def wrapper(*args, **kwargs):
+    policy = _RETRY_POLICY
+    attempt = 1
+    while True:
+      try:
+        return api_func(*args, **kwargs)
+      except SmartCardTransientError as e:
+        if attempt >= policy.attempts:
+          raise
+        delay = policy.delay(attempt)
+        logger.debug('%s failed (%s), retrying in %.3fs.', api_func.__name__, e, delay)
+        time.sleep(delay)
+        attempt += 1
+  return wrapper
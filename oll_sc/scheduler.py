@@ -0,0 +1,279 @@
+import hashlib
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from PyKCS11 import (CKA_ALWAYS_AUTHENTICATE, CKA_CLASS, CKA_ID, CKA_VALUE,
+                     CKF_RW_SESSION, CKF_SERIAL_SESSION, CKO_CERTIFICATE,
+                     CKO_PRIVATE_KEY, CKO_PUBLIC_KEY, CKR_DEVICE_REMOVED,
+                     CKR_SESSION_CLOSED, CKR_SESSION_HANDLE_INVALID,
+                     CKR_TOKEN_NOT_PRESENT, CKR_TOKEN_NOT_RECOGNIZED,
+                     CKU_CONTEXT_SPECIFIC, PyKCS11Error)
+
+from . import init_pkcs11
+from .api import RSA_PKCS_PSS_SHA256_MECHANISM
+from .exceptions import (SmartCardFindKeyObjectError, SmartCardNotPresentError,
+                         SmartCardSigningError)
+from .retry import classify_error
+
+logger = logging.getLogger(__name__)
+
+# Errors after which token is considered to be removed from its slot
+_TOKEN_REMOVED_ERRORS = (CKR_DEVICE_REMOVED, CKR_SESSION_CLOSED, CKR_SESSION_HANDLE_INVALID,
+                         CKR_TOKEN_NOT_PRESENT, CKR_TOKEN_NOT_RECOGNIZED)
+
+
+def _find_key_id(session, key_id, cert_fingerprint):
+  """Return key id of matching public object or None. Public objects are visible
+  without login, so no PIN attempt is spent on tokens without the key."""
+  if cert_fingerprint is None:
+    found = session.findObjects([(CKA_ID, key_id), (CKA_CLASS, CKO_PUBLIC_KEY)]) or \
+        session.findObjects([(CKA_ID, key_id), (CKA_CLASS, CKO_CERTIFICATE)])
+    return key_id if found else None
+
+  for cert in session.findObjects([(CKA_CLASS, CKO_CERTIFICATE)]):
+    cert_value, cert_key_id = session.getAttributeValue(cert, [CKA_VALUE, CKA_ID])
+    if hashlib.sha256(bytes(cert_value)).hexdigest() == cert_fingerprint.lower():
+      return tuple(cert_key_id)
+  return None
+
+
+class _TokenWorker(threading.Thread):
+  """Signs queued requests with one token."""
+
+  def __init__(self, scheduler, slot, session, priv_key, always_auth):
+    """
+    Args:
+      - scheduler(SigningScheduler): Provides pin, mechanism and is notified
+        about finished requests and removed token
+      - slot(int): Slot id
+      - session(pykcs11.Session): Logged in session
+      - priv_key(CK_OBJECT_HANDLE): Private key handle
+      - always_auth(bool): CKA_ALWAYS_AUTHENTICATE of private key
+    """
+    super().__init__(name='oll-sc-token-{}'.format(slot), daemon=True)
+    self.slot = slot
+    self.session = session
+    self.priv_key = priv_key
+    self.always_auth = always_auth
+    self.alive = True
+    self.pending = 0
+    self.signed = 0
+    self.queue = queue.Queue()
+    self._scheduler = scheduler
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      data, future = item
+      if not future.running() and not future.set_running_or_notify_cancel():
+        self._scheduler.request_done(self)
+        continue
+
+      login = self.always_auth
+      try:
+        if login:
+          self.session.login(self._scheduler.pin, CKU_CONTEXT_SPECIFIC)
+          login = False
+        signature = bytes(self.session.sign(self.priv_key, data, self._scheduler.mechanism))
+      except PyKCS11Error as e:
+        if e.value in _TOKEN_REMOVED_ERRORS:
+          logger.warning('Token in slot %s was removed, moving its pending work.', self.slot)
+          self._scheduler.token_removed(self, item)
+          break
+        # Login errors are reported as they are, never as signing errors
+        future.set_exception(classify_error(e, login=True) if login
+                             else SmartCardSigningError(data))
+      else:
+        self.signed += 1
+        future.set_result(signature)
+      self._scheduler.request_done(self)
+
+  def close(self):
+    try:
+      self.session.logout()
+      self.session.closeSession()
+    except PyKCS11Error:
+      pass
+
+
+class SigningScheduler:
+  """Sign with every present token which holds the same key.
+
+  One worker thread is started per token and each request is queued to the
+  token with the fewest pending requests. When a token is removed, its pending
+  requests are moved to the remaining tokens.
+
+  Usage:
+    with SigningScheduler.start((1,), pin) as scheduler:
+      futures = [scheduler.submit(data) for data in items]
+      signatures = [future.result() for future in futures]
+  """
+
+  def __init__(self, pin, mechanism=RSA_PKCS_PSS_SHA256_MECHANISM):
+    self.pin = pin
+    self.mechanism = mechanism
+    self.workers = []
+    self._lock = threading.Lock()
+
+  @classmethod
+  @init_pkcs11
+  def start(cls, key_id, pin, cert_fingerprint=None, mechanism=RSA_PKCS_PSS_SHA256_MECHANISM,
+            pkcs11=None):
+    """Find tokens with matching key and start one worker per token.
+
+    Args:
+      - key_id(tuple): Key ID as tuple (e.g. (1,)); ignored if cert_fingerprint is set
+      - pin(str): Pin for session and context specific login
+      - cert_fingerprint(str): SHA256 fingerprint of x509 certificate (hex)
+      - mechanism(PyKCS11 mechanism): Defaults to SHA256_RSA_PKCS_PSS
+      - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+    Returns:
+      SigningScheduler instance
+
+    Raises:
+      - SmartCardNotPresentError: If smart card is not inserted
+      - SmartCardFindKeyObjectError: If no token holds the key
+      - SmartCardWrongPinError: If pin is incorrect; it is not tried on other tokens
+      - SmartCardPinLockedError: If PIN is locked
+      - SmartCardTransientError: If a session could not be opened
+
+    NOTE: If starting fails, workers which were already started are stopped.
+    """
+    slots = pkcs11.getSlotList(tokenPresent=True)
+    if not slots:
+      raise SmartCardNotPresentError('Please insert your smart card.')
+
+    scheduler = cls(pin, mechanism)
+    try:
+      for slot in slots:
+        worker = scheduler._start_worker(pkcs11, slot, key_id, cert_fingerprint)
+        if worker is not None:
+          scheduler.workers.append(worker)
+    except BaseException:
+      scheduler.close()
+      raise
+
+    if not scheduler.workers:
+      raise SmartCardFindKeyObjectError(key_id if cert_fingerprint is None else cert_fingerprint)
+    logger.debug('Signing with tokens in slots %s', [w.slot for w in scheduler.workers])
+    return scheduler
+
+  def _start_worker(self, pkcs11, slot, key_id, cert_fingerprint):
+    """Log in to token in slot and return its started worker, or None if token
+    does not hold the key."""
+    try:
+      session = pkcs11.openSession(slot, CKF_SERIAL_SESSION | CKF_RW_SESSION)
+    except PyKCS11Error as e:
+      raise classify_error(e)
+
+    try:
+      slot_key_id = _find_key_id(session, key_id, cert_fingerprint)
+      if slot_key_id is None:
+        session.closeSession()
+        return None
+
+      try:
+        session.login(self.pin)
+      except PyKCS11Error as e:
+        # Never retried or tried on other tokens, so PIN attempts are not used up
+        raise classify_error(e, login=True)
+      priv_key = session.findObjects([(CKA_ID, slot_key_id), (CKA_CLASS, CKO_PRIVATE_KEY)])[0]
+      always_auth = session.getAttributeValue(priv_key, [CKA_ALWAYS_AUTHENTICATE])[0]
+    except (PyKCS11Error, IndexError) as e:
+      logger.warning('Skipping token in slot %s: %s', slot, e)
+      session.closeSession()
+      return None
+    except BaseException:
+      session.closeSession()
+      raise
+
+    worker = _TokenWorker(self, slot, session, priv_key, always_auth)
+    worker.start()
+    return worker
+
+  def submit(self, data):
+    """Queue data to be signed by the least busy token.
+
+    Args:
+      - data(str | bytes): Data to be signed
+
+    Returns:
+      Future resolved with signature (bytes) or with SmartCardSigningError,
+      SmartCardNotPresentError if all tokens were removed
+    """
+    if isinstance(data, str):
+      data = data.encode()
+    future = Future()
+    with self._lock:
+      self._queue_locked((data, future))
+    return future
+
+  def map(self, data_items):
+    """Sign data items across tokens and yield signatures in order.
+
+    Raises:
+      - SmartCardSigningError: If error happened during signing data
+      - SmartCardNotPresentError: If all tokens were removed
+    """
+    for future in [self.submit(data) for data in data_items]:
+      yield future.result()
+
+  def stats(self):
+    """Return number of pending and signed requests per slot (dict)."""
+    with self._lock:
+      return {worker.slot: {'pending': worker.pending, 'signed': worker.signed,
+                            'alive': worker.alive}
+              for worker in self.workers}
+
+  def close(self):
+    """Finish pending requests, stop workers and close their sessions."""
+    with self._lock:
+      workers = [worker for worker in self.workers if worker.alive]
+      for worker in workers:
+        worker.queue.put(None)
+    for worker in workers:
+      worker.join()
+    for worker in self.workers:
+      worker.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _queue_locked(self, item):
+    workers = [worker for worker in self.workers if worker.alive]
+    if not workers:
+      item[1].set_exception(SmartCardNotPresentError('Please insert your smart card.'))
+      return
+    worker = min(workers, key=lambda worker: worker.pending)
+    worker.pending += 1
+    worker.queue.put(item)
+
+  def request_done(self, worker):
+    """Called by worker when it finished a request."""
+    with self._lock:
+      worker.pending -= 1
+
+  def token_removed(self, worker, current_item):
+    """Called by worker when its token was removed. Moves current and queued
+    requests of the worker to remaining tokens."""
+    with self._lock:
+      worker.alive = False
+      items = [current_item]
+      while True:
+        try:
+          item = worker.queue.get_nowait()
+        except queue.Empty:
+          break
+        if item is not None:
+          items.append(item)
+      worker.pending = 0
+      for item in items:
+        self._queue_locked(item)
@@ -0,0 +1,343 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .exceptions import SmartCardNotPresentError
+from .metrics import LOGIN, OPEN_SESSION, timed
+from .object_cache import disable_object_cache, get_object_cache
+from .retry import classify_error, slot_guard
+
+logger = logging.getLogger(__name__)
+
+
+def _pin_digest(pin):
+  return hashlib.sha256(pin.encode() if isinstance(pin, str) else bytes(pin)).digest()
+
+
+class _PooledSession:
+  __slots__ = ('session', 'pkcs11', 'generation', 'last_used')
+
+  def __init__(self, session, pkcs11, generation):
+    self.session = session
+    self.pkcs11 = pkcs11
+    self.generation = generation
+    self.last_used = time.monotonic()
+
+
+class SessionPool:
+  """Pool of logged in token sessions, kept per slot and PIN.
+
+  Login state in PKCS#11 is shared by all sessions of an application on a token,
+  so a slot is logged in with one PIN at a time. Borrowing a session with a
+  different PIN closes idle sessions of that slot and logs in again.
+
+  Sessions idle for longer than `idle_timeout` are closed by a background
+  thread, which runs only while there are idle sessions.
+  """
+
+  def __init__(self, max_size=4, idle_timeout=300):
+    """
+    Args:
+      - max_size(int): Maximum number of open sessions per slot
+      - idle_timeout(int | float): Seconds after which idle session is closed
+    """
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self._cond = threading.Condition()
+    self._idle = {}  # slot -> list of idle _PooledSession (most recently used last)
+    self._size = {}  # slot -> number of open sessions (idle and borrowed)
+    self._pins = {}  # slot -> digest of PIN used for login
+    self._generation = {}  # slot -> incremented on invalidation
+    self._reaper = None  # thread closing idle sessions
+    self._reaper_wakeup = threading.Event()
+
+  @contextmanager
+  def session(self, pin, pkcs11, slot=None):
+    """Borrow logged in session for a slot (the first slot with token present
+    by default).
+
+    Args:
+      - pin(str): Pin for session login
+      - pkcs11(PyKCS11): PyKCS11Lib instance
+      - slot(int): Slot id (e.g. resolved by `oll_sc.slot_resolver.resolve_slot`)
+
+    Returns:
+      Session object (pykcs11.Session)
+
+    Raises:
+      - SmartCardNotPresentError: If smart card is not inserted
+      - SmartCardWrongPinError: If pin is incorrect
+      - SmartCardTransientError: If token failed temporarily
+      - SmartCardCircuitOpenError: If token of the slot failed repeatedly
+    """
+    slots = pkcs11.getSlotList(tokenPresent=True)
+    self._invalidate_removed(slots)
+    if slot is None and slots:
+      slot = slots[0]
+    if slot not in slots:
+      raise SmartCardNotPresentError('Please insert your smart card.')
+
+    with slot_guard(slot):
+      pooled = self._acquire(slot, pin, pkcs11)
+      try:
+        yield pooled.session
+      finally:
+        self._release(slot, pooled)
+
+  def invalidate(self, slot=None):
+    """Close idle sessions of a slot (or all slots). Borrowed sessions are closed
+    when they are returned.
+
+    Args:
+      - slot(int): Slot id; all slots if None
+    """
+    with self._cond:
+      for slot_id in ([slot] if slot is not None else list(self._size)):
+        self._invalidate_locked(slot_id)
+
+  def close(self):
+    """Close all idle sessions."""
+    self.invalidate()
+    self._reaper_wakeup.set()
+    reaper = self._reaper
+    if reaper is not None and reaper is not threading.current_thread():
+      reaper.join()
+
+  def prune(self):
+    """Close sessions which were idle for longer than `idle_timeout`."""
+    with self._cond:
+      for slot in list(self._idle):
+        self._prune_locked(slot)
+
+  def _reap(self):
+    """Close idle sessions when they time out; exit when none is idle."""
+    while True:
+      with self._cond:
+        for slot in list(self._idle):
+          self._prune_locked(slot)
+        last_used = [pooled.last_used for idle in self._idle.values() for pooled in idle]
+        if not last_used:
+          self._reaper = None
+          return
+        timeout = min(last_used) + self.idle_timeout - time.monotonic()
+      # Woken up earlier by close()
+      self._reaper_wakeup.wait(max(0, timeout))
+      self._reaper_wakeup.clear()
+
+  def _start_reaper_locked(self):
+    # Sessions never time out with infinite idle_timeout
+    if self._reaper is None and self.idle_timeout != float('inf'):
+      self._reaper = threading.Thread(target=self._reap, name='oll-sc-session-reaper',
+                                      daemon=True)
+      self._reaper.start()
+
+  def stats(self):
+    """Return number of open and idle sessions per slot (dict)."""
+    with self._cond:
+      return {slot: {'open': size, 'idle': len(self._idle.get(slot, ()))}
+              for slot, size in self._size.items()}
+
+  def _invalidate_removed(self, present_slots):
+    with self._cond:
+      for slot in list(self._size):
+        if slot not in present_slots:
+          logger.debug('Token removed from slot %s, invalidating sessions.', slot)
+          self._invalidate_locked(slot)
+
+  def _invalidate_locked(self, slot):
+    self._generation[slot] = self._generation.get(slot, 0) + 1
+    self._pins.pop(slot, None)
+    for pooled in self._idle.pop(slot, []):
+      self._discard_locked(slot, pooled)
+
+  def _prune_locked(self, slot):
+    deadline = time.monotonic() - self.idle_timeout
+    idle = self._idle.get(slot, [])
+    for pooled in [pooled for pooled in idle if pooled.last_used < deadline]:
+      idle.remove(pooled)
+      self._discard_locked(slot, pooled)
+
+  def _discard_locked(self, slot, pooled):
+    self._size[slot] -= 1
+    self._cond.notify()
+    self._close(slot, pooled)
+
+  @staticmethod
+  def _close(slot, pooled):
+    # Cached handles are valid only while their session is open
+    cache = get_object_cache()
+    if cache is not None:
+      cache.invalidate(pooled.session)
+    # Sessions of a previously loaded library are not valid anymore
+    if pooled.pkcs11 is not None:
+      from PyKCS11 import PyKCS11Error
+
+      try:
+        pooled.session.closeSession()
+      except PyKCS11Error:
+        pass
+    logger.debug('Closed pooled session for slot %s', slot)
+
+  def _acquire(self, slot, pin, pkcs11):
+    digest = _pin_digest(pin)
+    with self._cond:
+      while True:
+        if self._pins.get(slot, digest) != digest:
+          # Wait for sessions logged in with other PIN before logging in again
+          if self._size.get(slot, 0) > len(self._idle.get(slot, ())):
+            self._cond.wait()
+            continue
+          self._invalidate_locked(slot)
+
+        self._prune_locked(slot)
+        idle = self._idle.get(slot)
+        if idle:
+          pooled = idle.pop()
+          break
+        if self._size.get(slot, 0) < self.max_size:
+          self._size[slot] = self._size.get(slot, 0) + 1
+          pooled = None
+          break
+        self._cond.wait()
+
+      generation = self._generation.get(slot, 0)
+      logged_in = self._pins.get(slot) == digest
+
+    try:
+      if pooled is not None:
+        if self._is_healthy(pooled, pkcs11, pin):
+          return pooled
+        self._close(slot, pooled)
+        pooled = None
+      pooled = _PooledSession(self._open(slot, pin, pkcs11, logged_in), pkcs11, generation)
+    except BaseException:
+      if pooled is not None:
+        self._close(slot, pooled)
+      with self._cond:
+        self._size[slot] -= 1
+        self._cond.notify()
+      raise
+
+    with self._cond:
+      self._pins[slot] = digest
+    return pooled
+
+  def _release(self, slot, pooled):
+    with self._cond:
+      if pooled.generation != self._generation.get(slot, 0):
+        self._discard_locked(slot, pooled)
+        return
+      pooled.last_used = time.monotonic()
+      self._start_reaper_locked()
+      self._idle.setdefault(slot, []).append(pooled)
+      self._cond.notify()
+
+  def _is_healthy(self, pooled, pkcs11, pin):
+    """Check that pooled session is still valid and logged in. Login again if
+    user was logged out (CKR_USER_NOT_LOGGED_IN)."""
+    from PyKCS11 import (CKR_USER_ALREADY_LOGGED_IN, CKS_RO_USER_FUNCTIONS,
+                         CKS_RW_USER_FUNCTIONS, PyKCS11Error)
+
+    if pooled.pkcs11 is not pkcs11:
+      pooled.pkcs11 = None
+      return False
+    try:
+      state = pooled.session.getSessionInfo().state
+    except PyKCS11Error:
+      return False
+
+    if state not in (CKS_RO_USER_FUNCTIONS, CKS_RW_USER_FUNCTIONS):
+      logger.debug('Pooled session is not logged in, logging in again.')
+      try:
+        with timed(LOGIN):
+          pooled.session.login(pin)
+      except PyKCS11Error as e:
+        if e.value != CKR_USER_ALREADY_LOGGED_IN:
+          raise classify_error(e, login=True)
+    return True
+
+  @staticmethod
+  def _open(slot, pin, pkcs11, logged_in):
+    from PyKCS11 import (CKF_RW_SESSION, CKF_SERIAL_SESSION, CKR_USER_ALREADY_LOGGED_IN,
+                         PyKCS11Error)
+
+    try:
+      with timed(OPEN_SESSION):
+        session = pkcs11.openSession(slot, CKF_SERIAL_SESSION | CKF_RW_SESSION)
+    except PyKCS11Error as e:
+      raise classify_error(e)
+    logger.debug('Pooled session opened for slot %s', slot)
+    try:
+      try:
+        with timed(LOGIN):
+          session.login(pin)
+      except PyKCS11Error as e:
+        if e.value != CKR_USER_ALREADY_LOGGED_IN:
+          raise
+        if not logged_in:
+          # Logged in by someone else, PIN has to be verified
+          session.logout()
+          with timed(LOGIN):
+            session.login(pin)
+    except PyKCS11Error as e:
+      session.closeSession()
+      raise classify_error(e, login=True)
+    return session
+
+  def _after_fork_in_child(self):
+    """Sessions of parent process must not be used or closed in the child."""
+    self._cond = threading.Condition()
+    self._idle = {}
+    self._size = {}
+    self._pins = {}
+    self._generation = {}
+    self._reaper = None
+    self._reaper_wakeup = threading.Event()
+
+
+_SESSION_POOL = None
+
+
+def get_session_pool():
+  """Return session pool used by `oll_sc.api` functions or None if disabled."""
+  return _SESSION_POOL
+
+
+def enable_session_pool(max_size=4, idle_timeout=300):
+  """Make `oll_sc.api` functions borrow logged in sessions from a pool instead
+  of opening and logging in for every call.
+
+  Args:
+    - max_size(int): Maximum number of open sessions per slot
+    - idle_timeout(int | float): Seconds after which idle session is closed (by a
+      background thread, also if pool is not used anymore)
+
+  Returns:
+    SessionPool instance
+  """
+  global _SESSION_POOL
+  disable_session_pool()
+  _SESSION_POOL = SessionPool(max_size, idle_timeout)
+  return _SESSION_POOL
+
+
+def disable_session_pool():
+  """Close pooled sessions and open new session for every call again. Object
+  cache, which keeps handles of pooled sessions, is disabled too."""
+  global _SESSION_POOL
+  disable_object_cache()
+  pool, _SESSION_POOL = _SESSION_POOL, None
+  if pool is not None:
+    pool.close()
+
+
+def _after_fork_in_child():
+  if _SESSION_POOL is not None:
+    _SESSION_POOL._after_fork_in_child()  # pylint: disable=W0212
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork_in_child)
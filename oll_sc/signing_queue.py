@@ -0,0 +1,297 @@
+"""Priority signing queue shared by callers of one token.
+
+Requests are signed in order of priority class. Within a class, callers take
+turns (one request each), so a caller which queued a large batch does not delay
+other callers of the same class by the whole batch:
+
+  with SigningQueue() as signing_queue:
+    urgent = signing_queue.submit(data, key_id, pin, priority=URGENT, caller='release')
+    batch = signing_queue.submit_many(items, key_id, pin, priority=BULK, caller='resign')
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from .api import sc_sign_rsa_pkcs_pss_sha256
+from .exceptions import SmartCardQueueFullError
+from .metrics import QUEUE_WAIT, record
+
+logger = logging.getLogger(__name__)
+
+URGENT = 'urgent'
+NORMAL = 'normal'
+BULK = 'bulk'
+
+# Priority classes, most urgent first
+PRIORITIES = (URGENT, NORMAL, BULK)
+
+
+class _Request:
+  __slots__ = ('data', 'key_id', 'pin', 'caller', 'future', 'submitted')
+
+  def __init__(self, data, key_id, pin, caller):
+    self.data = data
+    self.key_id = key_id
+    self.pin = pin
+    self.caller = caller
+    self.future = Future()
+    self.submitted = time.monotonic()
+
+
+class _WaitStats:
+  __slots__ = ('count', 'sum', 'max')
+
+  def __init__(self):
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value):
+    self.count += 1
+    self.sum += value
+    self.max = max(self.max, value)
+
+
+class SigningQueue:
+  """Thread-safe queue of signing requests served by worker threads.
+
+  Higher priority classes are always served first. Requests of one class are
+  taken from its callers in turns. Requests are rejected with
+  SmartCardQueueFullError when the queue or the caller's share of it is full.
+  Only requests of the same or a more urgent class count against `max_depth`,
+  so queued bulk work never causes an urgent request to be rejected.
+  """
+
+  def __init__(self, sign=sc_sign_rsa_pkcs_pss_sha256, max_depth=10000,
+               max_caller_depth=None, workers=1):
+    """
+    Args:
+      - sign(callable): Function `sign(data, key_id, pin)` returning signature;
+        defaults to `oll_sc.api.sc_sign_rsa_pkcs_pss_sha256`
+      - max_depth(int): Maximum number of queued requests of a priority class
+        and more urgent ones
+      - max_caller_depth(int): Maximum number of queued requests of one caller;
+        unlimited if None
+      - workers(int): Number of worker threads; operations of one token are
+        serialized by the token, so one worker is enough for a single token
+    """
+    self.sign = sign
+    self.max_depth = max_depth
+    self.max_caller_depth = max_caller_depth
+    self._cond = threading.Condition()
+    # priority -> caller -> deque of requests; callers are served in order
+    self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+    self._depths = dict.fromkeys(PRIORITIES, 0)  # priority -> queued requests
+    self._caller_depth = {}
+    self._rejected = 0
+    self._waits = {priority: _WaitStats() for priority in PRIORITIES}
+    self._closed = False
+    self._threads = [threading.Thread(target=self._run, name='oll-sc-signing-queue-{}'.format(i),
+                                      daemon=True)
+                     for i in range(workers)]
+    for thread in self._threads:
+      thread.start()
+
+  def submit(self, data, key_id, pin, priority=NORMAL, caller=None):
+    """Queue data to be signed.
+
+    Args:
+      - data(str | bytes): Data to be signed
+      - key_id(tuple): Key ID as tuple (e.g. (1,))
+      - pin(str): Pin for session login
+      - priority(str): URGENT, NORMAL or BULK
+      - caller(hashable): Identifies caller for fair share within priority class
+
+    Returns:
+      Future resolved with signature (bytes) or exception raised by `sign`
+
+    Raises:
+      - SmartCardQueueFullError: If queue or caller's share of it is full
+    """
+    return self.submit_many([data], key_id, pin, priority, caller)[0]
+
+  def submit_many(self, data_items, key_id, pin, priority=BULK, caller=None):
+    """Queue data items to be signed. Either all items are queued or none.
+
+    Args:
+      - data_items(iterable of str | bytes): Data items to be signed
+      - key_id(tuple): Key ID as tuple (e.g. (1,))
+      - pin(str): Pin for session login
+      - priority(str): URGENT, NORMAL or BULK
+      - caller(hashable): Identifies caller for fair share within priority class
+
+    Returns:
+      List of futures, in order of data items
+
+    Raises:
+      - SmartCardQueueFullError: If queue or caller's share of it cannot hold
+        all data items
+    """
+    if priority not in self._queues:
+      raise ValueError('Unknown priority {}.'.format(priority))
+    requests = [_Request(data.encode() if isinstance(data, str) else data, key_id, pin, caller)
+                for data in data_items]
+
+    with self._cond:
+      if self._closed:
+        raise RuntimeError('Signing queue is closed.')
+      caller_depth = self._caller_depth.get(caller, 0)
+      depth = sum(self._depths[queued_priority]
+                  for queued_priority in PRIORITIES[:PRIORITIES.index(priority) + 1])
+      if depth + len(requests) > self.max_depth or \
+         (self.max_caller_depth is not None and
+          caller_depth + len(requests) > self.max_caller_depth):
+        self._rejected += len(requests)
+        raise SmartCardQueueFullError(
+            'Signing queue is full, rejected {} request(s) of {!r}.'.format(len(requests), caller))
+
+      self._queues[priority].setdefault(caller, deque()).extend(requests)
+      self._depths[priority] += len(requests)
+      self._caller_depth[caller] = caller_depth + len(requests)
+      self._cond.notify(len(requests))
+    return [request.future for request in requests]
+
+  def depth(self):
+    """Return number of queued requests (int)."""
+    with self._cond:
+      return sum(self._depths.values())
+
+  def stats(self):
+    """Return dict with queued requests per priority ('depth') and per caller
+    ('callers'), number of rejected requests ('rejected') and wait times of
+    dequeued requests per priority ('wait': {'count', 'sum', 'max'})."""
+    with self._cond:
+      return {
+          'depth': {priority: sum(len(requests) for requests in callers.values())
+                    for priority, callers in self._queues.items()},
+          'callers': dict(self._caller_depth),
+          'rejected': self._rejected,
+          'wait': {priority: {'count': wait.count, 'sum': wait.sum, 'max': wait.max}
+                   for priority, wait in self._waits.items()},
+      }
+
+  def close(self, cancel_pending=False):
+    """Stop accepting requests and wait for workers.
+
+    Args:
+      - cancel_pending(bool): Cancel queued requests instead of signing them
+    """
+    with self._cond:
+      self._closed = True
+      if cancel_pending:
+        for callers in self._queues.values():
+          for requests in callers.values():
+            for request in requests:
+              request.future.cancel()
+            requests.clear()
+          callers.clear()
+        self._depths = dict.fromkeys(PRIORITIES, 0)
+        self._caller_depth.clear()
+      self._cond.notify_all()
+    for thread in self._threads:
+      if thread is not threading.current_thread():
+        thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _next_locked(self):
+    """Pop request of the most urgent class, taking callers in turns."""
+    for priority in PRIORITIES:
+      callers = self._queues[priority]
+      if not callers:
+        continue
+      caller, requests = next(iter(callers.items()))
+      request = requests.popleft()
+      if requests:
+        callers.move_to_end(caller)
+      else:
+        del callers[caller]
+
+      self._depths[priority] -= 1
+      remaining = self._caller_depth[caller] - 1
+      if remaining:
+        self._caller_depth[caller] = remaining
+      else:
+        del self._caller_depth[caller]
+      wait = time.monotonic() - request.submitted
+      self._waits[priority].observe(wait)
+      return request, wait
+    return None, None
+
+  def _run(self):
+    while True:
+      with self._cond:
+        request, wait = self._next_locked()
+        while request is None:
+          if self._closed:
+            return
+          self._cond.wait()
+          request, wait = self._next_locked()
+
+      record(QUEUE_WAIT, wait)
+      if not request.future.set_running_or_notify_cancel():
+        continue
+      try:
+        signature = self.sign(request.data, request.key_id, request.pin)
+      except Exception as e:  # pylint: disable=broad-except
+        request.future.set_exception(e)
+      else:
+        request.future.set_result(signature)
+
+
+_SIGNING_QUEUE = None
+
+
+def get_signing_queue():
+  """Return process-wide signing queue or None if disabled."""
+  return _SIGNING_QUEUE
+
+
+def enable_signing_queue(max_depth=10000, max_caller_depth=None,
+                         sign=sc_sign_rsa_pkcs_pss_sha256, workers=1):
+  """Create process-wide signing queue shared by components of an application.
+
+  Args:
+    - max_depth(int): Maximum number of queued requests of a priority class
+      and more urgent ones
+    - max_caller_depth(int): Maximum number of queued requests of one caller
+    - sign(callable): Function `sign(data, key_id, pin)` returning signature;
+      defaults to `oll_sc.api.sc_sign_rsa_pkcs_pss_sha256`
+    - workers(int): Number of worker threads
+
+  Returns:
+    SigningQueue instance
+  """
+  global _SIGNING_QUEUE
+  disable_signing_queue()
+  _SIGNING_QUEUE = SigningQueue(sign, max_depth, max_caller_depth, workers)
+  return _SIGNING_QUEUE
+
+
+def disable_signing_queue(cancel_pending=False):
+  """Close process-wide signing queue.
+
+  Args:
+    - cancel_pending(bool): Cancel queued requests instead of signing them
+  """
+  global _SIGNING_QUEUE
+  signing_queue, _SIGNING_QUEUE = _SIGNING_QUEUE, None
+  if signing_queue is not None:
+    signing_queue.close(cancel_pending)
+
+
+def _after_fork_in_child():
+  """Worker threads do not exist in the child process."""
+  global _SIGNING_QUEUE
+  _SIGNING_QUEUE = None
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,194 @@
+"""Selection of a token by serial number, label or certificate fingerprint.
+
+API functions and CLI commands accept a token selector:
+  'serial:0123456789abcdef'  token serial number (from `getTokenInfo`)
+  'label:Signing key'        token label
+  'fingerprint:ab12...'      SHA256 (hex) of an x509 certificate on the token
+  '0123456789abcdef'         selector without kind is a serial number
+
+Slot of the selected token is looked up in a map of present tokens which is
+read again only after a slot event, so requests go straight to the right token
+and PIN is never tried on another one.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from .exceptions import SmartCardNotPresentError
+from .retry import classify_error
+from .watcher import TokenWatcher, get_token_watcher
+
+logger = logging.getLogger(__name__)
+
+SERIAL = 'serial'
+LABEL = 'label'
+FINGERPRINT = 'fingerprint'
+
+SELECTOR_KINDS = (SERIAL, LABEL, FINGERPRINT)
+
+TokenSelector = namedtuple('TokenSelector', ['kind', 'value'])
+
+
+def parse_token_selector(selector):
+  """Return TokenSelector of selector string (see module docstring) or None.
+
+  Raises:
+    - ValueError: If selector is empty
+  """
+  if selector is None or isinstance(selector, TokenSelector):
+    return selector
+  kind, separator, value = selector.partition(':')
+  if not separator or kind not in SELECTOR_KINDS:
+    kind, value = SERIAL, selector
+  if not value:
+    raise ValueError('Token selector {!r} is empty.'.format(selector))
+  return TokenSelector(kind, value)
+
+
+class SlotResolver:
+  """Map of present tokens to slots, read again only after slot events.
+
+  If token watcher is running (`oll_sc.watcher.start_token_watcher`), its
+  snapshot is used instead. Certificate fingerprints are read (without login)
+  only when a token is selected by fingerprint, and are kept per token.
+  """
+
+  def __init__(self, pkcs11):
+    """
+    Args:
+      - pkcs11(PyKCS11): PyKCS11Lib instance
+    """
+    self.pkcs11 = pkcs11
+    # Not started; slot events are read on lookups instead of a background thread
+    self._watcher = TokenWatcher(pkcs11)
+    self._loaded = False
+    self._fingerprints = {}  # (slot, serial) -> frozenset of certificate fingerprints
+    self._lock = threading.Lock()
+
+  def tokens(self):
+    """Return present tokens (dict of slot -> oll_sc.watcher.Token)."""
+    watcher = get_token_watcher()
+    if watcher is not None and watcher.pkcs11 is self.pkcs11:
+      return watcher.tokens()
+
+    with self._lock:
+      if self._loaded:
+        self._watcher.check()
+      else:
+        self._watcher.refresh()
+        self._loaded = True
+    return self._watcher.tokens()
+
+  def resolve(self, selector):
+    """Return slot of token matching the selector.
+
+    Args:
+      - selector(str | TokenSelector): Token selector (see module docstring)
+
+    Returns:
+      Slot id (int)
+
+    Raises:
+      - SmartCardNotPresentError: If no present token matches the selector
+      - SmartCardTransientError: If session for reading certificates could not
+        be opened
+    """
+    selector = parse_token_selector(selector)
+    tokens = self.tokens()
+    self._prune_fingerprints(tokens)
+    for slot, token in sorted(tokens.items()):
+      if self._matches(token, selector):
+        return slot
+    raise SmartCardNotPresentError('Please insert smart card with {} {}.'.format(*selector))
+
+  def invalidate(self):
+    """Read present tokens again on next lookup."""
+    with self._lock:
+      self._loaded = False
+      self._fingerprints.clear()
+
+  def _matches(self, token, selector):
+    if selector.kind == SERIAL:
+      return token.serial.lower() == selector.value.lower()
+    if selector.kind == LABEL:
+      return token.label == selector.value
+    return selector.value.lower() in self._token_fingerprints(token)
+
+  def _prune_fingerprints(self, tokens):
+    present = {(slot, token.serial) for slot, token in tokens.items()}
+    with self._lock:
+      for key in [key for key in self._fingerprints if key not in present]:
+        del self._fingerprints[key]
+
+  def _token_fingerprints(self, token):
+    key = (token.slot, token.serial)
+    with self._lock:
+      fingerprints = self._fingerprints.get(key)
+    if fingerprints is not None:
+      return fingerprints
+
+    from PyKCS11 import CKA_CLASS, CKA_VALUE, CKF_SERIAL_SESSION, CKO_CERTIFICATE, PyKCS11Error
+
+    try:
+      # Certificates are public objects, no login is needed
+      session = self.pkcs11.openSession(token.slot, CKF_SERIAL_SESSION)
+    except PyKCS11Error as e:
+      raise classify_error(e)
+    try:
+      fingerprints = frozenset(
+          hashlib.sha256(bytes(session.getAttributeValue(cert, [CKA_VALUE])[0])).hexdigest()
+          for cert in session.findObjects([(CKA_CLASS, CKO_CERTIFICATE)]))
+    except PyKCS11Error as e:
+      logger.debug('Could not read certificates of token in slot %s: %s', token.slot, e)
+      return frozenset()
+    finally:
+      session.closeSession()
+
+    with self._lock:
+      self._fingerprints[key] = fingerprints
+    return fingerprints
+
+
+_RESOLVER = None
+_RESOLVER_LOCK = threading.Lock()
+
+
+def get_slot_resolver(pkcs11):
+  """Return slot resolver of PyKCS11 library (created on first use)."""
+  global _RESOLVER
+  with _RESOLVER_LOCK:
+    if _RESOLVER is None or _RESOLVER.pkcs11 is not pkcs11:
+      _RESOLVER = SlotResolver(pkcs11)
+    return _RESOLVER
+
+
+def resolve_slot(pkcs11, token=None):
+  """Return slot of selected token, or of the first present token if selector
+  is None.
+
+  Args:
+    - pkcs11(PyKCS11): PyKCS11Lib instance
+    - token(str | TokenSelector): Token selector (see module docstring)
+
+  Raises:
+    - SmartCardNotPresentError: If selected token is not inserted
+  """
+  if token is None:
+    slots = pkcs11.getSlotList(tokenPresent=True)
+    if not slots:
+      raise SmartCardNotPresentError('Please insert your smart card.')
+    return slots[0]
+  return get_slot_resolver(pkcs11).resolve(token)
+
+
+def _after_fork_in_child():
+  """Slot map of the parent's library is not valid in the child."""
+  global _RESOLVER, _RESOLVER_LOCK
+  _RESOLVER = None
+  _RESOLVER_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork_in_child)
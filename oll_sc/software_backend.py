@@ -0,0 +1,259 @@
+"""Software signing backend for CI and bulk non-production signing.
+
+Keys are PEM files in a directory, named after hex encoded key id:
+  key-01.pem   private key of key id (1,); PIN is its password if encrypted
+  cert-01.pem  optional x509 certificate of key id (1,)
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, utils
+from PyKCS11 import (CKG_MGF1_SHA256, CKG_MGF1_SHA384, CKG_MGF1_SHA512,
+                     CKM_ECDSA, CKM_ECDSA_SHA256, CKM_ECDSA_SHA384,
+                     CKM_ECDSA_SHA512, CKM_RSA_PKCS_PSS, CKM_SHA256,
+                     CKM_SHA256_RSA_PKCS_PSS, CKM_SHA384,
+                     CKM_SHA384_RSA_PKCS_PSS, CKM_SHA512,
+                     CKM_SHA512_RSA_PKCS_PSS)
+
+from .api import (ECDSA_MECHANISM, P256_SIGNATURE_SIZE,
+                  RSA_PKCS_PSS_SHA256_MECHANISM,
+                  RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM, SIGNATURE_DER,
+                  SIGNATURE_ENCODINGS, ecdsa_signature_to_der,
+                  ecdsa_signature_to_raw)
+from .backends import KEYS_DIR_ENV, Backend
+from .exceptions import (SmartCardFindKeyObjectError, SmartCardSigningError,
+                         SmartCardWrongPinError)
+from .hashing import CHUNK_SIZE, iter_chunks, sha256_digest
+
+logger = logging.getLogger(__name__)
+
+# Batches of at least this many items are signed in a process pool
+PROCESS_POOL_THRESHOLD = 64
+
+_HASHES = {CKM_SHA256: 'SHA256', CKM_SHA384: 'SHA384', CKM_SHA512: 'SHA512'}
+_MGF_HASHES = {CKG_MGF1_SHA256: 'SHA256', CKG_MGF1_SHA384: 'SHA384', CKG_MGF1_SHA512: 'SHA512'}
+_PSS_MECHANISMS = (CKM_SHA256_RSA_PKCS_PSS, CKM_SHA384_RSA_PKCS_PSS, CKM_SHA512_RSA_PKCS_PSS)
+# Digest size -> hash of digests signed with CKM_ECDSA
+_ECDSA_DIGEST_HASHES = {32: hashes.SHA256, 48: hashes.SHA384, 64: hashes.SHA512}
+# ECDSA mechanisms which digest data -> hash
+_ECDSA_HASHES = {CKM_ECDSA_SHA256: hashes.SHA256, CKM_ECDSA_SHA384: hashes.SHA384,
+                 CKM_ECDSA_SHA512: hashes.SHA512}
+
+
+def _pss_params(mechanism):
+  """Return picklable (prehashed, hash name, MGF1 hash name, salt length) of
+  PyKCS11 RSA PSS mechanism or None if it is not supported."""
+  try:
+    mech_type = mechanism._mech.mechanism
+    param = mechanism._param
+    params = (mech_type == CKM_RSA_PKCS_PSS, _HASHES[param.hashAlg], _MGF_HASHES[param.mgf],
+              param.sLen)
+  except (AttributeError, KeyError):
+    return None
+  if mech_type != CKM_RSA_PKCS_PSS and mech_type not in _PSS_MECHANISMS:
+    return None
+  return params
+
+
+@lru_cache(maxsize=16)
+def _load_private_key(pem, password):
+  """Parse PEM private key; parsed keys are kept for repeated signing.
+
+  Raises:
+    - SmartCardWrongPinError: If key is encrypted and password is not valid
+  """
+  if b'ENCRYPTED' not in pem:
+    password = None
+  try:
+    return serialization.load_pem_private_key(pem, password, default_backend())
+  except (TypeError, ValueError):
+    raise SmartCardWrongPinError('PIN is not valid.')
+
+
+def _sign(private_key, data, params):
+  prehashed, hash_name, mgf_hash_name, salt_length = params
+  algorithm = getattr(hashes, hash_name)()
+  pss = padding.PSS(padding.MGF1(getattr(hashes, mgf_hash_name)()), salt_length)
+  if prehashed:
+    return private_key.sign(data, pss, utils.Prehashed(algorithm))
+  return private_key.sign(data, pss, algorithm)
+
+
+def _sign_chunk(pem, password, params, data_items):
+  """Sign list of data items; run in process pool workers."""
+  private_key = _load_private_key(pem, password)
+  signatures = []
+  for data in data_items:
+    try:
+      signatures.append(_sign(private_key, data, params))
+    except (TypeError, ValueError):
+      # Failed item (e.g. not bytes) does not abort the batch
+      signatures.append(None)
+  return signatures
+
+
+class SoftwareBackend(Backend):
+  """Signs with PEM keys loaded from disk using `cryptography`.
+
+  Large batches of `sign_many` are signed across a process pool.
+  """
+
+  def __init__(self, keys_dir, processes=None):
+    """
+    Args:
+      - keys_dir(str | pathlib.Path): Directory with keys (see module docstring)
+      - processes(int): Worker processes of `sign_many`; defaults to number of CPUs
+    """
+    self.keys_dir = Path(keys_dir)
+    self.processes = processes or os.cpu_count() or 1
+
+  @classmethod
+  def from_env(cls):
+    """Create backend for keys directory in `OLL_SC_KEYS_DIR`."""
+    keys_dir = os.environ.get(KEYS_DIR_ENV)
+    if not keys_dir:
+      raise ValueError('{} is not set.'.format(KEYS_DIR_ENV))
+    return cls(keys_dir)
+
+  def _read(self, prefix, key_id):
+    path = self.keys_dir / '{}-{}.pem'.format(prefix, bytes(key_id).hex())
+    try:
+      return path.read_bytes()
+    except OSError:
+      raise SmartCardFindKeyObjectError(key_id)
+
+  def _private_key_pem(self, key_id, pin):
+    """Return PEM of private key and password used to load it."""
+    pem = self._read('key', key_id)
+    password = pin.encode() if isinstance(pin, str) else pin
+    # Fail on wrong PIN before anything is signed
+    _load_private_key(pem, password)
+    return pem, password
+
+  def is_present(self):
+    return self.keys_dir.is_dir()
+
+  def export_pub_key_pem(self, key_id, pin):
+    pem, password = self._private_key_pem(key_id, pin)
+    return _load_private_key(pem, password).public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+  def export_x509_pem(self, key_id, pin):
+    try:
+      cert = x509.load_pem_x509_certificate(self._read('cert', key_id), default_backend())
+    except ValueError:
+      raise SmartCardFindKeyObjectError(key_id)
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+  def sign_rsa(self, data, mechanism, key_id, pin):
+    if isinstance(data, str):
+      data = data.encode()
+    pem, password = self._private_key_pem(key_id, pin)
+    params = _pss_params(mechanism)
+    if params is None:
+      raise SmartCardSigningError(data)
+    signature, = _sign_chunk(pem, password, params, [data])
+    if signature is None:
+      raise SmartCardSigningError(data)
+    return signature
+
+  def sign_rsa_pkcs_pss_sha256(self, data, key_id, pin):
+    return self.sign_rsa(data, RSA_PKCS_PSS_SHA256_MECHANISM, key_id, pin)
+
+  def sign_rsa_pkcs_pss_sha256_prehash(self, data, key_id, pin, chunk_size=CHUNK_SIZE):
+    return self.sign_rsa(sha256_digest(data, chunk_size), RSA_PKCS_PSS_SHA256_PREHASH_MECHANISM,
+                         key_id, pin)
+
+  def sign_stream(self, data, mechanism, key_id, pin, chunk_size=CHUNK_SIZE):
+    """Hash data in chunks and sign the digest. RSA PSS mechanisms which digest
+    data (e.g. CKM_SHA256_RSA_PKCS_PSS) and ECDSA ones (e.g. CKM_ECDSA_SHA256,
+    r || s is returned) are supported. Like in `oll_sc.api.sc_sign_stream`,
+    errors carry size and SHA256 of data read so far."""
+    pem, password = self._private_key_pem(key_id, pin)
+    private_key = _load_private_key(pem, password)
+    mech_type = getattr(getattr(mechanism, '_mech', None), 'mechanism', None)
+    is_ec_key = isinstance(private_key, ec.EllipticCurvePrivateKey)
+    params = _pss_params(mechanism)
+    if is_ec_key and mech_type in _ECDSA_HASHES:
+      algorithm = _ECDSA_HASHES[mech_type]()
+    elif not is_ec_key and params is not None and not params[0]:
+      algorithm = getattr(hashes, params[1])()
+    else:
+      raise SmartCardSigningError()
+
+    hasher = hashes.Hash(algorithm, default_backend())
+    summary, size = hashlib.sha256(), 0
+    for chunk in iter_chunks(data, chunk_size):
+      hasher.update(chunk)
+      summary.update(chunk)
+      size += len(chunk)
+    digest = hasher.finalize()
+
+    if is_ec_key:
+      signature = private_key.sign(digest, ec.ECDSA(utils.Prehashed(algorithm)))
+      return ecdsa_signature_to_raw(signature, (private_key.curve.key_size + 7) // 8)
+    signature, = _sign_chunk(pem, password, (True,) + params[1:], [digest])
+    if signature is None:
+      raise SmartCardSigningError(size=size, digest=summary.hexdigest())
+    return signature
+
+  def sign_rsa_pkcs_pss_sha256_stream(self, data, key_id, pin, chunk_size=CHUNK_SIZE):
+    return self.sign_stream(data, RSA_PKCS_PSS_SHA256_MECHANISM, key_id, pin, chunk_size)
+
+  def sign_ecdsa(self, data, mechanism, key_id, pin):
+    """Sign digest with EC key; only CKM_ECDSA mechanism is supported."""
+    if isinstance(data, str):
+      data = data.encode()
+    pem, password = self._private_key_pem(key_id, pin)
+    private_key = _load_private_key(pem, password)
+    mech_type = getattr(getattr(mechanism, '_mech', None), 'mechanism', None)
+    if not isinstance(private_key, ec.EllipticCurvePrivateKey) or mech_type != CKM_ECDSA or \
+       len(data) not in _ECDSA_DIGEST_HASHES:
+      raise SmartCardSigningError(data)
+    signature = private_key.sign(data, ec.ECDSA(utils.Prehashed(_ECDSA_DIGEST_HASHES[len(data)]())))
+    return ecdsa_signature_to_raw(signature, (private_key.curve.key_size + 7) // 8)
+
+  def sign_ecdsa_p256_sha256(self, data, key_id, pin, encoding=SIGNATURE_DER,
+                             chunk_size=CHUNK_SIZE):
+    if encoding not in SIGNATURE_ENCODINGS:
+      raise ValueError('Unknown signature encoding {}.'.format(encoding))
+    digest = sha256_digest(data, chunk_size)
+    signature = self.sign_ecdsa(digest, ECDSA_MECHANISM, key_id, pin)
+    if len(signature) != P256_SIGNATURE_SIZE:
+      raise SmartCardSigningError(digest)
+    return ecdsa_signature_to_der(signature) if encoding == SIGNATURE_DER else signature
+
+  def sign_many(self, data_items, key_id, pin, mechanism=RSA_PKCS_PSS_SHA256_MECHANISM):
+    """Sign data items, across a process pool if there are at least
+    `PROCESS_POOL_THRESHOLD` of them. Like `oll_sc.api.sc_sign_many`, returns
+    generator of signatures in which failed items are SmartCardSigningError
+    instances."""
+    pem, password = self._private_key_pem(key_id, pin)
+    data_items = [data.encode() if isinstance(data, str) else data for data in data_items]
+    params = _pss_params(mechanism)
+    if params is None:
+      for data in data_items:
+        yield SmartCardSigningError(data)
+      return
+
+    if self.processes == 1 or len(data_items) < PROCESS_POOL_THRESHOLD:
+      for data, signature in zip(data_items, _sign_chunk(pem, password, params, data_items)):
+        yield signature if signature is not None else SmartCardSigningError(data)
+      return
+
+    chunk_size = -(-len(data_items) // (self.processes * 4))
+    chunks = [data_items[i:i + chunk_size] for i in range(0, len(data_items), chunk_size)]
+    with ProcessPoolExecutor(max_workers=self.processes) as executor:
+      results = executor.map(_sign_chunk, *zip(*[(pem, password, params, chunk)
+                                                 for chunk in chunks]))
+      # Signatures of a chunk are yielded as soon as it is signed
+      for chunk, signatures in zip(chunks, results):
+        for data, signature in zip(chunk, signatures):
+          yield signature if signature is not None else SmartCardSigningError(data)
@@ -0,0 +1,225 @@
+"""Signing of TUF metadata.
+
+Metadata of all roles is canonicalized (in a process pool for large sets), the
+TUF keyid of the signing key is computed once and all roles are signed in one
+token session. Signatures are returned as securesystemslib style entries,
+`{'keyid': ..., 'sig': ...}`, ready to be embedded in role metadata:
+
+  result = sc_sign_tuf_metadata({'root': root, 'targets': targets}, (1,), pin)
+  for role, entry in result.signatures.items():
+    embed_signature(metadata[role], entry)
+"""
+import hashlib
+import logging
+import os
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+from .api import sc_export_pub_key_pem, sc_sign_many
+
+logger = logging.getLogger(__name__)
+
+KEY_TYPE = 'rsa'
+SCHEME = 'rsassa-pss-sha256'
+# Hash algorithms listed in key metadata by securesystemslib
+KEYID_HASH_ALGORITHMS = ('sha256', 'sha512')
+
+# Sets of at least this many roles are canonicalized in a process pool
+CANONICALIZE_PROCESS_POOL_THRESHOLD = 64
+
+TufSigningResult = namedtuple('TufSigningResult', ['keyid', 'signatures', 'timings'])
+
+
+def _encode_canonical(obj, parts):
+  if isinstance(obj, str):
+    parts.append('"' + obj.replace('\\', '\\\\').replace('"', '\\"') + '"')
+  elif obj is True:
+    parts.append('true')
+  elif obj is False:
+    parts.append('false')
+  elif obj is None:
+    parts.append('null')
+  elif isinstance(obj, int):
+    parts.append(str(obj))
+  elif isinstance(obj, (list, tuple)):
+    parts.append('[')
+    for index, item in enumerate(obj):
+      if index:
+        parts.append(',')
+      _encode_canonical(item, parts)
+    parts.append(']')
+  elif isinstance(obj, dict):
+    parts.append('{')
+    for index, key in enumerate(sorted(obj)):
+      if not isinstance(key, str):
+        raise ValueError('Canonical JSON keys must be strings, got {!r}.'.format(key))
+      if index:
+        parts.append(',')
+      _encode_canonical(key, parts)
+      parts.append(':')
+      _encode_canonical(obj[key], parts)
+    parts.append('}')
+  else:
+    raise ValueError('{!r} cannot be encoded in canonical JSON.'.format(obj))
+
+
+def encode_canonical(obj):
+  """Return canonical JSON (as used by TUF and securesystemslib) of an object.
+
+  Args:
+    - obj(dict | list | str | int | bool | None): Object to be encoded; floats are
+      not allowed
+
+  Returns:
+    UTF-8 encoded canonical JSON (bytes)
+
+  Raises:
+    - ValueError: If object cannot be encoded
+  """
+  parts = []
+  _encode_canonical(obj, parts)
+  return ''.join(parts).encode('utf-8')
+
+
+def _signed_part(metadata):
+  """Return `signed` part of full role metadata, or metadata itself."""
+  if isinstance(metadata, dict) and 'signed' in metadata:
+    return metadata['signed']
+  return metadata
+
+
+def _canonicalize_chunk(items):
+  """Canonicalize list of (role, metadata); run in process pool workers.
+  Returns list of (role, canonical bytes, seconds)."""
+  results = []
+  for role, metadata in items:
+    start = time.perf_counter()
+    data = encode_canonical(_signed_part(metadata))
+    results.append((role, data, time.perf_counter() - start))
+  return results
+
+
+def canonicalize_roles(roles, processes=None,
+                       process_pool_threshold=CANONICALIZE_PROCESS_POOL_THRESHOLD):
+  """Canonicalize `signed` part of metadata of many roles.
+
+  Args:
+    - roles(dict): Role name -> role metadata (full metadata or its `signed` part)
+    - processes(int): Number of worker processes; defaults to number of CPUs
+    - process_pool_threshold(int): Minimum number of roles canonicalized in a
+      process pool
+
+  Returns:
+    List of (role, canonical JSON (bytes), seconds spent), in order of roles
+
+  Raises:
+    - ValueError: If metadata cannot be encoded in canonical JSON
+  """
+  items = list(roles.items())
+  processes = processes or os.cpu_count() or 1
+  if processes == 1 or len(items) < process_pool_threshold:
+    return _canonicalize_chunk(items)
+
+  from concurrent.futures import ProcessPoolExecutor
+
+  chunk_size = -(-len(items) // (processes * 4))
+  chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+  with ProcessPoolExecutor(max_workers=processes) as executor:
+    return [result for chunk in executor.map(_canonicalize_chunk, chunks) for result in chunk]
+
+
+@lru_cache(maxsize=64)
+def _keyid(public_pem, hash_algorithms):
+  key_meta = {
+      'keytype': KEY_TYPE,
+      'scheme': SCHEME,
+      'keyid_hash_algorithms': list(hash_algorithms),
+      'keyval': {'public': public_pem.strip()},
+  }
+  return hashlib.sha256(encode_canonical(key_meta)).hexdigest()
+
+
+def tuf_keyid(public_pem, hash_algorithms=KEYID_HASH_ALGORITHMS):
+  """Return TUF keyid of RSA public key, computed like securesystemslib does.
+  Keyids are cached per public key.
+
+  Args:
+    - public_pem(bytes | str): Public key in PEM format
+    - hash_algorithms(tuple): `keyid_hash_algorithms` of key metadata
+
+  Returns:
+    Keyid (str)
+  """
+  if isinstance(public_pem, bytes):
+    public_pem = public_pem.decode()
+  return _keyid(public_pem, tuple(hash_algorithms))
+
+
+def embed_signature(metadata, entry):
+  """Add signature entry to full role metadata, replacing signature of the same
+  keyid.
+
+  Args:
+    - metadata(dict): Role metadata with `signed` and `signatures`
+    - entry(dict): Signature entry returned by `sc_sign_tuf_metadata`
+  """
+  signatures = [signature for signature in metadata.get('signatures', [])
+                if signature.get('keyid') != entry['keyid']]
+  signatures.append(entry)
+  metadata['signatures'] = signatures
+
+
+def sc_sign_tuf_metadata(roles, key_id, pin, public_pem=None, processes=None,
+                         hash_algorithms=KEYID_HASH_ALGORITHMS, token=None, pkcs11=None):
+  """Sign metadata of many TUF roles in one token session.
+
+  Args:
+    - roles(dict): Role name -> role metadata (full metadata or its `signed` part)
+    - key_id(tuple): Key ID as tuple (e.g. (1,))
+    - pin(str): Pin for session login
+    - public_pem(bytes | str): Public key of key id in PEM format; exported from
+      the token if None (without login if export cache is enabled)
+    - processes(int): Processes canonicalizing large sets of roles
+    - hash_algorithms(tuple): `keyid_hash_algorithms` used to compute keyid
+    - token(str): Token selector (e.g. 'serial:...', see `oll_sc.slot_resolver`);
+      first token if None
+    - pkcs11(PyKCS11): Automatically initialied; do not pass this argument
+
+  Returns:
+    TufSigningResult(keyid, signatures, timings), where signatures maps role
+    names to `{'keyid': ..., 'sig': ...}` entries and timings maps role names to
+    `{'canonicalize': seconds, 'sign': seconds}`; sign time of the first role
+    includes opening of the session
+
+  Raises:
+    - ValueError: If metadata cannot be encoded in canonical JSON
+    - SmartCardNotPresentError: If smart card is not inserted
+    - SmartCardWrongPinError: If pin is incorrect
+    - SmartCardFindKeyObjectError: If key for given key id does not exist
+    - SmartCardSigningError: If metadata of a role could not be signed
+  """
+  canonical = canonicalize_roles(roles, processes)
+  if public_pem is None:
+    public_pem = sc_export_pub_key_pem(key_id, pin, token=token, pkcs11=pkcs11)
+  keyid = tuf_keyid(public_pem, hash_algorithms)
+
+  signatures = {}
+  timings = {role: {'canonicalize': seconds} for role, _, seconds in canonical}
+  signed = iter(sc_sign_many([data for _, data, _ in canonical], key_id, pin, token=token,
+                             pkcs11=pkcs11))
+  try:
+    start = time.perf_counter()
+    for (role, _, _), signature in zip(canonical, signed):
+      timings[role]['sign'] = time.perf_counter() - start
+      if isinstance(signature, Exception):
+        raise signature
+      signatures[role] = {'keyid': keyid, 'sig': signature.hex()}
+      logger.debug('Signed %s metadata in %.3fs.', role, timings[role]['sign'])
+      start = time.perf_counter()
+  finally:
+    # Ends the signing session if a role failed
+    close = getattr(signed, 'close', None)
+    if close is not None:
+      close()
+  return TufSigningResult(keyid, signatures, timings)
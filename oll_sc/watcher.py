@@ -0,0 +1,225 @@
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from . import get_pkcs11
+from .session_pool import get_session_pool
+
+logger = logging.getLogger(__name__)
+
+Token = namedtuple('Token', ['slot', 'serial', 'label'])
+
+# Upper bound of slot events read in one check (guards against libraries which
+# keep reporting the same event)
+_MAX_EVENTS = 64
+
+
+class TokenWatcher:
+  """Keeps snapshot of present tokens up to date on a background thread.
+
+  Every `interval` seconds slot events are read with non-blocking
+  `C_WaitForSlotEvent` and slots are listed again only if an event occurred. If
+  the library does not support slot events, present slots are listed every
+  interval instead. Blocking `C_WaitForSlotEvent` is not used, because it could
+  not be interrupted when watcher is stopped.
+
+  Usage:
+    watcher = TokenWatcher(pkcs11)
+    watcher.subscribe(on_remove=lambda token: ...)
+    watcher.start()
+  """
+
+  def __init__(self, pkcs11, interval=0.2):
+    """
+    Args:
+      - pkcs11(PyKCS11): PyKCS11Lib instance
+      - interval(float): Seconds between checks
+    """
+    self.pkcs11 = pkcs11
+    self.interval = interval
+    self.slot_events = True
+    self._tokens = {}  # slot -> Token
+    self._subscribers = []
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def start(self):
+    """Read present tokens and start watching them."""
+    self.refresh()
+    self._thread = threading.Thread(target=self._run, name='oll-sc-token-watcher', daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    """Stop watching and wait for the background thread."""
+    self._stopped.set()
+    if self._thread is not None and self._thread is not threading.current_thread():
+      self._thread.join(timeout)
+
+  def is_present(self):
+    """Return True if a token is present in any slot (bool)."""
+    return bool(self._tokens)
+
+  def tokens(self):
+    """Return snapshot of present tokens (dict of slot -> Token)."""
+    with self._lock:
+      return dict(self._tokens)
+
+  def subscribe(self, on_insert=None, on_remove=None):
+    """Call `on_insert(token)` and `on_remove(token)` on the watcher's thread when
+    a token is inserted or removed.
+
+    Returns:
+      Subscription to be passed to `unsubscribe`
+    """
+    subscription = (on_insert, on_remove)
+    with self._lock:
+      self._subscribers.append(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription):
+    with self._lock:
+      self._subscribers.remove(subscription)
+
+  def refresh(self):
+    """List present slots and read token info of all of them."""
+    self._refresh(reread=True)
+
+  def check(self):
+    """Check for slot events and update snapshot; called by background thread."""
+    if not self.slot_events:
+      self._refresh(reread=False)
+      return
+
+    from PyKCS11 import CKF_DONT_BLOCK, CKR_NO_EVENT, PyKCS11Error
+
+    events = 0
+    changed = set()
+    try:
+      while events < _MAX_EVENTS:
+        changed.add(self.pkcs11.waitForSlotEvent(CKF_DONT_BLOCK))
+        events += 1
+    except PyKCS11Error as e:
+      if e.value != CKR_NO_EVENT:
+        logger.debug('Slot events are not supported (%s), polling slots.', e)
+        self.slot_events = False
+        events += 1
+    if events:
+      self._refresh(reread=True, changed=changed)
+
+  def _run(self):
+    while not self._stopped.wait(self.interval):
+      try:
+        self.check()
+      except Exception:  # pylint: disable=broad-except
+        logger.exception('Token watcher check failed.')
+
+  def _refresh(self, reread, changed=()):
+    """List present slots and read token info of new (or all if `reread`) slots.
+
+    Token of a slot in `changed` (slots with an event) is reported as removed
+    and inserted again even if its info did not change, since the same token
+    could have been removed and reinserted between two checks.
+    """
+    from PyKCS11 import PyKCS11Error
+
+    try:
+      slots = set(self.pkcs11.getSlotList(tokenPresent=True))
+    except PyKCS11Error as e:
+      logger.debug('Could not list slots: %s', e)
+      return
+
+    with self._lock:
+      previous = dict(self._tokens)
+    current = {}
+    for slot in slots:
+      token = previous.get(slot)
+      if token is None or reread:
+        try:
+          info = self.pkcs11.getTokenInfo(slot)
+        except PyKCS11Error:
+          # Token was removed meanwhile
+          continue
+        token = Token(slot, info.serialNumber.strip(), info.label.strip())
+      current[slot] = token
+
+    removed = [token for slot, token in previous.items()
+               if slot in changed or current.get(slot) != token]
+    inserted = [token for slot, token in current.items()
+                if slot in changed or previous.get(slot) != token]
+    with self._lock:
+      self._tokens = current
+      subscribers = list(self._subscribers)
+
+    for token in removed:
+      logger.debug('Token %s removed from slot %s', token.serial, token.slot)
+      self._notify([on_remove for _, on_remove in subscribers], token)
+    for token in inserted:
+      logger.debug('Token %s inserted in slot %s', token.serial, token.slot)
+      self._notify([on_insert for on_insert, _ in subscribers], token)
+
+  @staticmethod
+  def _notify(callbacks, token):
+    for callback in callbacks:
+      if callback is None:
+        continue
+      try:
+        callback(token)
+      except Exception:  # pylint: disable=broad-except
+        logger.exception('Token watcher callback %r failed.', callback)
+
+
+def _drop_cached_state(token):
+  """Invalidate pooled sessions of removed token, which also drops their cached
+  object handles."""
+  pool = get_session_pool()
+  if pool is not None:
+    pool.invalidate(token.slot)
+
+
+_WATCHER = None
+
+
+def get_token_watcher():
+  """Return running token watcher or None."""
+  return _WATCHER
+
+
+def start_token_watcher(interval=0.2, pkcs11=None):
+  """Start watching tokens of the process-wide PyKCS11 lib. While watcher runs,
+  `oll_sc.api.sc_is_present` reads its snapshot, and pooled sessions and cached
+  object handles of removed tokens are dropped.
+
+  Args:
+    - interval(float): Seconds between checks
+    - pkcs11(PyKCS11): Library to watch; process-wide instance if None
+
+  Returns:
+    TokenWatcher instance
+  """
+  global _WATCHER
+  stop_token_watcher()
+  watcher = TokenWatcher(pkcs11 or get_pkcs11(), interval)
+  watcher.subscribe(on_remove=_drop_cached_state)
+  _WATCHER = watcher.start()
+  return watcher
+
+
+def stop_token_watcher():
+  """Stop token watcher started by `start_token_watcher`."""
+  global _WATCHER
+  watcher, _WATCHER = _WATCHER, None
+  if watcher is not None:
+    watcher.stop()
+
+
+def _after_fork_in_child():
+  """Watcher thread does not exist in the child process."""
+  global _WATCHER
+  _WATCHER = None
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork_in_child)
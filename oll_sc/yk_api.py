@@ -1,51 +1,79 @@
 import datetime
+import logging
+import time
 from binascii import a2b_hex
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from cryptography.hazmat.primitives import serialization
-from ykman.descriptor import open_device
+from ykman.descriptor import list_devices, open_device
 from ykman.piv import (ALGO, PIN_POLICY, SLOT, PivController,
                        generate_random_management_key)
 from ykman.util import TRANSPORT
 
+from .export_cache import invalidate_export_cache
+from .object_cache import get_object_cache
+
 DEFAULT_PIN = '123456'
 DEFAULT_PUK = '12345678'
 DEFAULT_MANAGEMENT_KEY = a2b_hex('010203040506070801020304050607080102030405060708')
 
+RSA2048 = 'rsa2048'
+ECCP256 = 'eccp256'
+# Key type -> PIV algorithm of generated key; ECC P-256 keys sign several times
+# faster than RSA 2048 keys and have smaller signatures
+KEY_TYPES = {RSA2048: ALGO.RSA2048, ECCP256: ALGO.ECCP256}
+
+logger = logging.getLogger(__name__)
+
+# Result of provisioning one device by `yk_setup_all`; error is None on success,
+# pub_key_pem and mgm_key (management key set on the device) are None on failure
+YkSetupReport = namedtuple('YkSetupReport',
+                           ['serial', 'pub_key_pem', 'mgm_key', 'elapsed', 'error'])
+
 
 @contextmanager
-def _yk():
-  yk = open_device(transports=TRANSPORT.CCID)
-  yield yk
-  yk.close()
+def _yk(serial=None):
+  yk = open_device(transports=TRANSPORT.CCID, serial=serial)
+  try:
+    yield yk
+  finally:
+    yk.close()
 
 
 @contextmanager
-def _yk_piv_ctrl():
-  yk = open_device(transports=TRANSPORT.CCID)
-  yield PivController(yk.driver)
-  yk.close()
+def _yk_piv_ctrl(serial=None):
+  with _yk(serial) as yk:
+    yield PivController(yk.driver)
 
 
-def yk_setup(pin, cert_cn, cert_exp_days=365, pin_retries=10, mgm_key=generate_random_management_key()):
-  """Use to setup inserted Yubikey, with following steps (order is important):
-      - reset to factory settings
-      - set management key
-      - generate key(RSA2048)
-      - generate and import self-signed certificate(X509)
-      - set pin retries
-      - set pin
-      - set puk(same as pin)
-  """
-  with _yk_piv_ctrl() as ctrl:
+def _invalidate_caches():
+  # Cached key handles, values and exports belong to the replaced key
+  object_cache = get_object_cache()
+  if object_cache is not None:
+    object_cache.invalidate()
+  invalidate_export_cache()
+
+
+def _algorithm(key_type):
+  try:
+    return KEY_TYPES[key_type]
+  except KeyError:
+    raise ValueError('Unknown key type {}.'.format(key_type))
+
+
+def _setup_device(pin, cert_cn, cert_exp_days, pin_retries, mgm_key, serial, key_type):
+  algorithm = _algorithm(key_type)
+  with _yk_piv_ctrl(serial) as ctrl:
     # Factory reset and set PINs
     ctrl.reset()
 
     ctrl.authenticate(DEFAULT_MANAGEMENT_KEY)
     ctrl.set_mgm_key(mgm_key)
 
-    # Generate RSA2048
-    pub_key = ctrl.generate_key(SLOT.SIGNATURE, ALGO.RSA2048, PIN_POLICY.ALWAYS)
+    # Generate RSA2048 or ECCP256
+    pub_key = ctrl.generate_key(SLOT.SIGNATURE, algorithm, PIN_POLICY.ALWAYS)
 
     ctrl.authenticate(mgm_key)
     ctrl.verify(DEFAULT_PIN)
@@ -65,6 +93,102 @@ def yk_setup(pin, cert_cn, cert_exp_days=365, pin_retries=10, mgm_key=generate_r
   )
 
 
+def yk_setup(pin, cert_cn, cert_exp_days=365, pin_retries=10, mgm_key=None, serial=None,
+             key_type=RSA2048):
+  """Use to setup inserted Yubikey, with following steps (order is important):
+      - reset to factory settings
+      - set management key
+      - generate key(RSA2048 or ECCP256)
+      - generate and import self-signed certificate(X509)
+      - set pin retries
+      - set pin
+      - set puk(same as pin)
+
+  Args:
+    - mgm_key(bytes): Management key; new random key is generated if None.
+      Generated key is not returned, pass a key to be able to manage the device
+      later.
+    - serial(int): Serial number of device; the only inserted device if None
+    - key_type(str): RSA2048 or ECCP256 (sign with `sc_sign_ecdsa_p256_sha256`)
+
+  Returns:
+    Public key in PEM format (bytes)
+
+  Raises:
+    - ValueError: If key type is not known
+  """
+  if mgm_key is None:
+    mgm_key = generate_random_management_key()
+  pub_key_pem = _setup_device(pin, cert_cn, cert_exp_days, pin_retries, mgm_key, serial,
+                              key_type)
+  _invalidate_caches()
+  return pub_key_pem
+
+
+def _timed_setup(pin, cert_cn, cert_exp_days, pin_retries, mgm_key, serial, key_type):
+  start = time.perf_counter()
+  if mgm_key is None:
+    # Every device gets its own random management key
+    mgm_key = generate_random_management_key()
+  try:
+    pub_key_pem = _setup_device(pin, cert_cn, cert_exp_days, pin_retries, mgm_key, serial,
+                                key_type)
+    error = None
+  except Exception as e:  # pylint: disable=broad-except
+    logger.error('Setup of Yubikey %s failed: %s', serial, e)
+    pub_key_pem, mgm_key, error = None, None, str(e) or type(e).__name__
+  return YkSetupReport(serial, pub_key_pem, mgm_key, time.perf_counter() - start, error)
+
+
+def yk_setup_all(pin, cert_cn, cert_exp_days=365, pin_retries=10, serials=None,
+                 key_type=RSA2048, mgm_key=None):
+  """Setup all inserted Yubikeys concurrently, one worker per device. Steps are
+  the same as in `yk_setup`.
+
+  Args:
+    - serials(list of int): Serial numbers of devices; all inserted devices if None
+    - key_type(str): RSA2048 or ECCP256
+    - mgm_key(bytes): Management key of all devices; every device gets a new
+      random key if None
+
+  Returns:
+    List of YkSetupReport(serial, pub_key_pem, mgm_key, elapsed, error), in
+    order of serial numbers. Failure of one device does not stop setup of the
+    others.
+
+  Raises:
+    - ValueError: If key type is not known
+  """
+  _algorithm(key_type)
+  if serials is None:
+    serials = yk_serial_nums()
+  if not serials:
+    return []
+
+  with ThreadPoolExecutor(max_workers=len(serials)) as executor:
+    reports = list(executor.map(
+        lambda serial: _timed_setup(pin, cert_cn, cert_exp_days, pin_retries, mgm_key, serial,
+                                    key_type),
+        serials))
+  _invalidate_caches()
+  return reports
+
+
 def yk_serial_num():
   with _yk() as yk:
     return yk.serial
+
+
+def yk_serial_nums():
+  """Return serial numbers of all inserted Yubikeys (list of int)."""
+  serials = []
+  for yk in list_devices(transports=TRANSPORT.CCID):
+    try:
+      if yk.serial is None:
+        # Device cannot be opened by serial number, so it cannot be set up in fleet mode
+        logger.warning('Skipping Yubikey without visible serial number.')
+      else:
+        serials.append(yk.serial)
+    finally:
+      yk.close()
+  return sorted(serials)
@@ -1,15 +1,104 @@
 # Fake pkcs11 classes for simulation
+import hashlib
 import pickle
+import threading
+import time
 from pathlib import Path
 
-from PyKCS11 import (CKA_ALWAYS_AUTHENTICATE, CKO_CERTIFICATE, CKO_PRIVATE_KEY,
-                     CKO_PUBLIC_KEY, PyKCS11Error)
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+from PyKCS11 import (CK_SESSION_INFO, CK_TOKEN_INFO, CKA_ALWAYS_AUTHENTICATE,
+                     CKA_CERTIFICATE_TYPE, CKA_CLASS, CKA_EC_PARAMS,
+                     CKA_EC_POINT, CKA_ID, CKA_KEY_TYPE, CKA_LABEL,
+                     CKA_MODULUS_BITS, CKA_VALUE, CKC_X_509, CKK_EC, CKK_RSA,
+                     CKM_ECDSA, CKM_ECDSA_SHA256, CKM_RSA_PKCS_PSS,
+                     CKM_SHA256_RSA_PKCS_PSS, CKO_CERTIFICATE,
+                     CKO_PRIVATE_KEY, CKO_PUBLIC_KEY, CKR_DEVICE_ERROR,
+                     CKR_DEVICE_REMOVED, CKR_FUNCTION_NOT_SUPPORTED,
+                     CKR_KEY_TYPE_INCONSISTENT, CKR_MECHANISM_INVALID,
+                     CKR_NO_EVENT, CKR_OK, CKR_OPERATION_ACTIVE,
+                     CKR_OPERATION_NOT_INITIALIZED, CKR_PIN_INCORRECT,
+                     CKR_SESSION_HANDLE_INVALID, CKR_USER_NOT_LOGGED_IN,
+                     CKS_RW_PUBLIC_SESSION, CKS_RW_USER_FUNCTIONS,
+                     CKU_CONTEXT_SPECIFIC, PyKCS11Error)
 
-from .settings import VALID_KEY_ID, VALID_MECH, VALID_PIN
+from .settings import (EC_KEY_ID, TOKEN_SERIAL, VALID_KEY_ID, VALID_MECH,
+                       VALID_PIN)
+
+
+def _load_der(name):
+  with open(str(Path(__file__).parent / 'keys' / name), 'rb') as der:
+    return pickle.loads(der.read())
+
+
+# Key objects on the fake token and their attributes
+_OBJECTS = {
+    'cert': {
+        CKA_CLASS: CKO_CERTIFICATE,
+        CKA_ID: VALID_KEY_ID,
+        CKA_LABEL: 'Certificate for Digital Signature',
+        CKA_CERTIFICATE_TYPE: CKC_X_509,
+        CKA_VALUE: _load_der('x509_cert.cer'),
+    },
+    'pub_key': {
+        CKA_CLASS: CKO_PUBLIC_KEY,
+        CKA_ID: VALID_KEY_ID,
+        CKA_LABEL: 'SIGN pubkey',
+        CKA_KEY_TYPE: CKK_RSA,
+        CKA_MODULUS_BITS: 2048,
+        CKA_VALUE: _load_der('public_key.cer'),
+    },
+    'priv_key': {
+        CKA_CLASS: CKO_PRIVATE_KEY,
+        CKA_ID: VALID_KEY_ID,
+        CKA_LABEL: 'SIGN key',
+        CKA_ALWAYS_AUTHENTICATE: True,
+        CKA_KEY_TYPE: CKK_RSA,
+        CKA_MODULUS_BITS: 2048,
+    },
+}
+
+# Software key used to create real RSASSA-PSS signatures
+SIGNING_KEY = rsa.generate_private_key(65537, 2048, default_backend())
+PSS_PADDING = padding.PSS(padding.MGF1(hashes.SHA256()), 32)
+
+# Software key used to create real ECDSA signatures of `ec_key=True` tokens
+EC_SIGNING_KEY = ec.generate_private_key(ec.SECP256R1(), default_backend())
+_EC_POINT = EC_SIGNING_KEY.public_key().public_bytes(serialization.Encoding.X962,
+                                                     serialization.PublicFormat.UncompressedPoint)
+
+# ECDSA P-256 key objects; like on PIV tokens, public key has no CKA_VALUE
+_EC_OBJECTS = {
+    'ec_pub_key': {
+        CKA_CLASS: CKO_PUBLIC_KEY,
+        CKA_ID: EC_KEY_ID,
+        CKA_LABEL: 'SIGN EC pubkey',
+        CKA_KEY_TYPE: CKK_EC,
+        # DER of prime256v1 OID and DER OCTET STRING of uncompressed point
+        CKA_EC_PARAMS: tuple(bytes.fromhex('06082a8648ce3d030107')),
+        CKA_EC_POINT: tuple(bytes([0x04, len(_EC_POINT)]) + _EC_POINT),
+    },
+    'ec_priv_key': {
+        CKA_CLASS: CKO_PRIVATE_KEY,
+        CKA_ID: EC_KEY_ID,
+        CKA_LABEL: 'SIGN EC key',
+        CKA_ALWAYS_AUTHENTICATE: True,
+        CKA_KEY_TYPE: CKK_EC,
+    },
+}
+
+
+# Simulated duration (seconds) of token operations, see `PKCS11(latency=...)`;
+# 'sign_ec' is signing with the ECDSA key
+NO_LATENCY = {'open': 0, 'login': 0, 'find': 0, 'sign': 0, 'sign_ec': 0}
 
 
 def _is_valid_mechanism(mechanism):
-  return mechanism._mech.mechanism == VALID_MECH._mech.mechanism and \
+  if mechanism._mech.mechanism == CKM_ECDSA:
+    return True
+  return mechanism._mech.mechanism in (VALID_MECH._mech.mechanism, CKM_RSA_PKCS_PSS) and \
       mechanism._param.hashAlg == VALID_MECH._param.hashAlg and \
       mechanism._param.mgf == VALID_MECH._param.mgf and \
       mechanism._param.sLen == VALID_MECH._param.sLen
@@ -21,56 +110,135 @@ class _Session:
     https://github.com/LudovicRousseau/PyKCS11/blob/master/PyKCS11/__init__.py#L851
   """
 
-  def __init__(self, able_to_login=True):
+  def __init__(self, able_to_login=True, slot=0, token=None):
+    # Multi-part signing is called through low level API, like in PyKCS11
+    self.lib = self
+    self.session = id(self)
+    self._stream = None  # [key handle, mechanism type, SHA256 of data] while signing
+    self._stream_signature = None
     self._able_to_login = able_to_login
+    self._token = token
+    self._objects = token.objects if token is not None else _OBJECTS
+    self.slot = slot
+    self.removed = False
     self.logged_in = False
     self.session_closed = False
+    self.find_objects_calls = 0
 
   def closeSession(self):
     self.session_closed = True
 
-  def findObjects(self, *args):
-    # If key id is wrong, return empty list
-    if args[0][0][1] != VALID_KEY_ID:
-      return []
+  def getSessionInfo(self):
+    if self.session_closed:
+      raise PyKCS11Error(CKR_SESSION_HANDLE_INVALID)
+    info = CK_SESSION_INFO()
+    info.slotID = self.slot
+    info.state = CKS_RW_USER_FUNCTIONS if self.logged_in else CKS_RW_PUBLIC_SESSION
+    return info
 
-    return {
-        # Certificate
-        CKO_CERTIFICATE: ['cert'],
-        CKO_PUBLIC_KEY: ['pub_key'],
-        CKO_PRIVATE_KEY: ['priv_key']
-    }.get(args[0][1][1], [])
-
-  def getAttributeValue(self, obj, *args):
-    if obj == 'pub_key':
-      with open(str(Path(__file__).parent / 'keys/public_key.cer'), 'rb') as der:
-        return [pickle.loads(der.read())]
-    elif obj == 'cert':
-      with open(str(Path(__file__).parent / 'keys/x509_cert.cer'), 'rb') as der:
-        return [pickle.loads(der.read())]
-    elif obj == 'priv_key' and args[0][0] == CKA_ALWAYS_AUTHENTICATE:
-      return [True]
+  def _operation(self, name):
+    if self._token is not None:
+      self._token.operation(self.slot, name)
 
-    else:
-      return []
+  def findObjects(self, template=()):
+    self.find_objects_calls += 1
+    self._operation('find')
+    # Private keys are visible only to logged in user
+    return [handle for handle, attributes in self._objects.items()
+            if all(attributes.get(attr) == value for attr, value in template) and
+            (self.logged_in or attributes[CKA_CLASS] != CKO_PRIVATE_KEY)]
+
+  def getAttributeValue(self, obj, attr, allAsBinary=False):
+    attributes = self._objects.get(obj, {})
+    return [attributes.get(a) for a in attr]
 
   def login(self, pin, user_type=None):
+    if self._token is not None:
+      self._token.login_calls += 1
+      if user_type == CKU_CONTEXT_SPECIFIC:
+        self._token.raise_failure('context_login')
+    self._operation('login')
     if not self._able_to_login or pin != VALID_PIN:
-      raise PyKCS11Error('Could not login.')
+      raise PyKCS11Error(CKR_PIN_INCORRECT)
     self.logged_in = True
 
   def logout(self):
     if not self.logged_in:
-      raise PyKCS11Error('Could not logout.')
+      raise PyKCS11Error(CKR_USER_NOT_LOGGED_IN)
     self.logged_in = False
 
   def sign(self, pk, data, mechanism):
+    if self.removed:
+      raise PyKCS11Error(CKR_DEVICE_REMOVED)
     if not _is_valid_mechanism(mechanism):
-      raise PyKCS11Error('Mechanism is not valid.')
+      raise PyKCS11Error(CKR_MECHANISM_INVALID)
     if not isinstance(data, bytes):
       raise TypeError()
+    ec_key = self._objects[pk][CKA_KEY_TYPE] == CKK_EC
+    if ec_key != (mechanism._mech.mechanism == CKM_ECDSA):
+      raise PyKCS11Error(CKR_KEY_TYPE_INCONSISTENT)
+    self._operation('sign_ec' if ec_key else 'sign')
+
+    if ec_key:
+      # PKCS#11 ECDSA signature is r and s as big endian integers (r || s)
+      r, s = utils.decode_dss_signature(
+          EC_SIGNING_KEY.sign(data, ec.ECDSA(utils.Prehashed(hashes.SHA256()))))
+      return list(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))
+    if mechanism._mech.mechanism == CKM_RSA_PKCS_PSS:
+      return SIGNING_KEY.sign(data, PSS_PADDING, utils.Prehashed(hashes.SHA256()))
+    return SIGNING_KEY.sign(data, PSS_PADDING, hashes.SHA256())
+
+  def C_SignInit(self, session, mechanism, key):
+    if self.removed:
+      return CKR_DEVICE_REMOVED
+    if self._stream is not None:
+      return CKR_OPERATION_ACTIVE
+    if mechanism.mechanism not in (CKM_SHA256_RSA_PKCS_PSS, CKM_ECDSA_SHA256):
+      return CKR_MECHANISM_INVALID
+    ec_key = self._objects[key][CKA_KEY_TYPE] == CKK_EC
+    if ec_key != (mechanism.mechanism == CKM_ECDSA_SHA256):
+      return CKR_KEY_TYPE_INCONSISTENT
+    self._stream = [key, mechanism.mechanism, hashlib.sha256()]
+    self._stream_signature = None
+    return CKR_OK
 
-    return b'signature'
+  def C_SignUpdate(self, session, data):
+    if self._stream is None:
+      return CKR_OPERATION_NOT_INITIALIZED
+    if self.removed:
+      self._stream = None
+      return CKR_DEVICE_REMOVED
+    if self._token is None or self._token.stream_digest:
+      self._stream[2].update(bytes(data))
+    return CKR_OK
+
+  def C_SignFinal(self, session, signature):
+    if self._stream is None:
+      return CKR_OPERATION_NOT_INITIALIZED
+    if self._stream_signature is None:
+      # First call returns signature size
+      key, mech_type, digest = self._stream
+      ec_key = mech_type == CKM_ECDSA_SHA256
+      try:
+        self._operation('sign_ec' if ec_key else 'sign')
+      except PyKCS11Error as e:
+        self._stream = None
+        return e.value
+      if ec_key:
+        r, s = utils.decode_dss_signature(EC_SIGNING_KEY.sign(
+            digest.digest(), ec.ECDSA(utils.Prehashed(hashes.SHA256()))))
+        self._stream_signature = r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+      else:
+        self._stream_signature = SIGNING_KEY.sign(digest.digest(), PSS_PADDING,
+                                                  utils.Prehashed(hashes.SHA256()))
+    if signature.size() < len(self._stream_signature):
+      signature.resize(len(self._stream_signature))
+      return CKR_OK
+    signature.clear()
+    for byte in self._stream_signature:
+      signature.append(byte)
+    self._stream = self._stream_signature = None
+    return CKR_OK
 
 
 class PKCS11:
@@ -80,19 +248,96 @@ class PKCS11:
   """
 
   def __init__(self, sc_inserted=True, able_to_open_session=True,
-               _able_to_login=True):
+               _able_to_login=True, slots=1, latency=None, slot_events=True, ec_key=False,
+               stream_digest=True):
+    """
+    Args:
+      - slots(int): Number of slots with inserted token
+      - slot_events(bool): Whether waitForSlotEvent is supported
+      - latency(dict): Simulated seconds of 'open', 'login', 'find', 'sign' and
+        'sign_ec' operations; operations of one token are serialized like on a
+        real token
+      - ec_key(bool): Whether tokens also hold ECDSA P-256 key with EC_KEY_ID
+      - stream_digest(bool): Whether data of multi-part signing is hashed; reading
+        it back from PyKCS11 is slow, so benchmarks of large data disable it and
+        get signatures of empty data
+    """
+    self.objects = dict(_OBJECTS, **_EC_OBJECTS) if ec_key else _OBJECTS
+    self.stream_digest = stream_digest
     self._able_to_login = _able_to_login
+    self.latency = dict(NO_LATENCY, **(latency or {}))
+    self._token_locks = [threading.Lock() for _ in range(slots)]
     self._able_to_open_session = able_to_open_session
     self._sc_inserted = sc_inserted
+    self._slots = slots
+    self._removed_slots = set()
+    self._slot_events = slot_events
+    self._events = []
+    self._failures = {}  # operation -> [error code, remaining failures]
+    self.opened_sessions = []
+    self.get_slot_list_calls = 0
+    self.login_calls = 0
+    self.token_info_calls = 0
 
   def getSlotList(self, tokenPresent=False):
+    self.get_slot_list_calls += 1
     if self._sc_inserted:
-      return [0]
+      return [slot for slot in range(self._slots) if slot not in self._removed_slots]
     else:
       return []
 
+  def getTokenInfo(self, slot):
+    self.token_info_calls += 1
+    info = CK_TOKEN_INFO()
+    info.label = 'Fake token'
+    info.serialNumber = TOKEN_SERIAL if slot == 0 else '{}-{}'.format(TOKEN_SERIAL, slot)
+    return info
+
+  def fail(self, name, code, times=1):
+    """Make next `times` operations `name` ('open', 'login', 'context_login',
+    'find', 'sign' or 'sign_ec') raise PyKCS11Error with given code."""
+    self._failures[name] = [code, times]
+
+  def raise_failure(self, name):
+    """Raise failure of operation set by `fail`, if any."""
+    failure = self._failures.get(name)
+    if failure is not None and failure[1] > 0:
+      failure[1] -= 1
+      raise PyKCS11Error(failure[0])
+
+  def operation(self, slot, name):
+    """Simulate duration of token operation."""
+    self.raise_failure(name)
+    seconds = self.latency[name]
+    if seconds:
+      with self._token_locks[slot]:
+        time.sleep(seconds)
+
+  def remove_token(self, slot):
+    """Simulate removal of a token from slot."""
+    self._removed_slots.add(slot)
+    self._events.append(slot)
+    for session in self.opened_sessions:
+      if session.slot == slot:
+        session.removed = True
+
+  def insert_token(self, slot):
+    """Simulate insertion of a token in slot."""
+    self._removed_slots.discard(slot)
+    self._events.append(slot)
+
+  def waitForSlotEvent(self, flags=0):
+    if not self._slot_events:
+      raise PyKCS11Error(CKR_FUNCTION_NOT_SUPPORTED)
+    if not self._events:
+      raise PyKCS11Error(CKR_NO_EVENT)
+    return self._events.pop(0)
+
   def openSession(self, slot, flags=0):
     if not self._able_to_open_session:
-      raise PyKCS11Error('Could not open a session.')
+      raise PyKCS11Error(CKR_DEVICE_ERROR)
 
-    return _Session(self._able_to_login)
+    self.operation(slot, 'open')
+    session = _Session(self._able_to_login, slot, self)
+    self.opened_sessions.append(session)
+    return session
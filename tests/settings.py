@@ -3,7 +3,11 @@ from PyKCS11 import (CKG_MGF1_SHA256, CKM_SHA256, CKM_SHA256_RSA_PKCS_PSS,
 
 MOCK_PYKCS11 = True  # Set to False to test it with real PyKCS11Lib and smart card
 
+TOKEN_SERIAL = '0123456789abcdef'
+
 VALID_KEY_ID = (0x01,)
+# Key id of ECDSA P-256 key (fake token holds it if created with `ec_key=True`)
+EC_KEY_ID = (0x02,)
 WRONG_KEY_ID = (0x20,)
 
 VALID_PIN = '123456'
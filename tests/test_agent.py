@@ -0,0 +1,137 @@
+import json
+import os
+import socket
+import stat
+import struct
+import threading
+from pathlib import Path
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from PyKCS11 import CKR_DEVICE_ERROR, PyKCS11Error
+
+from oll_sc.agent import (AGENT_SOCK_ENV, AgentClient, recv_message,
+                          send_message)
+from oll_sc.agent_server import start_agent
+from oll_sc.api import (sc_export_pub_key_pem, sc_is_present,
+                        sc_sign_rsa_pkcs_pss_sha256,
+                        sc_sign_rsa_pkcs_pss_sha256_prehash)
+from oll_sc.exceptions import (SmartCardAgentError,
+                               SmartCardFindKeyObjectError,
+                               SmartCardTransientError, SmartCardWrongPinError)
+
+from .pkcs11 import PSS_PADDING, SIGNING_KEY
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_KEY_ID, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture
+def agent(pkcs11, monkeypatch, tmp_path):
+  # Only agent uses fake library, API calls which are not forwarded fail
+  monkeypatch.setattr('oll_sc.agent_server.get_pkcs11', lambda: pkcs11)
+  server = start_agent(VALID_PIN, str(tmp_path / 'agent.sock'), ttl=0)
+  thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+  thread.start()
+  monkeypatch.setenv(AGENT_SOCK_ENV, server.server_address)
+  yield server
+  server.shutdown()
+  server.server_close()
+  thread.join()
+
+
+def test_message_should_roundtrip():
+  left, right = socket.socketpair()
+  with left, right:
+    send_message(left, [b'sign', b'', b'\x00' * 10])
+    assert recv_message(right) == [b'sign', b'', b'\x00' * 10]
+    left.close()
+    assert recv_message(right) is None
+
+
+def test_api_functions_should_go_through_agent(agent, pkcs11):
+  data = b'test'
+  signature = sc_sign_rsa_pkcs_pss_sha256(data, VALID_KEY_ID, VALID_PIN)
+  prehash_signature = sc_sign_rsa_pkcs_pss_sha256_prehash(data, VALID_KEY_ID, VALID_PIN)
+  for sig in (signature, prehash_signature):
+    SIGNING_KEY.public_key().verify(sig, data, PSS_PADDING, hashes.SHA256())
+
+  assert sc_is_present()
+  assert sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN) == \
+      (Path(__file__).parent / 'keys/public_key.pem').read_bytes()
+  # One session logged in at agent start
+  assert len(pkcs11.opened_sessions) == 1
+
+
+def test_agent_wrong_pin_should_raise_error(agent):
+  with pytest.raises(SmartCardWrongPinError):
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, WRONG_PIN)
+
+
+def test_agent_wrong_key_id_should_raise_error(agent):
+  with pytest.raises(SmartCardFindKeyObjectError):
+    sc_export_pub_key_pem(WRONG_KEY_ID, VALID_PIN)
+
+
+def test_start_agent_wrong_pin_should_raise_error(pkcs11, monkeypatch, tmp_path):
+  monkeypatch.setattr('oll_sc.agent_server.get_pkcs11', lambda: pkcs11)
+  with pytest.raises(SmartCardWrongPinError):
+    start_agent(WRONG_PIN, str(tmp_path / 'agent.sock'))
+
+
+def test_agent_stats_should_return_phase_metrics(agent):
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN)
+  with AgentClient(agent.server_address) as client:
+    snapshot = json.loads(client.request('stats').decode())
+  assert snapshot['sign']['count'] == 1
+  assert snapshot['login']['count'] == 1
+
+
+def test_agent_socket_should_be_private(agent):
+  assert stat.S_IMODE(os.stat(agent.server_address).st_mode) == 0o600
+
+
+@pytest.mark.parametrize('fields', [[b'sign'], [b'\xff', b'', b'', b'']])
+def test_agent_malformed_request_should_return_error(agent, fields):
+  with AgentClient(agent.server_address) as client:
+    send_message(client._sock, fields)  # pylint: disable=W0212
+    assert recv_message(client._sock)[:2] == [b'error', b'SmartCardError']  # pylint: disable=W0212
+    assert client.request('is_present') == b'\x01'
+
+
+def test_agent_malformed_message_should_return_error(agent):
+  with AgentClient(agent.server_address) as client:
+    # Field length exceeds message
+    client._sock.sendall(struct.pack('!II', 4, 100))  # pylint: disable=W0212
+    assert recv_message(client._sock)[:2] == [b'error', b'SmartCardError']  # pylint: disable=W0212
+    assert client.request('is_present') == b'\x01'
+
+
+def test_agent_pkcs11_error_should_return_error(agent, pkcs11, monkeypatch):
+  def get_slot_list(tokenPresent=False):
+    raise PyKCS11Error(CKR_DEVICE_ERROR)
+  monkeypatch.setattr(pkcs11, 'getSlotList', get_slot_list)
+
+  with AgentClient(agent.server_address) as client:
+    with pytest.raises(SmartCardTransientError):
+      client.request('is_present')
+
+
+def test_agent_connection_error_should_raise_agent_error(agent, monkeypatch):
+  def recv(sock):
+    raise ConnectionResetError('Connection reset by peer.')
+  monkeypatch.setattr('oll_sc.agent.recv_message', recv)
+
+  with pytest.raises(SmartCardAgentError):
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN)
+
+
+def test_backend_should_take_precedence_over_agent(agent, pkcs11, monkeypatch):
+  class _Backend:
+    def sign_rsa_pkcs_pss_sha256(self, data, key_id, pin):
+      return b'backend'
+  monkeypatch.setattr('oll_sc.backends._BACKEND', _Backend())
+
+  assert sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN) == b'backend'
+  # Only the session logged in at agent start
+  assert len(pkcs11.opened_sessions) == 1
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from pathlib import Path
+
+import pytest
+
+from oll_sc import aio
+from oll_sc.aio import TokenExecutor
+from oll_sc.exceptions import SmartCardFindKeyObjectError
+
+from .settings import TOKEN_SERIAL, VALID_KEY_ID, VALID_PIN, WRONG_KEY_ID
+
+
+def _run(coroutine):
+  """Run coroutine in a new event loop (`asyncio.run` needs Python 3.7)."""
+  loop = asyncio.new_event_loop()
+  try:
+    return loop.run_until_complete(coroutine)
+  finally:
+    loop.close()
+
+
+def test_aio_api_functions(pkcs11):
+  async def main():
+    return await asyncio.gather(
+        aio.sc_is_present(pkcs11=pkcs11),
+        aio.sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11),
+        aio.sc_export_x509_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11),
+        aio.sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11),
+    )
+
+  present, pub_key_pem, x509_pem, signature = _run(main())
+  assert present
+  assert pub_key_pem == (Path(__file__).parent / 'keys/public_key.pem').read_bytes()
+  assert x509_pem == (Path(__file__).parent / 'keys/x509_cert.pem').read_bytes()
+  assert isinstance(signature, bytes)
+
+
+@pytest.mark.skip_smartcard
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_aio_api_functions_should_use_selected_token(pkcs11):
+  token = 'serial:{}-1'.format(TOKEN_SERIAL)
+
+  async def main():
+    return await asyncio.gather(
+        aio.sc_is_present(token=token, pkcs11=pkcs11),
+        aio.sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, token=token, pkcs11=pkcs11),
+        aio.sc_export_x509_pem(VALID_KEY_ID, VALID_PIN, token=token, pkcs11=pkcs11),
+        aio.sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, token=token,
+                                        pkcs11=pkcs11),
+    )
+
+  assert _run(main())[0]
+  assert {session.slot for session in pkcs11.opened_sessions} == {1}
+
+
+def test_aio_should_raise_api_errors(pkcs11):
+  with pytest.raises(SmartCardFindKeyObjectError):
+    _run(aio.sc_export_pub_key_pem(WRONG_KEY_ID, VALID_PIN, pkcs11=pkcs11))
+
+
+def test_token_executor_should_limit_pending_calls_and_keep_order():
+  executor = TokenExecutor(max_pending=2)
+  calls = []
+  running = threading.Event()
+  release = threading.Event()
+
+  def call(i):
+    running.set()
+    release.wait()
+    calls.append(i)
+    return i
+
+  async def main():
+    tasks = [asyncio.ensure_future(executor.run(call, i)) for i in range(5)]
+    await asyncio.sleep(0.05)
+    submitted = executor._executor._work_queue.qsize() + running.is_set()
+    release.set()
+    return submitted, await asyncio.gather(*tasks)
+
+  submitted, results = _run(main())
+  assert submitted == 2
+  assert results == calls == list(range(5))
+
+
+def test_token_executor_cancel_should_not_block_other_calls():
+  executor = TokenExecutor(max_pending=1)
+  release = threading.Event()
+
+  async def main():
+    blocking = asyncio.ensure_future(executor.run(release.wait))
+    waiting = asyncio.ensure_future(executor.run(lambda: 'cancelled'))
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    blocking.cancel()
+    release.set()
+    return await executor.run(lambda: 'done')
+
+  assert _run(main()) == 'done'
@@ -1,15 +1,19 @@
+import io
 from pathlib import Path
 
 import pytest
+from cryptography.hazmat.primitives import hashes, serialization
 
 from oll_sc.api import (sc_export_pub_key_pem, sc_export_x509_pem,
-                        sc_is_present, sc_session, sc_sign_rsa,
-                        sc_sign_rsa_pkcs_pss_sha256)
+                        sc_is_present, sc_session, sc_sign_many,
+                        sc_sign_rsa, sc_sign_rsa_pkcs_pss_sha256,
+                        sc_sign_rsa_pkcs_pss_sha256_prehash, sc_verify,
+                        sc_verify_many)
 from oll_sc.exceptions import (SmartCardFindKeyObjectError,
                                SmartCardNotPresentError, SmartCardSigningError,
                                SmartCardWrongPinError)
 
-from .pkcs11 import PKCS11
+from .pkcs11 import PKCS11, PSS_PADDING, SIGNING_KEY
 from .settings import (VALID_KEY_ID, VALID_MECH, VALID_PIN, WRONG_KEY_ID,
                        WRONG_MECH, WRONG_PIN)
 
@@ -92,3 +96,85 @@ def test_sc_sign_rsa_pkcs_pss_sha256_bytes_data(pkcs11):
   signature = sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
   assert signature
   assert isinstance(signature, bytes)
+
+
+def test_sc_sign_many_should_yield_signatures_in_one_session(pkcs11):
+  signatures = list(sc_sign_many(['a', b'b', b'c'], VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11))
+  assert len(signatures) == 3
+  assert all(isinstance(signature, bytes) for signature in signatures)
+
+  if isinstance(pkcs11, PKCS11):
+    assert len(pkcs11.opened_sessions) == 1
+
+
+@pytest.mark.skip_smartcard
+def test_sc_sign_many_should_yield_error_for_failed_item(pkcs11):
+  signatures = list(sc_sign_many([b'a', 1, b'c'], VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11))
+  assert isinstance(signatures[0], bytes)
+  assert isinstance(signatures[1], SmartCardSigningError)
+  assert isinstance(signatures[2], bytes)
+
+
+def test_sc_sign_many_wrong_mechanism_should_yield_errors(pkcs11):
+  signatures = list(sc_sign_many([b'a', b'b'], VALID_KEY_ID, VALID_PIN, mechanism=WRONG_MECH,
+                                 pkcs11=pkcs11))
+  assert all(isinstance(signature, SmartCardSigningError) for signature in signatures)
+
+
+def test_sc_sign_many_wrong_key_id_should_raise_error(pkcs11):
+  with pytest.raises(SmartCardFindKeyObjectError):
+    list(sc_sign_many([b'a'], WRONG_KEY_ID, VALID_PIN, pkcs11=pkcs11))
+
+
+@pytest.mark.skip_smartcard
+@pytest.mark.parametrize('as_input', [
+    lambda data, tmp_path: data,
+    lambda data, tmp_path: io.BytesIO(data),
+    lambda data, tmp_path: _write_file(tmp_path / 'data', data),
+])
+def test_sc_sign_rsa_pkcs_pss_sha256_prehash_should_verify_as_sha256_mechanism(
+        pkcs11, tmp_path, as_input):
+  data = b'test' * 1000
+  prehash_signature = sc_sign_rsa_pkcs_pss_sha256_prehash(as_input(data, tmp_path), VALID_KEY_ID,
+                                                          VALID_PIN, chunk_size=64,
+                                                          pkcs11=pkcs11)
+  signature = sc_sign_rsa_pkcs_pss_sha256(data, VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  public_key = SIGNING_KEY.public_key()
+  for sig in (prehash_signature, signature):
+    public_key.verify(sig, data, PSS_PADDING, hashes.SHA256())
+
+
+def _write_file(path, data):
+  path.write_bytes(data)
+  return path
+
+
+SIGNING_KEY_PEM = SIGNING_KEY.public_key().public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def test_sc_verify_valid_signature_should_return_true(pkcs11):
+  signature = sc_sign_rsa_pkcs_pss_sha256('test data', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert sc_verify('test data', signature, SIGNING_KEY_PEM)
+  assert not sc_verify('other data', signature, SIGNING_KEY_PEM)
+
+
+def test_sc_verify_with_certificate_should_use_its_public_key():
+  with open(str(Path(__file__).parent / 'keys/x509_cert.pem'), 'rb') as pem:
+    assert not sc_verify(b'test data', b'\x00' * 256, pem.read())
+
+
+def test_sc_verify_invalid_pem_should_raise_error():
+  with pytest.raises(ValueError):
+    sc_verify(b'test data', b'', b'not a pem')
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_sc_verify_many_should_return_results_in_order(pkcs11, processes):
+  data_items = [b'data %d' % i for i in range(8)]
+  signatures = list(sc_sign_many(data_items, VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11))
+  signatures[3] = signatures[4]
+  results = sc_verify_many(zip(data_items, signatures), SIGNING_KEY_PEM, processes=processes,
+                           process_pool_threshold=4)
+  assert results == [i != 3 for i in range(8)]
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from benchmarks.suite import compare, run
+from oll_sc.api import sc_sign_rsa_pkcs_pss_sha256
+
+from .pkcs11 import PKCS11
+from .settings import VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+def test_simulated_token_should_add_operation_latency():
+  pkcs11 = PKCS11(latency={'sign': 0.05})
+  start = time.perf_counter()
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert time.perf_counter() - start >= 0.05
+
+
+def test_suite_should_report_every_benchmark():
+  results = run(iterations=2, latency={'open': 0, 'login': 0, 'find': 0, 'sign': 0})
+  assert {'is_present', 'export_pub_key', 'export_x509', 'sign', 'sign_repeated',
+          'sign_many', 'sign_scheduler'} <= set(results)
+  for result in results.values():
+    assert result['ops_per_sec'] > 0
+    assert result['p50_ms'] <= result['p99_ms']
+
+
+def test_compare_should_report_regressions_beyond_tolerance():
+  baseline = {'sign': {'ops_per_sec': 100.0}, 'is_present': {'ops_per_sec': 100.0}}
+  results = {'sign': {'ops_per_sec': 70.0}, 'is_present': {'ops_per_sec': 90.0},
+             'new': {'ops_per_sec': 1.0}}
+  assert compare(results, baseline, tolerance=0.2) == [('sign', 0.7)]
+
+
+def test_ecc_benchmark_should_compare_rsa_and_ecdsa():
+  from benchmarks.ecc import run as run_ecc
+  results = run_ecc(iterations=2, latency={'open': 0, 'login': 0, 'find': 0, 'sign': 0,
+                                           'sign_ec': 0})
+  assert set(results) == {'rsa2048_pss', 'ecdsa_p256', 'rsa2048_pss_pooled', 'ecdsa_p256_pooled'}
+  assert results['rsa2048_pss']['signature_bytes'] == 256
+  assert results['ecdsa_p256']['signature_bytes'] <= 72
+
+
+def test_stream_memory_benchmark_should_report_peak_memory(tmp_path):
+  from benchmarks.stream_memory import run as run_stream_memory
+  results = run_stream_memory(size_mb=2, variants=('stream', 'read_bytes'), directory=str(tmp_path))
+  assert set(results) == {'stream', 'read_bytes'}
+  assert all(result['peak_mb'] >= 0 and result['seconds'] > 0 for result in results.values())
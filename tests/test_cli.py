@@ -0,0 +1,38 @@
+import functools
+import json
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from oll_sc import cli
+from oll_sc.api import sc_sign_many
+from oll_sc.hashing import sha256_digest
+
+from .settings import VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+def test_sign_batch_should_report_unreadable_file(pkcs11, monkeypatch, tmp_path):
+  for name in ('a', 'b', 'c'):
+    (tmp_path / name).write_bytes(name.encode())
+  unreadable = tmp_path / 'b'
+
+  def digest(path, *args):
+    if path == unreadable:
+      raise PermissionError(13, 'Permission denied', str(path))
+    return sha256_digest(path, *args)
+
+  monkeypatch.setattr(cli, 'sha256_digest', digest)
+  monkeypatch.setattr(cli, 'sc_sign_many', functools.partial(sc_sign_many, pkcs11=pkcs11))
+  output_json = tmp_path / 'signatures.json'
+  result = CliRunner().invoke(cli.oll_sc, [
+      'sign-batch', str(VALID_KEY_ID[0]), VALID_PIN, str(tmp_path), '-j', str(output_json)])
+
+  assert result.exit_code == 0, result.output
+  assert 'Signed 2 files' in result.output
+  results = {Path(entry['path']).name: entry for entry in json.loads(output_json.read_text())}
+  assert 'Permission denied' in results['b']['error']
+  assert 'signature' not in results['b']
+  assert all('signature' in results[name] for name in ('a', 'c'))
@@ -0,0 +1,79 @@
+import io
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from PyKCS11 import CKR_DEVICE_ERROR
+
+from oll_sc.api import (SIGNATURE_RAW, ecdsa_signature_to_der,
+                        ecdsa_signature_to_raw, sc_export_pub_key_pem,
+                        sc_sign_ecdsa_p256_sha256, sc_sign_rsa_pkcs_pss_sha256,
+                        sc_verify, sc_verify_many)
+from oll_sc.exceptions import SmartCardSigningError
+from oll_sc.retry import configure_retry
+
+from .pkcs11 import EC_SIGNING_KEY
+from .settings import EC_KEY_ID, VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+EC_TOKEN = [{'ec_key': True}]
+
+
+def _ec_pub_key_pem():
+  return EC_SIGNING_KEY.public_key().public_bytes(serialization.Encoding.PEM,
+                                                  serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+@pytest.mark.parametrize('pkcs11', EC_TOKEN, indirect=True)
+def test_sc_export_pub_key_pem_should_export_ec_key_from_point(pkcs11):
+  assert sc_export_pub_key_pem(EC_KEY_ID, VALID_PIN, pkcs11=pkcs11) == _ec_pub_key_pem()
+
+
+@pytest.mark.parametrize('pkcs11', EC_TOKEN, indirect=True)
+def test_sc_sign_ecdsa_p256_sha256_should_create_der_signature(pkcs11):
+  signature = sc_sign_ecdsa_p256_sha256(b'data', EC_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  assert signature[0] == 0x30
+  assert sc_verify(b'data', signature, _ec_pub_key_pem())
+  assert not sc_verify(b'other data', signature, _ec_pub_key_pem())
+
+
+@pytest.mark.parametrize('pkcs11', EC_TOKEN, indirect=True)
+def test_sc_sign_ecdsa_p256_sha256_should_create_raw_signature(pkcs11):
+  signature = sc_sign_ecdsa_p256_sha256(io.BytesIO(b'data'), EC_KEY_ID, VALID_PIN,
+                                        encoding=SIGNATURE_RAW, pkcs11=pkcs11)
+
+  assert len(signature) == 64
+  assert sc_verify_many([(b'data', ecdsa_signature_to_der(signature))], _ec_pub_key_pem()) == \
+      [True]
+
+
+@pytest.mark.parametrize('pkcs11', EC_TOKEN, indirect=True)
+def test_sign_should_fail_for_key_of_other_type(pkcs11):
+  with pytest.raises(SmartCardSigningError):
+    sc_sign_ecdsa_p256_sha256(b'data', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  with pytest.raises(SmartCardSigningError):
+    sc_sign_rsa_pkcs_pss_sha256(b'data', EC_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+
+@pytest.mark.parametrize('pkcs11', EC_TOKEN, indirect=True)
+def test_sc_sign_ecdsa_p256_sha256_should_retry_transient_errors(pkcs11):
+  configure_retry(attempts=3, base_delay=0)
+  try:
+    pkcs11.fail('sign_ec', CKR_DEVICE_ERROR)
+    signature = sc_sign_ecdsa_p256_sha256(io.BytesIO(b'data'), EC_KEY_ID, VALID_PIN,
+                                          pkcs11=pkcs11)
+  finally:
+    configure_retry()
+  # File object is hashed once, so retried signature is of the same digest
+  assert sc_verify(b'data', signature, _ec_pub_key_pem())
+
+
+def test_sc_sign_ecdsa_p256_sha256_should_reject_unknown_encoding(pkcs11):
+  with pytest.raises(ValueError):
+    sc_sign_ecdsa_p256_sha256(b'data', EC_KEY_ID, VALID_PIN, encoding='pem', pkcs11=pkcs11)
+
+
+def test_ecdsa_signature_encodings_should_round_trip():
+  raw = bytes(range(1, 65))
+  assert ecdsa_signature_to_raw(ecdsa_signature_to_der(raw)) == raw
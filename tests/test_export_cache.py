@@ -0,0 +1,95 @@
+import hashlib
+import json
+from pathlib import Path
+
+import pytest
+from PyKCS11 import CKA_VALUE
+
+from oll_sc.api import sc_export_pub_key_pem, sc_export_x509_pem
+from oll_sc.export_cache import (PUBLIC_KEY, ExportCache, disable_export_cache,
+                                 enable_export_cache)
+
+from .settings import VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+PUB_KEY_PEM = (Path(__file__).parent / 'keys/public_key.pem').read_bytes()
+X509_PEM = (Path(__file__).parent / 'keys/x509_cert.pem').read_bytes()
+
+
+@pytest.fixture
+def cache(tmp_path):
+  yield enable_export_cache(tmp_path / 'exports')
+  disable_export_cache()
+
+
+def test_cached_exports_should_not_login(cache, pkcs11):
+  assert sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) == PUB_KEY_PEM
+  assert sc_export_x509_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) == X509_PEM
+  assert pkcs11.login_calls == 2
+
+  assert sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) == PUB_KEY_PEM
+  assert sc_export_x509_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) == X509_PEM
+  # Public values are checked in sessions without login
+  assert pkcs11.login_calls == 2
+
+
+def test_export_cache_should_not_match_regenerated_key(cache, pkcs11, monkeypatch):
+  sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert cache.get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) == PUB_KEY_PEM
+
+  # Key pair generated again by another tool
+  monkeypatch.setitem(pkcs11.objects['pub_key'], CKA_VALUE, b'other public key')
+  assert cache.get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) is None
+
+
+def test_export_cache_should_persist_on_disk(cache, pkcs11):
+  sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert ExportCache(cache.directory).get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) == PUB_KEY_PEM
+
+
+def test_export_cache_should_not_match_other_token(cache, pkcs11, monkeypatch):
+  sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  token_info = pkcs11.getTokenInfo
+
+  def other_label(slot):
+    info = token_info(slot)
+    info.label = 'Other token'
+    return info
+  monkeypatch.setattr(pkcs11, 'getTokenInfo', other_label)
+
+  assert cache.get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) is None
+
+
+def test_export_cache_should_ignore_corrupted_entry(cache, pkcs11):
+  sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  entry_path, = cache.directory.glob('*.json')
+  entry_path.write_text(entry_path.read_text().replace('MII', 'XXX'))
+
+  assert ExportCache(cache.directory).get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) is None
+
+
+def test_export_cache_should_check_digest_of_exported_value(cache, pkcs11):
+  sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  entry_path, = cache.directory.glob('*.json')
+  entry = json.loads(entry_path.read_text())
+  assert entry['value_sha256']
+
+  # Other valid PEM with matching PEM digest, but not of the exported value
+  entry['pem'] = X509_PEM.decode()
+  entry['pem_sha256'] = hashlib.sha256(X509_PEM).hexdigest()
+  entry_path.write_text(json.dumps(entry))
+  assert ExportCache(cache.directory).get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) is None
+
+  del entry['pem']
+  entry_path.write_text(json.dumps(entry))
+  assert ExportCache(cache.directory).get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) is None
+
+
+def test_export_cache_invalidate_should_remove_entries(cache, pkcs11):
+  sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  cache.invalidate()
+
+  assert not list(cache.directory.glob('*.json'))
+  assert cache.get(pkcs11, VALID_KEY_ID, PUBLIC_KEY) is None
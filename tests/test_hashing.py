@@ -0,0 +1,54 @@
+import hashlib
+import io
+import mmap
+
+from oll_sc.hashing import data_summary, iter_chunks, sha256_digest
+
+DATA = b'0123456789' * 100
+DIGEST = hashlib.sha256(DATA).digest()
+
+
+def test_sha256_digest_bytes():
+  assert sha256_digest(DATA, chunk_size=64) == DIGEST
+
+
+def test_sha256_digest_str_should_be_encoded():
+  assert sha256_digest(DATA.decode(), chunk_size=64) == DIGEST
+
+
+def test_sha256_digest_path(tmp_path):
+  path = tmp_path / 'data'
+  path.write_bytes(DATA)
+  assert sha256_digest(path, chunk_size=64) == DIGEST
+
+
+def test_sha256_digest_file_object():
+  assert sha256_digest(io.BytesIO(DATA), chunk_size=64) == DIGEST
+
+
+def test_iter_chunks_should_respect_chunk_size():
+  sizes = [len(chunk) for chunk in iter_chunks(io.BytesIO(DATA), chunk_size=300)]
+  assert sizes == [300, 300, 300, 100]
+
+
+def test_sha256_digest_empty_file(tmp_path):
+  path = tmp_path / 'empty'
+  path.touch()
+  assert sha256_digest(path) == hashlib.sha256().digest()
+
+
+def test_iter_chunks_should_slice_mmap_without_copies(tmp_path):
+  path = tmp_path / 'data'
+  path.write_bytes(DATA)
+  with open(str(path), 'rb') as data_file, \
+       mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+    chunks = list(iter_chunks(mapped, chunk_size=300))
+    assert all(isinstance(chunk, memoryview) for chunk in chunks)
+    assert b''.join(chunks) == DATA
+    chunks.clear()
+
+
+def test_data_summary_should_return_size_and_digest():
+  assert data_summary(DATA) == (len(DATA), DIGEST.hex())
+  assert data_summary(DATA.decode()) == (len(DATA), DIGEST.hex())
+  assert data_summary(memoryview(DATA)[:10]) == (10, hashlib.sha256(DATA[:10]).hexdigest())
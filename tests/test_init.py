@@ -0,0 +1,63 @@
+import pytest
+
+import oll_sc
+from oll_sc import get_pkcs11, init_pkcs11, reload_pkcs11
+
+
+class _FakePyKCS11Lib:
+  loaded = 0
+
+  def load(self, path):
+    _FakePyKCS11Lib.loaded += 1
+
+
+@pytest.fixture
+def fake_lib(monkeypatch, tmp_path):
+  lib_path = tmp_path / 'opensc-pkcs11.so'
+  lib_path.touch()
+  monkeypatch.setattr(oll_sc, 'OPENSC_LIB_PATH', lib_path)
+  monkeypatch.setattr(oll_sc, 'PyKCS11Lib', _FakePyKCS11Lib)
+  monkeypatch.setattr(oll_sc, '_PKCS11', None)
+  monkeypatch.setattr(oll_sc, '_FORKED_PKCS11', [])
+  _FakePyKCS11Lib.loaded = 0
+  return _FakePyKCS11Lib
+
+
+def test_get_pkcs11_should_load_library_once(fake_lib):
+  assert get_pkcs11() is get_pkcs11()
+  assert fake_lib.loaded == 1
+
+
+def test_init_pkcs11_should_pass_shared_instance(fake_lib):
+  @init_pkcs11
+  def api_func(pkcs11=None):
+    return pkcs11
+
+  assert api_func() is api_func() is get_pkcs11()
+  assert fake_lib.loaded == 1
+
+
+def test_reload_pkcs11_should_load_new_instance(fake_lib):
+  pkcs11 = get_pkcs11()
+  assert reload_pkcs11() is not pkcs11
+  assert fake_lib.loaded == 2
+
+
+def test_get_pkcs11_should_load_new_instance_after_fork(fake_lib, monkeypatch):
+  pkcs11 = get_pkcs11()
+  monkeypatch.setattr(oll_sc.os, 'getpid', lambda: -1)
+  assert get_pkcs11() is not pkcs11
+  assert oll_sc._FORKED_PKCS11 == [pkcs11]
+
+
+def test_after_fork_in_child_should_drop_instance(fake_lib):
+  pkcs11 = get_pkcs11()
+  oll_sc._after_fork_in_child()
+  assert get_pkcs11() is not pkcs11
+  assert fake_lib.loaded == 2
+
+
+def test_get_pkcs11_unsupported_platform_should_raise_error(fake_lib, monkeypatch, tmp_path):
+  monkeypatch.setattr(oll_sc, 'OPENSC_LIB_PATH', tmp_path / 'missing.so')
+  with pytest.raises(oll_sc.PlatformNotSupported):
+    get_pkcs11()
@@ -0,0 +1,64 @@
+import hashlib
+import json
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from PyKCS11 import CKR_TOKEN_NOT_PRESENT
+
+from oll_sc.exceptions import SmartCardNotPresentError
+from oll_sc.inventory import (CERTIFICATE, PRIVATE_KEY, PUBLIC_KEY,
+                              sc_inventory)
+
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_KEY_ID
+
+
+def _pub_key_fingerprint(pkcs11):
+  from oll_sc.api import sc_export_pub_key_pem
+  pub_key = serialization.load_pem_public_key(
+      sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11))
+  return hashlib.sha256(pub_key.public_bytes(
+      serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)).hexdigest()
+
+
+def test_sc_inventory_with_pin_should_list_all_objects(pkcs11):
+  inventory = sc_inventory(VALID_PIN, pkcs11=pkcs11)
+  kinds = sorted(obj.kind for obj in inventory[VALID_KEY_ID])
+
+  assert kinds == sorted([CERTIFICATE, PUBLIC_KEY, PRIVATE_KEY])
+  assert inventory[WRONG_KEY_ID] == []
+  private_key, = inventory.of_kind(PRIVATE_KEY)
+  assert private_key.key_type == 'RSA'
+  assert private_key.modulus_bits == 2048
+  assert private_key.value is None
+
+
+def test_sc_inventory_should_precompute_fingerprints(pkcs11):
+  inventory = sc_inventory(VALID_PIN, pkcs11=pkcs11)
+  fingerprint = _pub_key_fingerprint(pkcs11)
+
+  public_key, = inventory.of_kind(PUBLIC_KEY)
+  assert public_key.fingerprint == fingerprint
+  assert {obj.kind for obj in inventory.by_fingerprint(fingerprint)} >= {PUBLIC_KEY, PRIVATE_KEY}
+
+
+@pytest.mark.skip_smartcard
+def test_sc_inventory_without_pin_should_list_public_objects(pkcs11):
+  inventory = sc_inventory(pkcs11=pkcs11)
+
+  assert {obj.kind for obj in inventory} == {CERTIFICATE, PUBLIC_KEY}
+  assert not any(session.logged_in for session in pkcs11.opened_sessions)
+
+
+def test_sc_inventory_to_dict_should_be_json_serializable(pkcs11):
+  inventory = sc_inventory(VALID_PIN, pkcs11=pkcs11)
+  data = json.loads(json.dumps(inventory.to_dict(include_values=True)))
+
+  assert data['serial'] == inventory.serial
+  assert len(data['objects']) == len(inventory)
+
+
+@pytest.mark.skip_smartcard
+def test_sc_inventory_without_pin_should_classify_open_session_error(pkcs11):
+  pkcs11.fail('open', CKR_TOKEN_NOT_PRESENT)
+  with pytest.raises(SmartCardNotPresentError):
+    sc_inventory(pkcs11=pkcs11)
@@ -0,0 +1,67 @@
+import pytest
+from cryptography.hazmat.primitives import serialization
+
+from oll_sc.merkle import (MerkleProof, leaf_hash, merkle_proof,
+                           merkle_root_from_proof, merkle_tree, sc_sign_merkle,
+                           sc_verify_merkle)
+
+from .pkcs11 import SIGNING_KEY
+from .settings import VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture
+def pem():
+  return SIGNING_KEY.public_key().public_bytes(serialization.Encoding.PEM,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+@pytest.mark.parametrize('count', range(1, 12))
+def test_proofs_should_lead_to_root(count):
+  leaves = [leaf_hash(str(i)) for i in range(count)]
+  levels = merkle_tree(leaves)
+  for index, leaf in enumerate(leaves):
+    assert merkle_root_from_proof(leaf, merkle_proof(levels, index)) == levels[-1][0]
+
+
+def test_sign_merkle_should_sign_only_root(pkcs11, pem):
+  documents = ['document {}'.format(i) for i in range(100)]
+  result = sc_sign_merkle(documents, VALID_KEY_ID, VALID_PIN, workers=4, pkcs11=pkcs11)
+
+  assert len(result.proofs) == len(documents)
+  assert len(pkcs11.opened_sessions) == 1
+  for document, proof in zip(documents, result.proofs):
+    assert sc_verify_merkle(document, proof, result.signature, pem)
+    assert sc_verify_merkle(document, proof.to_bytes(), result.signature, pem)
+
+
+def test_verify_merkle_should_reject_wrong_document_or_proof(pkcs11, pem):
+  result = sc_sign_merkle([b'a', b'b', b'c'], VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  assert not sc_verify_merkle(b'd', result.proofs[0], result.signature, pem)
+  assert not sc_verify_merkle(b'a', result.proofs[1], result.signature, pem)
+  assert not sc_verify_merkle(b'a', result.proofs[0]._replace(leaf_count=5), result.signature,
+                              pem)
+  assert not sc_verify_merkle(b'a', b'invalid', result.signature, pem)
+
+
+def test_root_signature_should_not_be_valid_for_document(pkcs11, pem):
+  result = sc_sign_merkle([b'a'], VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert not sc_verify_merkle(result.root, MerkleProof(0, 1, []), result.signature, pem)
+
+
+def test_sign_merkle_should_hash_files(pkcs11, pem, tmp_path):
+  paths = []
+  for i in range(5):
+    path = tmp_path / 'document-{}'.format(i)
+    path.write_bytes(b'x' * 100 * i)
+    paths.append(path)
+  result = sc_sign_merkle(paths, VALID_KEY_ID, VALID_PIN, chunk_size=64, pkcs11=pkcs11)
+
+  assert sc_verify_merkle(b'x' * 300, result.proofs[3], result.signature, pem)
+
+
+def test_sign_merkle_without_documents_should_raise_error(pkcs11):
+  with pytest.raises(ValueError):
+    sc_sign_merkle([], VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
@@ -0,0 +1,89 @@
+import pytest
+
+from oll_sc import metrics
+from oll_sc.api import sc_session, sc_sign_rsa_pkcs_pss_sha256
+from oll_sc.exceptions import SmartCardWrongPinError
+from oll_sc.metrics import (CONTEXT_LOGIN, FIND_OBJECTS, LOGIN, OPEN_SESSION,
+                            SIGN, add_hook, disable_metrics, enable_metrics,
+                            prometheus_text, quantile, remove_hook, timed)
+
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture
+def recorded():
+  metrics_ = enable_metrics()
+  yield metrics_
+  disable_metrics()
+
+
+def test_timed_without_hooks_should_not_time():
+  assert timed(SIGN) is metrics._NO_TIMING
+
+
+def test_hook_should_receive_phase_duration_and_error():
+  calls = []
+  hook = lambda *args: calls.append(args)  # noqa: E731
+  add_hook(hook)
+  try:
+    with timed(SIGN):
+      pass
+    with pytest.raises(KeyError):
+      with timed(LOGIN):
+        raise KeyError()
+  finally:
+    remove_hook(hook)
+
+  assert [(phase, type(error)) for phase, _, error in calls] == \
+      [(SIGN, type(None)), (LOGIN, KeyError)]
+  assert all(duration >= 0 for _, duration, _ in calls)
+
+
+def test_failing_hook_should_not_break_call():
+  def hook(phase, duration, error):
+    raise RuntimeError()
+  add_hook(hook)
+  try:
+    with timed(SIGN):
+      pass
+  finally:
+    remove_hook(hook)
+
+
+def test_signing_should_record_every_phase(pkcs11, recorded):
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  snapshot = recorded.snapshot()
+
+  for phase in (OPEN_SESSION, LOGIN, FIND_OBJECTS, CONTEXT_LOGIN, SIGN):
+    assert snapshot[phase]['count'] == 1
+    assert snapshot[phase]['buckets'][-1][1] == 1
+    assert not snapshot[phase]['errors']
+
+
+def test_failed_login_should_be_counted_by_exception_class(pkcs11, recorded):
+  with pytest.raises(SmartCardWrongPinError):
+    with sc_session(WRONG_PIN, pkcs11=pkcs11):
+      pass
+  assert recorded.snapshot()[LOGIN]['errors'] == {'PyKCS11Error': 1}
+
+
+def test_prometheus_text_should_contain_histograms_and_errors(recorded):
+  recorded(SIGN, 0.003, None)
+  recorded(SIGN, 0.2, ValueError())
+  text = prometheus_text(recorded.snapshot())
+
+  assert 'oll_sc_phase_duration_seconds_bucket{phase="sign",le="0.005"} 1\n' in text
+  assert 'oll_sc_phase_duration_seconds_bucket{phase="sign",le="+Inf"} 2\n' in text
+  assert 'oll_sc_phase_duration_seconds_count{phase="sign"} 2\n' in text
+  assert 'oll_sc_phase_errors_total{phase="sign",error="ValueError"} 1\n' in text
+
+
+def test_quantile_should_return_bucket_bound(recorded):
+  for _ in range(99):
+    recorded(SIGN, 0.004, None)
+  recorded(SIGN, 0.3, None)
+  data = recorded.snapshot()[SIGN]
+  assert quantile(data, 0.5) == 0.005
+  assert quantile(data, 1) == 0.3
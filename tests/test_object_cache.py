@@ -0,0 +1,108 @@
+import pytest
+from PyKCS11 import CKO_PRIVATE_KEY, CKO_PUBLIC_KEY, CKR_KEY_HANDLE_INVALID, PyKCS11Error
+
+from oll_sc.api import sc_export_pub_key_pem, sc_sign_rsa_pkcs_pss_sha256
+from oll_sc.exceptions import SmartCardSigningError
+from oll_sc.object_cache import (ObjectCache, disable_object_cache,
+                                 enable_object_cache, get_object_cache)
+from oll_sc.session_pool import (disable_session_pool, enable_session_pool,
+                                 get_session_pool)
+
+from .pkcs11 import _Session
+from .settings import VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+SESSION = _Session()
+
+
+@pytest.fixture
+def cache():
+  enable_session_pool()
+  yield enable_object_cache(max_size=4)
+  disable_object_cache()
+  disable_session_pool()
+
+
+def _find_objects_calls(pkcs11):
+  return sum(session.find_objects_calls for session in pkcs11.opened_sessions)
+
+
+def test_sign_should_search_private_key_once(cache, pkcs11):
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  assert _find_objects_calls(pkcs11) == 1
+  assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1}
+
+
+def test_export_should_return_cached_value(cache, pkcs11):
+  pub_key_pem = sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) == pub_key_pem
+  assert _find_objects_calls(pkcs11) == 1
+
+
+def test_sign_with_stale_handle_should_evict_object(cache, pkcs11, monkeypatch):
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  def sign(*args):
+    raise PyKCS11Error(CKR_KEY_HANDLE_INVALID)
+  monkeypatch.setattr(_Session, 'sign', sign)
+
+  with pytest.raises(SmartCardSigningError):
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert cache.stats()['size'] == 0
+
+
+def test_object_cache_should_evict_least_recently_used():
+  cache = ObjectCache(max_size=2)
+  cache.get(None, SESSION, (1,), CKO_PRIVATE_KEY, lambda: 'key1')
+  cache.get(None, SESSION, (2,), CKO_PRIVATE_KEY, lambda: 'key2')
+  cache.get(None, SESSION, (1,), CKO_PRIVATE_KEY, lambda: 'other')
+  cache.get(None, SESSION, (3,), CKO_PRIVATE_KEY, lambda: 'key3')
+
+  assert cache.get(None, SESSION, (1,), CKO_PRIVATE_KEY, lambda: 'other') == 'key1'
+  assert cache.get(None, SESSION, (2,), CKO_PRIVATE_KEY, lambda: 'other') == 'other'
+  assert cache.evictions == 2
+
+
+def test_object_cache_invalidate_should_remove_session_objects():
+  cache = ObjectCache()
+  cache.get(None, SESSION, (1,), CKO_PUBLIC_KEY, lambda: 'key1')
+  cache.get(None, _Session(), (1,), CKO_PUBLIC_KEY, lambda: 'key1')
+  cache.invalidate(SESSION)
+
+  assert cache.stats()['size'] == 1
+
+
+def test_object_cache_should_be_cleared_for_new_pkcs11():
+  cache = ObjectCache()
+  cache.get('pkcs11', SESSION, (1,), CKO_PUBLIC_KEY, lambda: 'key1')
+  assert cache.get('reloaded', SESSION, (1,), CKO_PUBLIC_KEY, lambda: 'key2') == 'key2'
+
+
+def test_cache_hit_should_not_call_token(cache, pkcs11):
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  token_info_calls = pkcs11.token_info_calls
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  assert pkcs11.token_info_calls == token_info_calls
+  assert cache.stats()['hits'] == 1
+
+
+def test_closed_pooled_session_should_drop_cached_objects(cache, pkcs11):
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert cache.stats()['size'] == 1
+
+  get_session_pool().invalidate()
+  assert cache.stats()['size'] == 0
+
+
+def test_object_cache_should_need_session_pool():
+  with pytest.raises(RuntimeError):
+    enable_object_cache()
+
+
+def test_disable_session_pool_should_disable_object_cache(cache):
+  disable_session_pool()
+  assert get_object_cache() is None
@@ -0,0 +1,153 @@
+import pytest
+from PyKCS11 import (CKR_ATTRIBUTE_READ_ONLY, CKR_DEVICE_ERROR,
+                     CKR_DEVICE_REMOVED, CKR_FUNCTION_FAILED,
+                     CKR_GENERAL_ERROR, CKR_PIN_INCORRECT, CKR_PIN_LOCKED,
+                     CKR_SESSION_HANDLE_INVALID, PyKCS11Error)
+
+from oll_sc.api import (sc_export_pub_key_pem, sc_session,
+                        sc_sign_rsa_pkcs_pss_sha256)
+from oll_sc.exceptions import (SmartCardCircuitOpenError, SmartCardError,
+                               SmartCardNotPresentError, SmartCardPinLockedError,
+                               SmartCardTransientError, SmartCardWrongPinError)
+from oll_sc.retry import (CircuitBreaker, RetryPolicy, classify_error,
+                          configure_retry, get_circuit_breaker)
+from oll_sc.session_pool import disable_session_pool, enable_session_pool
+
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture(autouse=True)
+def retry():
+  configure_retry(attempts=3, base_delay=0, failure_threshold=5, reset_timeout=60)
+  yield
+  configure_retry()
+
+
+@pytest.mark.parametrize('code, login, error_cls', [
+    (CKR_DEVICE_ERROR, False, SmartCardTransientError),
+    (CKR_SESSION_HANDLE_INVALID, False, SmartCardTransientError),
+    (CKR_DEVICE_ERROR, True, SmartCardError),
+    (CKR_DEVICE_REMOVED, False, SmartCardNotPresentError),
+    (CKR_PIN_INCORRECT, True, SmartCardWrongPinError),
+    (CKR_PIN_LOCKED, True, SmartCardPinLockedError),
+    (CKR_ATTRIBUTE_READ_ONLY, True, SmartCardWrongPinError),
+    (CKR_ATTRIBUTE_READ_ONLY, False, SmartCardError),
+])
+def test_classify_error(code, login, error_cls):
+  assert type(classify_error(PyKCS11Error(code), login=login)) is error_cls
+
+
+def test_retry_policy_delay_should_be_bounded():
+  policy = RetryPolicy(base_delay=0.1, max_delay=0.3)
+  assert all(0 <= policy.delay(1) <= 0.1 for _ in range(100))
+  assert all(0 <= policy.delay(5) <= 0.3 for _ in range(100))
+
+
+def test_transient_error_should_be_retried(pkcs11):
+  pkcs11.fail('sign', CKR_DEVICE_ERROR, times=2)
+  assert sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert pkcs11.login_calls == 3 * 2  # session and context specific login per attempt
+
+
+def test_transient_error_should_be_raised_after_attempts(pkcs11):
+  pkcs11.fail('open', CKR_DEVICE_ERROR, times=3)
+  with pytest.raises(SmartCardTransientError):
+    sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert len(pkcs11.opened_sessions) == 0
+
+
+def test_wrong_pin_should_not_be_retried(pkcs11):
+  with pytest.raises(SmartCardWrongPinError):
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, WRONG_PIN, pkcs11=pkcs11)
+  assert pkcs11.login_calls == 1
+
+
+def test_wrong_pin_should_not_be_retried_with_session_pool(pkcs11):
+  enable_session_pool()
+  try:
+    with pytest.raises(SmartCardWrongPinError):
+      sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, WRONG_PIN, pkcs11=pkcs11)
+  finally:
+    disable_session_pool()
+  assert pkcs11.login_calls == 1
+
+
+@pytest.mark.parametrize('code', [CKR_DEVICE_ERROR, CKR_FUNCTION_FAILED, CKR_GENERAL_ERROR])
+def test_token_error_of_login_should_not_be_retried(pkcs11, code):
+  pkcs11.fail('login', code, times=3)
+  with pytest.raises(SmartCardError) as excinfo:
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert not isinstance(excinfo.value, SmartCardTransientError)
+  assert pkcs11.login_calls == 1
+
+
+def test_token_error_of_context_specific_login_should_not_be_retried(pkcs11):
+  pkcs11.fail('context_login', CKR_DEVICE_ERROR, times=3)
+  with pytest.raises(SmartCardError) as excinfo:
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert not isinstance(excinfo.value, SmartCardTransientError)
+  assert pkcs11.login_calls == 2  # session and context specific login, once
+
+
+def test_locked_pin_should_raise_error(pkcs11):
+  pkcs11.fail('login', CKR_PIN_LOCKED)
+  with pytest.raises(SmartCardPinLockedError):
+    sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert pkcs11.login_calls == 1
+
+
+def test_error_in_session_block_should_not_look_like_wrong_pin(pkcs11):
+  with pytest.raises(PyKCS11Error):
+    with sc_session(VALID_PIN, pkcs11=pkcs11):
+      raise PyKCS11Error(CKR_DEVICE_ERROR)
+  assert pkcs11.opened_sessions[0].session_closed
+
+
+def test_open_circuit_should_fail_fast(pkcs11):
+  configure_retry(attempts=1, failure_threshold=2)
+  pkcs11.fail('open', CKR_DEVICE_ERROR, times=2)
+  for _ in range(2):
+    with pytest.raises(SmartCardTransientError):
+      sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  with pytest.raises(SmartCardCircuitOpenError):
+    sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert get_circuit_breaker().is_open(0)
+  assert len(pkcs11.opened_sessions) == 0
+
+
+def test_circuit_should_close_after_successful_probe(pkcs11):
+  configure_retry(attempts=1, failure_threshold=1, reset_timeout=0)
+  pkcs11.fail('open', CKR_DEVICE_ERROR)
+  with pytest.raises(SmartCardTransientError):
+    sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert get_circuit_breaker().is_open(0)
+
+  assert sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert not get_circuit_breaker().is_open(0)
+
+
+def test_circuit_breaker_should_count_consecutive_failures_per_slot():
+  breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+  breaker.record_failure(0)
+  breaker.record_success(0)
+  breaker.record_failure(0)
+  breaker.record_failure(1)
+  assert not breaker.is_open(0)
+
+  breaker.record_failure(1)
+  assert breaker.is_open(1)
+  breaker.before_call(0)
+  with pytest.raises(SmartCardCircuitOpenError):
+    breaker.before_call(1)
+
+
+def test_disabled_circuit_breaker(pkcs11):
+  configure_retry(attempts=1, failure_threshold=None)
+  pkcs11.fail('open', CKR_DEVICE_ERROR, times=5)
+  for _ in range(5):
+    with pytest.raises(SmartCardTransientError):
+      sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert get_circuit_breaker() is None
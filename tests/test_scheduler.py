@@ -0,0 +1,115 @@
+import hashlib
+import threading
+import time
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from PyKCS11 import CKA_VALUE, CKR_DEVICE_ERROR, CKR_PIN_LOCKED, PyKCS11Error
+
+from oll_sc.exceptions import (SmartCardFindKeyObjectError,
+                               SmartCardNotPresentError,
+                               SmartCardPinLockedError,
+                               SmartCardTransientError,
+                               SmartCardWrongPinError)
+from oll_sc.scheduler import SigningScheduler
+
+from .pkcs11 import _OBJECTS, PSS_PADDING, SIGNING_KEY, _Session
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_KEY_ID, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture
+def slow_sign(monkeypatch):
+  sign = _Session.sign
+
+  def _slow_sign(self, *args):
+    time.sleep(0.005)
+    return sign(self, *args)
+  monkeypatch.setattr(_Session, 'sign', _slow_sign)
+
+
+def _verify(data, signature):
+  SIGNING_KEY.public_key().verify(signature, data, PSS_PADDING, hashes.SHA256())
+
+
+@pytest.mark.parametrize('pkcs11', [dict(slots=3)], indirect=True)
+def test_scheduler_should_spread_requests_across_tokens(pkcs11, slow_sign):
+  data_items = [str(i).encode() for i in range(30)]
+  with SigningScheduler.start(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) as scheduler:
+    signatures = list(scheduler.map(data_items))
+    stats = scheduler.stats()
+
+  for data, signature in zip(data_items, signatures):
+    _verify(data, signature)
+  assert sum(slot['signed'] for slot in stats.values()) == 30
+  assert all(slot['signed'] for slot in stats.values())
+
+
+@pytest.mark.parametrize('pkcs11', [dict(slots=2)], indirect=True)
+def test_scheduler_should_move_work_of_removed_token(pkcs11, slow_sign):
+  with SigningScheduler.start(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) as scheduler:
+    pkcs11.remove_token(1)
+    data_items = [str(i).encode() for i in range(10)]
+    signatures = list(scheduler.map(data_items))
+    stats = scheduler.stats()
+
+  for data, signature in zip(data_items, signatures):
+    _verify(data, signature)
+  assert stats[0]['signed'] == 10
+  assert not stats[1]['alive']
+
+
+def test_scheduler_all_tokens_removed_should_raise_error(pkcs11):
+  with SigningScheduler.start(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11) as scheduler:
+    pkcs11.remove_token(0)
+    with pytest.raises(SmartCardNotPresentError):
+      list(scheduler.map([b'a', b'b']))
+
+
+def test_scheduler_should_find_key_by_cert_fingerprint(pkcs11):
+  fingerprint = hashlib.sha256(bytes(_OBJECTS['cert'][CKA_VALUE])).hexdigest()
+  with SigningScheduler.start(None, VALID_PIN, cert_fingerprint=fingerprint,
+                              pkcs11=pkcs11) as scheduler:
+    _verify(b'a', scheduler.submit(b'a').result())
+
+
+def test_scheduler_wrong_key_id_should_raise_error(pkcs11):
+  with pytest.raises(SmartCardFindKeyObjectError):
+    SigningScheduler.start(WRONG_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert not any(session.logged_in for session in pkcs11.opened_sessions)
+
+
+@pytest.mark.parametrize('pkcs11', [dict(slots=2)], indirect=True)
+def test_scheduler_wrong_pin_should_not_be_tried_on_other_tokens(pkcs11):
+  with pytest.raises(SmartCardWrongPinError):
+    SigningScheduler.start(VALID_KEY_ID, WRONG_PIN, pkcs11=pkcs11)
+  assert pkcs11.login_calls == 1
+  assert all(session.session_closed for session in pkcs11.opened_sessions)
+
+
+@pytest.mark.parametrize('pkcs11', [dict(slots=2)], indirect=True)
+def test_scheduler_locked_pin_should_raise_error(pkcs11):
+  pkcs11.fail('login', CKR_PIN_LOCKED)
+  with pytest.raises(SmartCardPinLockedError):
+    SigningScheduler.start(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert pkcs11.login_calls == 1
+
+
+@pytest.mark.parametrize('pkcs11', [dict(slots=2)], indirect=True)
+def test_scheduler_should_stop_started_workers_if_start_fails(pkcs11):
+  opened = []
+  open_session = pkcs11.openSession
+
+  def _open_session(slot, flags=0):
+    if slot == 1:
+      raise PyKCS11Error(CKR_DEVICE_ERROR)
+    session = open_session(slot, flags)
+    opened.append(session)
+    return session
+  pkcs11.openSession = _open_session
+
+  with pytest.raises(SmartCardTransientError):
+    SigningScheduler.start(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert opened and all(session.session_closed for session in opened)
+  assert not [thread for thread in threading.enumerate() if thread.name.startswith('oll-sc-token')]
@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+
+from oll_sc.api import sc_session, sc_sign_rsa_pkcs_pss_sha256
+from oll_sc.exceptions import SmartCardNotPresentError, SmartCardWrongPinError
+from oll_sc.session_pool import (SessionPool, disable_session_pool,
+                                 enable_session_pool, get_session_pool)
+
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture
+def pool():
+  yield enable_session_pool(max_size=2)
+  disable_session_pool()
+
+
+def test_api_functions_should_reuse_pooled_session(pool, pkcs11):
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+
+  assert len(pkcs11.opened_sessions) == 1
+  assert pkcs11.opened_sessions[0].logged_in
+  assert not pkcs11.opened_sessions[0].session_closed
+
+
+def test_disable_session_pool_should_close_sessions(pool, pkcs11):
+  with sc_session(VALID_PIN, pkcs11=pkcs11) as session:
+    pass
+  disable_session_pool()
+
+  assert get_session_pool() is None
+  assert session.session_closed
+
+
+def test_pooled_session_wrong_pin_should_raise_error(pool, pkcs11):
+  with pytest.raises(SmartCardWrongPinError):
+    with sc_session(WRONG_PIN, pkcs11=pkcs11):
+      pass
+  assert pool.stats()[0] == {'open': 0, 'idle': 0}
+
+
+def test_pooled_session_other_pin_should_login_again(pool, pkcs11):
+  with sc_session(VALID_PIN, pkcs11=pkcs11) as session:
+    pass
+
+  with pytest.raises(SmartCardWrongPinError):
+    with sc_session(WRONG_PIN, pkcs11=pkcs11):
+      pass
+  assert session.session_closed
+
+
+def test_pooled_session_should_login_again_if_logged_out(pool, pkcs11):
+  with sc_session(VALID_PIN, pkcs11=pkcs11) as session:
+    session.logout()
+
+  with sc_session(VALID_PIN, pkcs11=pkcs11) as pooled:
+    assert pooled is session
+    assert pooled.logged_in
+
+
+def test_pooled_session_should_be_replaced_if_invalid(pool, pkcs11):
+  with sc_session(VALID_PIN, pkcs11=pkcs11) as session:
+    session.closeSession()
+
+  with sc_session(VALID_PIN, pkcs11=pkcs11) as pooled:
+    assert pooled is not session
+  assert pool.stats()[0] == {'open': 1, 'idle': 1}
+
+
+def test_pooled_session_should_be_closed_after_idle_timeout(pkcs11):
+  pool = SessionPool(idle_timeout=0)
+  with pool.session(VALID_PIN, pkcs11) as session:
+    pass
+
+  with pool.session(VALID_PIN, pkcs11) as pooled:
+    assert pooled is not session
+  assert session.session_closed
+
+
+def test_idle_pooled_session_should_be_closed_without_next_borrow(pkcs11):
+  pool = SessionPool(idle_timeout=0.05)
+  with pool.session(VALID_PIN, pkcs11) as session:
+    pass
+
+  reaper = pool._reaper  # pylint: disable=W0212
+  reaper.join(1)
+  assert not reaper.is_alive()
+  assert session.session_closed
+  assert pool.stats()[0] == {'open': 0, 'idle': 0}
+
+
+def test_close_should_stop_reaper(pkcs11):
+  pool = SessionPool(idle_timeout=300)
+  with pool.session(VALID_PIN, pkcs11) as session:
+    pass
+
+  reaper = pool._reaper  # pylint: disable=W0212
+  assert reaper.is_alive()
+  pool.close()
+  assert not reaper.is_alive()
+  assert session.session_closed
+
+
+def test_pooled_session_should_be_invalidated_if_token_removed(pool, pkcs11):
+  with sc_session(VALID_PIN, pkcs11=pkcs11) as session:
+    pass
+
+  pkcs11._sc_inserted = False
+  with pytest.raises(SmartCardNotPresentError):
+    with sc_session(VALID_PIN, pkcs11=pkcs11):
+      pass
+  assert session.session_closed
+
+
+def test_pooled_session_should_wait_if_pool_is_full(pkcs11):
+  pool = SessionPool(max_size=1)
+  borrowed = []
+
+  def borrow():
+    with pool.session(VALID_PIN, pkcs11) as session:
+      borrowed.append(session)
+
+  with pool.session(VALID_PIN, pkcs11) as session:
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+
+  thread.join()
+  assert borrowed == [session]
+  assert len(pkcs11.opened_sessions) == 1
@@ -0,0 +1,158 @@
+import threading
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+
+from oll_sc.api import sc_sign_rsa_pkcs_pss_sha256
+from oll_sc.exceptions import SmartCardQueueFullError, SmartCardWrongPinError
+from oll_sc.metrics import QUEUE_WAIT, disable_metrics, enable_metrics
+from oll_sc.signing_queue import (BULK, NORMAL, URGENT, SigningQueue,
+                                  disable_signing_queue, enable_signing_queue,
+                                  get_signing_queue)
+
+from .pkcs11 import PSS_PADDING, SIGNING_KEY
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+class _GatedSign:
+  """Sign function recording order of signed data; blocks until opened."""
+
+  def __init__(self):
+    self.signed = []
+    self.started = threading.Event()
+    self.gate = threading.Event()
+
+  def __call__(self, data, key_id, pin):
+    self.started.set()
+    self.gate.wait()
+    self.signed.append(data)
+    return data
+
+
+@pytest.fixture
+def gated_queue():
+  sign = _GatedSign()
+  signing_queue = SigningQueue(sign)
+  # Worker is busy with the first request while others are queued
+  signing_queue.submit(b'first', VALID_KEY_ID, VALID_PIN)
+  sign.started.wait()
+  yield signing_queue, sign
+  sign.gate.set()
+  signing_queue.close()
+
+
+def test_signing_queue_should_sign_with_api(pkcs11):
+  def sign(data, key_id, pin):
+    return sc_sign_rsa_pkcs_pss_sha256(data, key_id, pin, pkcs11=pkcs11)
+
+  with SigningQueue(sign) as signing_queue:
+    future = signing_queue.submit('test', VALID_KEY_ID, VALID_PIN)
+    wrong_pin = signing_queue.submit(b'test', VALID_KEY_ID, WRONG_PIN)
+
+    SIGNING_KEY.public_key().verify(future.result(), b'test', PSS_PADDING, hashes.SHA256())
+    with pytest.raises(SmartCardWrongPinError):
+      wrong_pin.result()
+
+
+def test_urgent_request_should_not_wait_for_batch(gated_queue):
+  signing_queue, sign = gated_queue
+  batch = signing_queue.submit_many([b'bulk'] * 100, VALID_KEY_ID, VALID_PIN, caller='resign')
+  urgent = signing_queue.submit(b'urgent', VALID_KEY_ID, VALID_PIN, priority=URGENT,
+                                caller='release')
+  sign.gate.set()
+
+  assert urgent.result() == b'urgent'
+  batch[-1].result()
+  assert sign.signed[:2] == [b'first', b'urgent']
+
+
+def test_callers_of_same_priority_should_take_turns(gated_queue):
+  signing_queue, sign = gated_queue
+  futures = signing_queue.submit_many([b'a'] * 3, VALID_KEY_ID, VALID_PIN, priority=NORMAL,
+                                      caller='a')
+  signing_queue.submit_many([b'b'] * 2, VALID_KEY_ID, VALID_PIN, priority=NORMAL, caller='b')
+  assert signing_queue.stats()['callers'] == {'a': 3, 'b': 2}
+  sign.gate.set()
+
+  futures[-1].result()
+  assert sign.signed == [b'first', b'a', b'b', b'a', b'b', b'a']
+
+
+def test_full_queue_should_reject_requests():
+  sign = _GatedSign()
+  signing_queue = SigningQueue(sign, max_depth=3, max_caller_depth=2)
+  try:
+    signing_queue.submit(b'first', VALID_KEY_ID, VALID_PIN)
+    sign.started.wait()
+    signing_queue.submit_many([b'a'] * 2, VALID_KEY_ID, VALID_PIN, caller='a')
+    with pytest.raises(SmartCardQueueFullError):
+      signing_queue.submit(b'a', VALID_KEY_ID, VALID_PIN, caller='a')
+    with pytest.raises(SmartCardQueueFullError):
+      signing_queue.submit_many([b'b'] * 2, VALID_KEY_ID, VALID_PIN, caller='b')
+    signing_queue.submit(b'b', VALID_KEY_ID, VALID_PIN, caller='b')
+
+    stats = signing_queue.stats()
+    assert stats['rejected'] == 3
+    assert stats['depth'] == {URGENT: 0, NORMAL: 1, BULK: 2}
+  finally:
+    sign.gate.set()
+    signing_queue.close()
+
+
+def test_queued_bulk_requests_should_not_reject_urgent_request(gated_queue):
+  signing_queue, sign = gated_queue
+  signing_queue.max_depth = 100
+  signing_queue.submit_many([b'bulk'] * 100, VALID_KEY_ID, VALID_PIN, caller='resign')
+  with pytest.raises(SmartCardQueueFullError):
+    signing_queue.submit(b'bulk', VALID_KEY_ID, VALID_PIN, priority=BULK, caller='resign')
+
+  urgent = signing_queue.submit(b'urgent', VALID_KEY_ID, VALID_PIN, priority=URGENT,
+                                caller='release')
+  sign.gate.set()
+  assert urgent.result() == b'urgent'
+  assert sign.signed[:2] == [b'first', b'urgent']
+
+
+def test_close_should_cancel_pending_requests(gated_queue):
+  signing_queue, sign = gated_queue
+  futures = signing_queue.submit_many([b'bulk'] * 10, VALID_KEY_ID, VALID_PIN)
+  threading.Timer(0.01, sign.gate.set).start()
+  signing_queue.close(cancel_pending=True)
+
+  assert all(future.cancelled() for future in futures)
+  assert sign.signed == [b'first']
+  with pytest.raises(RuntimeError):
+    signing_queue.submit(b'test', VALID_KEY_ID, VALID_PIN)
+
+
+def test_wait_time_should_be_recorded(gated_queue):
+  signing_queue, sign = gated_queue
+  metrics = enable_metrics()
+  try:
+    future = signing_queue.submit(b'urgent', VALID_KEY_ID, VALID_PIN, priority=URGENT)
+    sign.gate.set()
+    future.result()
+  finally:
+    disable_metrics()
+
+  assert metrics.snapshot()[QUEUE_WAIT]['count'] == 1
+  wait = signing_queue.stats()['wait']
+  assert wait[URGENT]['count'] == 1
+  assert wait[NORMAL]['count'] == 1
+
+
+def test_enable_signing_queue_should_use_sign_and_workers(pkcs11):
+  def sign(data, key_id, pin):
+    return sc_sign_rsa_pkcs_pss_sha256(data, key_id, pin, pkcs11=pkcs11)
+
+  signing_queue = enable_signing_queue(sign=sign, workers=2)
+  try:
+    assert get_signing_queue() is signing_queue
+    assert len(signing_queue._threads) == 2  # pylint: disable=W0212
+    signature = signing_queue.submit(b'test', VALID_KEY_ID, VALID_PIN).result()
+    SIGNING_KEY.public_key().verify(signature, b'test', PSS_PADDING, hashes.SHA256())
+  finally:
+    disable_signing_queue()
+  assert get_signing_queue() is None
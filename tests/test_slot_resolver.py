@@ -0,0 +1,126 @@
+import hashlib
+
+import pytest
+from PyKCS11 import CKA_VALUE, CKR_DEVICE_ERROR
+
+from oll_sc.api import sc_export_pub_key_pem, sc_is_present, sc_sign_rsa_pkcs_pss_sha256
+from oll_sc.exceptions import SmartCardNotPresentError, SmartCardTransientError
+from oll_sc.export_cache import disable_export_cache, enable_export_cache
+from oll_sc.session_pool import disable_session_pool, enable_session_pool
+from oll_sc.slot_resolver import (FINGERPRINT, LABEL, SERIAL, TokenSelector,
+                                  get_slot_resolver, parse_token_selector,
+                                  resolve_slot)
+
+from .pkcs11 import _OBJECTS
+from .settings import TOKEN_SERIAL, VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+SECOND_SERIAL = '{}-1'.format(TOKEN_SERIAL)
+
+
+def _cert_fingerprint():
+  return hashlib.sha256(bytes(_OBJECTS['cert'][CKA_VALUE])).hexdigest()
+
+
+@pytest.mark.parametrize('selector, expected', [
+    ('serial:123', TokenSelector(SERIAL, '123')),
+    ('label:Signing key', TokenSelector(LABEL, 'Signing key')),
+    ('fingerprint:AB12', TokenSelector(FINGERPRINT, 'AB12')),
+    ('123', TokenSelector(SERIAL, '123')),
+    ('other:123', TokenSelector(SERIAL, 'other:123')),
+])
+def test_parse_token_selector(selector, expected):
+  assert parse_token_selector(selector) == expected
+
+
+def test_parse_token_selector_should_reject_empty_value():
+  with pytest.raises(ValueError):
+    parse_token_selector('serial:')
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_resolve_slot_by_serial_label_and_fingerprint(pkcs11):
+  assert resolve_slot(pkcs11) == 0
+  assert resolve_slot(pkcs11, 'serial:' + SECOND_SERIAL) == 1
+  assert resolve_slot(pkcs11, SECOND_SERIAL.upper()) == 1
+  assert resolve_slot(pkcs11, 'label:Fake token') == 0
+  assert resolve_slot(pkcs11, 'fingerprint:' + _cert_fingerprint()) == 0
+
+  pkcs11.remove_token(0)
+  assert resolve_slot(pkcs11, 'fingerprint:' + _cert_fingerprint().upper()) == 1
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_slot_map_should_be_read_again_only_after_slot_events(pkcs11):
+  assert resolve_slot(pkcs11, SECOND_SERIAL) == 1
+  calls = pkcs11.token_info_calls
+  for _ in range(5):
+    assert resolve_slot(pkcs11, SECOND_SERIAL) == 1
+  assert pkcs11.token_info_calls == calls
+
+  pkcs11.remove_token(1)
+  with pytest.raises(SmartCardNotPresentError) as excinfo:
+    resolve_slot(pkcs11, SECOND_SERIAL)
+  assert SECOND_SERIAL in str(excinfo.value)
+
+  pkcs11.insert_token(1)
+  assert resolve_slot(pkcs11, SECOND_SERIAL) == 1
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_sign_should_use_selected_token(pkcs11):
+  sc_sign_rsa_pkcs_pss_sha256(b'data', VALID_KEY_ID, VALID_PIN, token=SECOND_SERIAL,
+                              pkcs11=pkcs11)
+  assert [session.slot for session in pkcs11.opened_sessions] == [1]
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_pin_should_not_be_tried_on_other_token(pkcs11):
+  with pytest.raises(SmartCardNotPresentError):
+    sc_sign_rsa_pkcs_pss_sha256(b'data', VALID_KEY_ID, VALID_PIN, token='serial:missing',
+                                pkcs11=pkcs11)
+  assert pkcs11.login_calls == 0
+  assert not sc_is_present(token='serial:missing', pkcs11=pkcs11)
+  assert sc_is_present(token=SECOND_SERIAL, pkcs11=pkcs11)
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_session_pool_should_use_selected_token(pkcs11):
+  pool = enable_session_pool()
+  try:
+    sc_sign_rsa_pkcs_pss_sha256(b'data', VALID_KEY_ID, VALID_PIN, token=SECOND_SERIAL,
+                                pkcs11=pkcs11)
+    sc_sign_rsa_pkcs_pss_sha256(b'data', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+    assert set(pool.stats()) == {0, 1}
+  finally:
+    disable_session_pool()
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_export_cache_should_be_kept_per_selected_token(pkcs11, tmp_path):
+  enable_export_cache(tmp_path / 'exports')
+  try:
+    pem = sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, token=SECOND_SERIAL, pkcs11=pkcs11)
+    logins = pkcs11.login_calls
+    assert sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, token=SECOND_SERIAL,
+                                 pkcs11=pkcs11) == pem
+    assert pkcs11.login_calls == logins
+    sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+    assert pkcs11.login_calls == logins + 1
+  finally:
+    disable_export_cache()
+
+
+def test_get_slot_resolver_should_be_replaced_for_other_library(pkcs11):
+  resolver = get_slot_resolver(pkcs11)
+  assert get_slot_resolver(pkcs11) is resolver
+  assert get_slot_resolver(object()) is not resolver
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2}], indirect=True)
+def test_resolve_by_fingerprint_should_classify_open_session_error(pkcs11):
+  pkcs11.fail('open', CKR_DEVICE_ERROR)
+  with pytest.raises(SmartCardTransientError):
+    resolve_slot(pkcs11, 'fingerprint:' + _cert_fingerprint())
+  assert resolve_slot(pkcs11, 'fingerprint:' + _cert_fingerprint()) == 0
@@ -0,0 +1,155 @@
+import datetime
+import inspect
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from oll_sc import software_backend
+from oll_sc.api import (sc_export_pub_key_pem, sc_export_x509_pem,
+                        sc_is_present, sc_sign_many,
+                        sc_sign_rsa_pkcs_pss_sha256,
+                        sc_sign_rsa_pkcs_pss_sha256_prehash, sc_verify)
+from oll_sc.backends import (BACKEND_ENV, KEYS_DIR_ENV, Backend, get_backend,
+                             set_backend)
+from oll_sc.exceptions import (SmartCardFindKeyObjectError,
+                               SmartCardSigningError, SmartCardWrongPinError)
+from oll_sc.software_backend import SoftwareBackend
+
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_KEY_ID, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture(scope='module')
+def key():
+  return rsa.generate_private_key(65537, 2048, default_backend())
+
+
+@pytest.fixture
+def keys_dir(tmp_path, key):
+  (tmp_path / 'key-01.pem').write_bytes(key.private_bytes(
+      serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+      serialization.BestAvailableEncryption(VALID_PIN.encode())))
+
+  name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'test')])
+  now = datetime.datetime.utcnow()
+  cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+      .public_key(key.public_key()).serial_number(1) \
+      .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+      .sign(key, hashes.SHA256(), default_backend())
+  (tmp_path / 'cert-01.pem').write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+  return tmp_path
+
+
+@pytest.fixture
+def backend(keys_dir):
+  backend = SoftwareBackend(keys_dir, processes=2)
+  set_backend(backend)
+  yield backend
+  set_backend(None)
+
+
+def test_api_functions_should_use_software_backend(backend, key):
+  pub_key_pem = sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN)
+  assert pub_key_pem == key.public_key().public_bytes(
+      serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+  assert b'BEGIN CERTIFICATE' in sc_export_x509_pem(VALID_KEY_ID, VALID_PIN)
+  assert sc_is_present()
+
+  signature = sc_sign_rsa_pkcs_pss_sha256(b'data', VALID_KEY_ID, VALID_PIN)
+  prehash_signature = sc_sign_rsa_pkcs_pss_sha256_prehash(b'data', VALID_KEY_ID, VALID_PIN)
+  assert sc_verify(b'data', signature, pub_key_pem)
+  assert sc_verify(b'data', prehash_signature, pub_key_pem)
+
+
+def test_software_backend_wrong_pin_should_raise_error(backend):
+  with pytest.raises(SmartCardWrongPinError):
+    sc_sign_rsa_pkcs_pss_sha256(b'data', VALID_KEY_ID, WRONG_PIN)
+
+
+def test_software_backend_wrong_key_id_should_raise_error(backend):
+  with pytest.raises(SmartCardFindKeyObjectError):
+    sc_export_pub_key_pem(WRONG_KEY_ID, VALID_PIN)
+
+
+def test_software_backend_sign_many_should_use_process_pool(backend, monkeypatch):
+  monkeypatch.setattr(software_backend, 'PROCESS_POOL_THRESHOLD', 4)
+  data_items = [b'data %d' % i for i in range(10)]
+  signatures = sc_sign_many(data_items, VALID_KEY_ID, VALID_PIN)
+  pub_key_pem = sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN)
+  assert all(sc_verify(data, signature, pub_key_pem)
+             for data, signature in zip(data_items, signatures))
+
+
+def test_backend_should_be_configured_through_environment(keys_dir, monkeypatch):
+  assert get_backend() is None
+  monkeypatch.setenv(BACKEND_ENV, 'software')
+  monkeypatch.setenv(KEYS_DIR_ENV, str(keys_dir))
+  backend = get_backend()
+  assert isinstance(backend, SoftwareBackend)
+  assert get_backend() is backend
+  assert sc_is_present()
+
+
+def test_sign_ecdsa_p256_sha256_should_use_software_backend(backend, keys_dir):
+  from cryptography.hazmat.primitives.asymmetric import ec
+  from oll_sc.api import SIGNATURE_RAW, sc_sign_ecdsa_p256_sha256
+
+  ec_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+  (keys_dir / 'key-02.pem').write_bytes(ec_key.private_bytes(
+      serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+      serialization.NoEncryption()))
+  pub_key_pem = sc_export_pub_key_pem((2,), VALID_PIN)
+
+  signature = sc_sign_ecdsa_p256_sha256(b'data', (2,), VALID_PIN)
+  assert sc_verify(b'data', signature, pub_key_pem)
+  assert len(sc_sign_ecdsa_p256_sha256(b'data', (2,), VALID_PIN, encoding=SIGNATURE_RAW)) == 64
+
+
+def test_sign_rsa_pkcs_pss_sha256_stream_should_use_software_backend(backend, tmp_path):
+  from oll_sc.api import sc_sign_rsa_pkcs_pss_sha256_stream
+
+  path = tmp_path / 'data'
+  path.write_bytes(b'data' * 1000)
+  signature = sc_sign_rsa_pkcs_pss_sha256_stream(path, VALID_KEY_ID, VALID_PIN, chunk_size=64)
+  assert sc_verify(path.read_bytes(), signature, sc_export_pub_key_pem(VALID_KEY_ID, VALID_PIN))
+
+
+def test_software_backend_sign_many_should_yield_error_for_failed_item(backend):
+  signatures = sc_sign_many([b'a', 1, b'c'], VALID_KEY_ID, VALID_PIN)
+  assert inspect.isgenerator(signatures)
+  signatures = list(signatures)
+  assert isinstance(signatures[0], bytes)
+  assert isinstance(signatures[1], SmartCardSigningError)
+  assert isinstance(signatures[2], bytes)
+
+
+def test_sign_stream_ecdsa_should_use_software_backend(backend, keys_dir):
+  from cryptography.hazmat.primitives.asymmetric import ec
+  from oll_sc.api import ECDSA_SHA256_MECHANISM, ecdsa_signature_to_der, sc_sign_stream
+
+  ec_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+  (keys_dir / 'key-02.pem').write_bytes(ec_key.private_bytes(
+      serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+      serialization.NoEncryption()))
+
+  signature = sc_sign_stream(b'data' * 100, ECDSA_SHA256_MECHANISM, (2,), VALID_PIN,
+                             chunk_size=64)
+  assert len(signature) == 64
+  assert sc_verify(b'data' * 100, ecdsa_signature_to_der(signature),
+                   sc_export_pub_key_pem((2,), VALID_PIN))
+  with pytest.raises(SmartCardSigningError):
+    sc_sign_stream(b'data', ECDSA_SHA256_MECHANISM, VALID_KEY_ID, VALID_PIN)
+
+
+def test_backend_missing_methods_should_not_be_instantiated():
+  class _PartialBackend(Backend):
+    def is_present(self):
+      return True
+
+  with pytest.raises(TypeError):
+    _PartialBackend()
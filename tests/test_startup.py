@@ -0,0 +1,12 @@
+import pytest
+
+from benchmarks.startup import MODULES, run
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+def test_heavy_modules_should_be_imported_lazily():
+  results = run(runs=1)
+  assert set(results) == set(MODULES)
+  for result in results.values():
+    assert result['lazy_imported'] == []
@@ -0,0 +1,126 @@
+import io
+import logging
+import mmap
+
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from PyKCS11 import CKR_DEVICE_ERROR, CKR_KEY_TYPE_INCONSISTENT
+
+from oll_sc.api import (ECDSA_MECHANISM, ECDSA_SHA256_MECHANISM,
+                        sc_sign_rsa_pkcs_pss_sha256,
+                        sc_sign_rsa_pkcs_pss_sha256_stream, sc_sign_stream)
+from oll_sc.exceptions import (SmartCardSigningError,
+                               SmartCardTransientError)
+from oll_sc.session_pool import disable_session_pool, enable_session_pool
+
+from .pkcs11 import EC_SIGNING_KEY, PSS_PADDING, SIGNING_KEY, _Session
+from .settings import EC_KEY_ID, VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+DATA = b'0123456789' * 100
+
+
+class _BrokenFile(io.BytesIO):
+  """File object failing after the first chunk."""
+
+  def readinto(self, buffer):
+    if self.tell():
+      raise OSError('Read error')
+    return super().readinto(buffer)
+
+
+def _verify(signature, data=DATA):
+  SIGNING_KEY.public_key().verify(signature, data, PSS_PADDING, hashes.SHA256())
+
+
+def test_stream_signature_should_verify(pkcs11):
+  signature = sc_sign_rsa_pkcs_pss_sha256_stream(DATA, VALID_KEY_ID, VALID_PIN, chunk_size=64,
+                                                 pkcs11=pkcs11)
+  _verify(signature)
+
+
+def test_stream_should_sign_memoryview_file_object_path_and_mmap(pkcs11, tmp_path):
+  path = tmp_path / 'data'
+  path.write_bytes(DATA)
+  for data in (memoryview(DATA), io.BytesIO(DATA), path, DATA.decode()):
+    _verify(sc_sign_rsa_pkcs_pss_sha256_stream(data, VALID_KEY_ID, VALID_PIN, chunk_size=300,
+                                               pkcs11=pkcs11))
+
+  with open(str(path), 'rb') as data_file, \
+       mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+    _verify(sc_sign_rsa_pkcs_pss_sha256_stream(mapped, VALID_KEY_ID, VALID_PIN, chunk_size=300,
+                                               pkcs11=pkcs11))
+
+
+@pytest.mark.parametrize('pkcs11', [{'ec_key': True}], indirect=True)
+def test_stream_should_sign_with_ecdsa(pkcs11):
+  signature = sc_sign_stream(io.BytesIO(DATA), ECDSA_SHA256_MECHANISM, EC_KEY_ID, VALID_PIN,
+                             chunk_size=64, pkcs11=pkcs11)
+  assert len(signature) == 64
+  der = utils.encode_dss_signature(int.from_bytes(signature[:32], 'big'),
+                                   int.from_bytes(signature[32:], 'big'))
+  EC_SIGNING_KEY.public_key().verify(der, DATA, ec.ECDSA(hashes.SHA256()))
+
+
+def test_stream_error_should_carry_size_and_digest_only(pkcs11):
+  with pytest.raises(SmartCardSigningError) as excinfo:
+    sc_sign_stream(DATA, ECDSA_MECHANISM, VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert excinfo.value.size == 0
+
+  pkcs11.fail('sign', CKR_KEY_TYPE_INCONSISTENT)
+  with pytest.raises(SmartCardSigningError) as excinfo:
+    sc_sign_rsa_pkcs_pss_sha256_stream(b'secret payload', VALID_KEY_ID, VALID_PIN,
+                                       pkcs11=pkcs11)
+  assert 'secret' not in str(excinfo.value)
+  assert excinfo.value.size == 14
+
+
+def test_signing_error_should_not_contain_data():
+  error = SmartCardSigningError(b'secret payload')
+  assert 'secret' not in str(error)
+  assert '14 bytes' in str(error)
+  assert error.digest in str(error)
+
+
+def test_debug_log_should_not_contain_data(pkcs11, caplog):
+  with caplog.at_level(logging.DEBUG, logger='oll_sc.api'):
+    sc_sign_rsa_pkcs_pss_sha256(b'secret payload', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+    sc_sign_rsa_pkcs_pss_sha256_stream(b'secret payload', VALID_KEY_ID, VALID_PIN,
+                                       pkcs11=pkcs11)
+  assert 'secret' not in caplog.text
+  assert '14 bytes' in caplog.text
+
+
+def test_stream_transient_error_should_not_be_retried(pkcs11):
+  pkcs11.fail('sign', CKR_DEVICE_ERROR)
+  with pytest.raises(SmartCardTransientError):
+    sc_sign_rsa_pkcs_pss_sha256_stream(DATA, VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert len(pkcs11.opened_sessions) == 1
+
+
+def test_session_should_sign_again_after_read_error(pkcs11):
+  enable_session_pool()
+  try:
+    with pytest.raises(OSError):
+      sc_sign_rsa_pkcs_pss_sha256_stream(_BrokenFile(DATA), VALID_KEY_ID, VALID_PIN,
+                                         chunk_size=64, pkcs11=pkcs11)
+    _verify(sc_sign_rsa_pkcs_pss_sha256_stream(DATA, VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11))
+    assert len(pkcs11.opened_sessions) == 1
+  finally:
+    disable_session_pool()
+
+
+def test_stream_should_pass_data_in_chunks(pkcs11, monkeypatch):
+  updates = []
+  sign_update = _Session.C_SignUpdate
+
+  def _sign_update(self, session, data):
+    updates.append(len(data))
+    return sign_update(self, session, data)
+  monkeypatch.setattr(_Session, 'C_SignUpdate', _sign_update)
+
+  _verify(sc_sign_rsa_pkcs_pss_sha256_stream(memoryview(DATA), VALID_KEY_ID, VALID_PIN,
+                                             chunk_size=300, pkcs11=pkcs11))
+  assert updates == [300, 300, 300, len(DATA) - 900]
@@ -0,0 +1,117 @@
+import hashlib
+import json
+
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+
+from oll_sc.backends import set_backend
+from oll_sc.exceptions import SmartCardWrongPinError
+from oll_sc.software_backend import SoftwareBackend
+from oll_sc.tuf_signing import (canonicalize_roles, embed_signature,
+                                encode_canonical, sc_sign_tuf_metadata,
+                                tuf_keyid)
+
+from .pkcs11 import PSS_PADDING, SIGNING_KEY
+from .settings import VALID_KEY_ID, VALID_PIN, WRONG_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+PUBLIC_PEM = SIGNING_KEY.public_key().public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def _roles(count=3):
+  return {
+      'role{}'.format(i): {
+          'signed': {'_type': 'targets', 'version': i, 'expires': '2030-01-01T00:00:00Z',
+                     'targets': {'file"\\{}'.format(i): {'length': i, 'custom': None}}},
+          'signatures': [],
+      }
+      for i in range(count)
+  }
+
+
+def test_encode_canonical():
+  assert encode_canonical({'b': [1, True, None], 'a': 'x"\\ü'}) == \
+      '{"a":"x\\"\\\\ü","b":[1,true,null]}'.encode('utf-8')
+  with pytest.raises(ValueError):
+    encode_canonical({'a': 1.5})
+  with pytest.raises(ValueError):
+    encode_canonical({1: 'a'})
+
+
+def test_tuf_keyid_should_hash_canonical_key_metadata():
+  # JSON escapes newlines of PEM, canonical JSON keeps them
+  key_meta = ('{"keyid_hash_algorithms":["sha256","sha512"],"keytype":"rsa",'
+              '"keyval":{"public":"' + PUBLIC_PEM.decode().strip() + '"},'
+              '"scheme":"rsassa-pss-sha256"}')
+  assert tuf_keyid(PUBLIC_PEM) == hashlib.sha256(key_meta.encode()).hexdigest()
+  assert tuf_keyid(PUBLIC_PEM.decode()) == tuf_keyid(PUBLIC_PEM)
+
+
+def test_canonicalize_roles_in_process_pool():
+  roles = _roles(8)
+  expected = canonicalize_roles(roles, processes=1)
+  assert [role for role, _, _ in expected] == list(roles)
+  pooled = canonicalize_roles(roles, processes=2, process_pool_threshold=0)
+  assert [data for _, data, _ in pooled] == [data for _, data, _ in expected]
+
+
+def test_sign_tuf_metadata_should_sign_all_roles_in_one_session(pkcs11):
+  roles = _roles()
+  result = sc_sign_tuf_metadata(roles, VALID_KEY_ID, VALID_PIN, public_pem=PUBLIC_PEM,
+                                pkcs11=pkcs11)
+
+  assert len(pkcs11.opened_sessions) == 1
+  assert result.keyid == tuf_keyid(PUBLIC_PEM)
+  assert set(result.timings) == set(roles)
+  for role, metadata in roles.items():
+    entry = result.signatures[role]
+    assert entry['keyid'] == result.keyid
+    assert set(result.timings[role]) == {'canonicalize', 'sign'}
+    SIGNING_KEY.public_key().verify(bytes.fromhex(entry['sig']),
+                                    encode_canonical(metadata['signed']),
+                                    PSS_PADDING, hashes.SHA256())
+
+    embed_signature(metadata, entry)
+    embed_signature(metadata, entry)
+    assert metadata['signatures'] == [entry]
+    json.dumps(metadata)
+
+
+def test_sign_tuf_metadata_should_export_public_key(pkcs11):
+  result = sc_sign_tuf_metadata(_roles(1), VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+  assert result.keyid
+  assert len(pkcs11.opened_sessions) == 2
+
+
+def test_sign_tuf_metadata_wrong_pin_should_raise_error(pkcs11):
+  with pytest.raises(SmartCardWrongPinError):
+    sc_sign_tuf_metadata(_roles(), VALID_KEY_ID, WRONG_PIN, public_pem=PUBLIC_PEM,
+                         pkcs11=pkcs11)
+
+
+class _ListBackend(SoftwareBackend):
+  """Backend returning signatures of `sign_many` as list."""
+
+  def sign_many(self, *args, **kwargs):
+    return list(super().sign_many(*args, **kwargs))
+
+
+@pytest.mark.parametrize('backend_cls', [SoftwareBackend, _ListBackend])
+def test_sign_tuf_metadata_should_use_backend(tmp_path, backend_cls):
+  (tmp_path / 'key-01.pem').write_bytes(SIGNING_KEY.private_bytes(
+      serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+      serialization.NoEncryption()))
+  roles = _roles()
+  set_backend(backend_cls(tmp_path, processes=1))
+  try:
+    result = sc_sign_tuf_metadata(roles, VALID_KEY_ID, VALID_PIN)
+  finally:
+    set_backend(None)
+
+  assert result.keyid == tuf_keyid(PUBLIC_PEM)
+  for role, metadata in roles.items():
+    SIGNING_KEY.public_key().verify(bytes.fromhex(result.signatures[role]['sig']),
+                                    encode_canonical(metadata['signed']),
+                                    PSS_PADDING, hashes.SHA256())
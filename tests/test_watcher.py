@@ -0,0 +1,101 @@
+import pytest
+
+from oll_sc.api import sc_is_present, sc_sign_rsa_pkcs_pss_sha256
+from oll_sc.object_cache import disable_object_cache, enable_object_cache
+from oll_sc.session_pool import disable_session_pool, enable_session_pool
+from oll_sc.watcher import (TokenWatcher, get_token_watcher,
+                            start_token_watcher, stop_token_watcher)
+
+from .settings import TOKEN_SERIAL, VALID_KEY_ID, VALID_PIN
+
+pytestmark = pytest.mark.skip_smartcard
+
+
+@pytest.fixture
+def watcher(pkcs11):
+  # Checks are run by tests, background thread waits for an hour
+  watcher = start_token_watcher(interval=3600, pkcs11=pkcs11)
+  yield watcher
+  stop_token_watcher()
+
+
+def test_sc_is_present_should_read_watcher_snapshot(watcher, pkcs11):
+  calls = pkcs11.get_slot_list_calls
+  assert sc_is_present(pkcs11=pkcs11)
+  assert pkcs11.get_slot_list_calls == calls
+
+  pkcs11.remove_token(0)
+  watcher.check()
+  assert not sc_is_present(pkcs11=pkcs11)
+  assert get_token_watcher() is watcher
+
+
+@pytest.mark.parametrize('pkcs11', [{'slots': 2, 'slot_events': True},
+                                    {'slots': 2, 'slot_events': False}], indirect=True)
+def test_watcher_should_notify_subscribers(pkcs11):
+  events = []
+  watcher = TokenWatcher(pkcs11)
+  watcher.subscribe(on_insert=lambda token: events.append(('insert', token.slot)),
+                    on_remove=lambda token: events.append(('remove', token.slot)))
+  watcher.start()
+  try:
+    assert sorted(events) == [('insert', 0), ('insert', 1)]
+    assert watcher.tokens()[0].serial == TOKEN_SERIAL
+
+    del events[:]
+    pkcs11.remove_token(1)
+    watcher.check()
+    assert events == [('remove', 1)]
+    assert set(watcher.tokens()) == {0}
+
+    del events[:]
+    pkcs11.insert_token(1)
+    watcher.check()
+    assert events == [('insert', 1)]
+  finally:
+    watcher.stop()
+
+
+def test_watcher_without_events_should_not_list_slots(pkcs11):
+  watcher = TokenWatcher(pkcs11).start()
+  try:
+    calls = pkcs11.get_slot_list_calls
+    watcher.check()
+    assert pkcs11.get_slot_list_calls == calls
+  finally:
+    watcher.stop()
+
+
+def test_token_removal_should_drop_pooled_sessions_and_cached_handles(watcher, pkcs11):
+  pool = enable_session_pool()
+  cache = enable_object_cache()
+  try:
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+    assert pool.stats()[0]['idle'] == 1
+    assert cache.stats()['size'] == 1
+
+    pkcs11.remove_token(0)
+    watcher.check()
+    assert pool.stats()[0]['idle'] == 0
+    assert cache.stats()['size'] == 0
+  finally:
+    disable_session_pool()
+    disable_object_cache()
+
+
+def test_token_reinserted_between_checks_should_drop_pooled_sessions(watcher, pkcs11):
+  events = []
+  watcher.subscribe(on_insert=lambda token: events.append(('insert', token.slot)),
+                    on_remove=lambda token: events.append(('remove', token.slot)))
+  pool = enable_session_pool()
+  try:
+    sc_sign_rsa_pkcs_pss_sha256(b'test', VALID_KEY_ID, VALID_PIN, pkcs11=pkcs11)
+    assert pool.stats()[0]['idle'] == 1
+
+    pkcs11.remove_token(0)
+    pkcs11.insert_token(0)
+    watcher.check()
+    assert events == [('remove', 0), ('insert', 0)]
+    assert pool.stats()[0]['idle'] == 0
+  finally:
+    disable_session_pool()
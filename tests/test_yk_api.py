@@ -0,0 +1,214 @@
+import importlib
+import json
+import os
+import stat
+import sys
+import types
+
+import pytest
+from click.testing import CliRunner
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from .pkcs11 import EC_SIGNING_KEY, SIGNING_KEY
+
+pytestmark = pytest.mark.skip_smartcard
+
+PIN = '654321'
+DEFAULT_MANAGEMENT_KEY = bytes.fromhex('010203040506070801020304050607080102030405060708')
+
+
+class _Yubikey:
+  """Fake Yubikey device; also used as its driver."""
+
+  def __init__(self, serial, fail=False):
+    self.serial = serial
+    self.fail = fail
+    self.driver = self
+    self.mgm_key = DEFAULT_MANAGEMENT_KEY
+    self.algorithm = None
+    self.pin = None
+    self.closed = 0
+
+  def close(self):
+    self.closed += 1
+
+
+class _PivController:
+  """Fake `ykman.piv.PivController` of a `_Yubikey`."""
+
+  def __init__(self, device):
+    self._device = device
+
+  def reset(self):
+    self._device.mgm_key = DEFAULT_MANAGEMENT_KEY
+
+  def authenticate(self, mgm_key):
+    if mgm_key != self._device.mgm_key:
+      raise ValueError('Wrong management key.')
+
+  def set_mgm_key(self, mgm_key):
+    self._device.mgm_key = mgm_key
+
+  def generate_key(self, slot, algorithm, pin_policy):
+    if self._device.fail:
+      raise OSError('Device {} failed.'.format(self._device.serial))
+    self._device.algorithm = algorithm
+    return (EC_SIGNING_KEY if algorithm == 'ECCP256' else SIGNING_KEY).public_key()
+
+  def verify(self, pin):
+    pass
+
+  def generate_self_signed_certificate(self, slot, pub_key, cert_cn, valid_from, valid_to):
+    pass
+
+  def set_pin_retries(self, pin_retries, puk_retries):
+    pass
+
+  def change_pin(self, old_pin, new_pin):
+    self._device.pin = new_pin
+
+  def change_puk(self, old_puk, new_puk):
+    pass
+
+
+def _module(name, **attributes):
+  module = types.ModuleType(name)
+  module.__dict__.update(attributes)
+  return module
+
+
+@pytest.fixture
+def devices():
+  return {}
+
+
+@pytest.fixture
+def yk_api(devices, monkeypatch):
+  """Import `oll_sc.yk_api` with ykman replaced by fakes of `devices`."""
+  def open_device(transports=None, serial=None):
+    if serial is None:
+      serial, = devices
+    return devices[serial]
+
+  modules = {
+      'ykman': _module('ykman'),
+      'ykman.descriptor': _module(
+          'ykman.descriptor', open_device=open_device,
+          list_devices=lambda transports=None: list(devices.values())),
+      'ykman.piv': _module(
+          'ykman.piv', PivController=_PivController,
+          ALGO=types.SimpleNamespace(RSA2048='RSA2048', ECCP256='ECCP256'),
+          SLOT=types.SimpleNamespace(SIGNATURE='SIGNATURE'),
+          PIN_POLICY=types.SimpleNamespace(ALWAYS='ALWAYS'),
+          generate_random_management_key=lambda: os.urandom(24)),
+      'ykman.util': _module('ykman.util', TRANSPORT=types.SimpleNamespace(CCID='CCID')),
+  }
+  for name, module in modules.items():
+    monkeypatch.setitem(sys.modules, name, module)
+  # Imported again with fakes and removed from sys.modules after the test
+  monkeypatch.delitem(sys.modules, 'oll_sc.yk_api', raising=False)
+  return importlib.import_module('oll_sc.yk_api')
+
+
+def _insert(devices, *serials, fail=()):
+  for serial in serials:
+    devices[serial] = _Yubikey(serial, fail=serial in fail)
+
+
+def test_yk_setup_all_should_report_every_device(yk_api, devices):
+  _insert(devices, 3, 1, 2)
+  reports = yk_api.yk_setup_all(PIN, 'Test')
+
+  assert [report.serial for report in reports] == [1, 2, 3]
+  for report in reports:
+    assert report.error is None
+    assert report.elapsed >= 0
+    assert isinstance(serialization.load_pem_public_key(report.pub_key_pem), rsa.RSAPublicKey)
+  # Devices are closed after listing and after setup
+  assert all(device.pin == PIN and device.closed == 2 for device in devices.values())
+
+
+def test_yk_setup_all_failure_should_not_stop_other_devices(yk_api, devices):
+  _insert(devices, 1, 2, 3, fail=(2,))
+  reports = yk_api.yk_setup_all(PIN, 'Test')
+
+  assert [report.error for report in reports] == [None, 'Device 2 failed.', None]
+  assert reports[1].pub_key_pem is None
+  assert [device.pin for device in devices.values()] == [PIN, None, PIN]
+  # Failed device is closed too
+  assert devices[2].closed == 2
+
+
+def test_yk_setup_all_should_use_new_management_key_per_device(yk_api, devices):
+  _insert(devices, 1, 2, 3)
+  yk_api.yk_setup_all(PIN, 'Test')
+
+  mgm_keys = [device.mgm_key for device in devices.values()]
+  assert len(set(mgm_keys)) == 3
+  assert DEFAULT_MANAGEMENT_KEY not in mgm_keys
+
+
+def test_yk_setup_all_should_report_management_key_of_every_device(yk_api, devices):
+  _insert(devices, 1, 2, 3, fail=(3,))
+  reports = yk_api.yk_setup_all(PIN, 'Test')
+
+  assert [report.mgm_key for report in reports] == [devices[1].mgm_key, devices[2].mgm_key, None]
+
+
+def test_yk_setup_all_should_use_given_management_key(yk_api, devices):
+  _insert(devices, 1, 2)
+  mgm_key = bytes(range(24))
+  reports = yk_api.yk_setup_all(PIN, 'Test', mgm_key=mgm_key)
+
+  assert [device.mgm_key for device in devices.values()] == [mgm_key, mgm_key]
+  assert [report.mgm_key for report in reports] == [mgm_key, mgm_key]
+
+
+def test_yk_setup_all_should_generate_eccp256_keys(yk_api, devices):
+  _insert(devices, 1, 2)
+  reports = yk_api.yk_setup_all(PIN, 'Test', key_type=yk_api.ECCP256)
+
+  assert [device.algorithm for device in devices.values()] == ['ECCP256', 'ECCP256']
+  for report in reports:
+    assert isinstance(serialization.load_pem_public_key(report.pub_key_pem),
+                      ec.EllipticCurvePublicKey)
+
+
+def test_yk_setup_all_unknown_key_type_should_raise_error(yk_api, devices):
+  _insert(devices, 1)
+  with pytest.raises(ValueError):
+    yk_api.yk_setup_all(PIN, 'Test', key_type='rsa1024')
+  assert devices[1].algorithm is None
+
+
+def test_yubikey_setup_all_command_should_write_report(yk_api, devices, tmp_path):
+  from oll_sc.cli import oll_sc
+
+  _insert(devices, 1, 2, fail=(2,))
+  report_path = tmp_path / 'report.json'
+  result = CliRunner().invoke(oll_sc, [
+      'yubikey-setup', '--pin', PIN, '--cert-cn', 'Test', '--all', '--key-type', 'eccp256',
+      '--report', str(report_path)])
+
+  assert result.exit_code == 0
+  assert 'Yubikey 1 setup' in result.output
+  assert 'Yubikey 2 failed: Device 2 failed.' in result.output
+  entries = json.loads(report_path.read_text())
+  assert stat.S_IMODE(report_path.stat().st_mode) == 0o600
+  assert [entry['serial'] for entry in entries] == [1, 2]
+  assert bytes.fromhex(entries[0]['mgm_key']) == devices[1].mgm_key
+  assert entries[1]['mgm_key'] is None
+  assert isinstance(serialization.load_pem_public_key(entries[0]['pub_key_pem'].encode()),
+                    ec.EllipticCurvePublicKey)
+  assert entries[1]['error'] == 'Device 2 failed.'
+
+
+def test_yubikey_setup_command_should_print_management_key(yk_api, devices):
+  from oll_sc.cli import oll_sc
+
+  _insert(devices, 1)
+  result = CliRunner().invoke(oll_sc, ['yubikey-setup', '--pin', PIN, '--cert-cn', 'Test'])
+
+  assert result.exit_code == 0
+  assert 'Management key: {}'.format(devices[1].mgm_key.hex()) in result.output